@@ -0,0 +1,22 @@
+# backend/backend/asgi.py
+"""
+ASGI config for the backend project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Serving it (e.g. gunicorn with uvicorn workers, see docker-compose.yml) turns
+on the async upload and download views (VAULT_ASYNC_TRANSFERS).
+
+For more information on this file, see
+https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+# Point to the project's settings module
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+# Only an ASGI server can make use of the async transfer views
+os.environ.setdefault('VAULT_ASYNC_TRANSFERS', 'True')
+
+application = get_asgi_application()
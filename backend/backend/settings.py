@@ -4,6 +4,7 @@
 import os 
 from pathlib import Path
 from dotenv import load_dotenv 
+from corsheaders.defaults import default_headers
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -45,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover the whole middleware stack (only active with VAULT_METRICS_ENABLED)
+    'vault.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     # Add WhiteNoiseMiddleware here for serving static files in production
     # 'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -94,6 +97,17 @@ DATABASES = {
     }
 }
 
+# Set DB_ENGINE=sqlite to run locally without PostgreSQL (development only).
+# PostgreSQL-only search indexes are skipped and filename search falls back
+# to plain substring matching.
+if os.getenv('DB_ENGINE', 'postgresql') == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -143,6 +157,209 @@ MEDIA_URL = '/media/'
 # Directory where user-uploaded files will be stored
 MEDIA_ROOT = BASE_DIR / 'mediafiles'
 
+# File uploads are hashed and streamed to disk as the request body is parsed,
+# so a large upload never has to fit in a worker's memory.
+FILE_UPLOAD_HANDLERS = [
+    'vault.upload_handlers.HashingFileUploadHandler',
+]
+# In-flight uploads are written here. With the local blob backend it must be
+# on the same filesystem as MEDIA_ROOT so finished uploads can be renamed
+# into place atomically.
+VAULT_UPLOAD_TEMP_DIR = os.getenv('VAULT_UPLOAD_TEMP_DIR', MEDIA_ROOT / 'tmp')
+
+# Where blob and chunk files are kept (see vault/blobstore.py):
+#   'local' - under MEDIA_ROOT
+#   's3'    - in an S3-compatible bucket (AWS S3, MinIO, ...); requires boto3,
+#             credentials come from the usual AWS_* environment variables
+VAULT_BLOB_BACKEND = os.getenv('VAULT_BLOB_BACKEND', 'local')
+# Path layout of stored files:
+#   'fanout' - uploads/ab/cd/<hash>, keeps every directory small
+#   'flat'   - uploads/<hash>, the original layout
+# Files stored under the other layout stay readable; move them over with
+# 'python manage.py vault_migrate_layout'.
+VAULT_BLOB_LAYOUT = os.getenv('VAULT_BLOB_LAYOUT', 'fanout')
+VAULT_S3_BUCKET = os.getenv('VAULT_S3_BUCKET', '')
+VAULT_S3_PREFIX = os.getenv('VAULT_S3_PREFIX', '') # Key prefix inside the bucket
+VAULT_S3_ENDPOINT_URL = os.getenv('VAULT_S3_ENDPOINT_URL', '') # e.g. http://minio:9000, empty for AWS
+VAULT_S3_REGION = os.getenv('VAULT_S3_REGION', '')
+
+# Optional read-through cache of stored files on a local disk (see
+# vault/blobcache.py), for primary storage that is slow to read (a network
+# volume, S3). Shared by every worker pointing at the same directory.
+# Empty: no cache, every read goes to primary storage.
+VAULT_BLOB_CACHE_DIR = os.getenv('VAULT_BLOB_CACHE_DIR', '')
+# Disk space the cache may use; least recently read files are evicted
+VAULT_BLOB_CACHE_MAX_BYTES = int(os.getenv('VAULT_BLOB_CACHE_MAX_BYTES', 10 * 1024 ** 3)) # 10 GB
+# Larger files are always read from primary storage
+VAULT_BLOB_CACHE_MAX_FILE_SIZE = int(os.getenv('VAULT_BLOB_CACHE_MAX_FILE_SIZE', 512 * 1024 ** 2)) # 512 MB
+
+# Background jobs on newly stored content (vault/jobs.py), queued with the
+# upload and run by 'manage.py vault_worker'. Comma-separated job kinds;
+# empty queues nothing.
+VAULT_BLOB_JOBS = [kind.strip() for kind in os.getenv('VAULT_BLOB_JOBS', 'sniff_content_type').split(',') if kind.strip()]
+# Worker processes started by vault_worker
+VAULT_WORKER_PROCESSES = int(os.getenv('VAULT_WORKER_PROCESSES', 2))
+# Attempts before a job is marked failed, and the backoff between them:
+# doubling from VAULT_JOB_RETRY_DELAY up to VAULT_JOB_MAX_RETRY_DELAY (seconds)
+VAULT_JOB_MAX_ATTEMPTS = int(os.getenv('VAULT_JOB_MAX_ATTEMPTS', 5))
+VAULT_JOB_RETRY_DELAY = float(os.getenv('VAULT_JOB_RETRY_DELAY', 10))
+VAULT_JOB_MAX_RETRY_DELAY = float(os.getenv('VAULT_JOB_MAX_RETRY_DELAY', 3600))
+# Seconds a claimed job may run before another worker takes it over
+VAULT_JOB_LEASE = int(os.getenv('VAULT_JOB_LEASE', 600))
+
+# Resumable (chunked) uploads: default, minimum and maximum chunk size in bytes
+# (only the last chunk of a file may be smaller than the minimum)
+VAULT_UPLOAD_CHUNK_SIZE = int(os.getenv('VAULT_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024)) # 8 MB
+VAULT_UPLOAD_MIN_CHUNK_SIZE = int(os.getenv('VAULT_UPLOAD_MIN_CHUNK_SIZE', 64 * 1024)) # 64 KiB
+VAULT_UPLOAD_MAX_CHUNK_SIZE = int(os.getenv('VAULT_UPLOAD_MAX_CHUNK_SIZE', 64 * 1024 * 1024)) # 64 MB
+# Most chunks one session may have; every chunk is a row walked on each status request
+VAULT_UPLOAD_MAX_CHUNKS = int(os.getenv('VAULT_UPLOAD_MAX_CHUNKS', 10000))
+# Largest file a resumable upload may declare; its part file is preallocated
+VAULT_UPLOAD_MAX_FILE_SIZE = int(os.getenv('VAULT_UPLOAD_MAX_FILE_SIZE', 50 * 1024 ** 3)) # 50 GB
+# Seconds a resumable upload stays open without receiving a chunk; expired
+# sessions are removed by 'python manage.py vault_expire_uploads'
+VAULT_UPLOAD_SESSION_TTL = int(os.getenv('VAULT_UPLOAD_SESSION_TTL', 24 * 3600)) # 1 day
+
+# Hash-first claims of content the caller does not already own must prove
+# possession (vault/claims.py); seconds a proof-of-possession challenge stays valid
+VAULT_CLAIM_CHALLENGE_TTL = int(os.getenv('VAULT_CLAIM_CHALLENGE_TTL', 300))
+
+# ZIP archives are downloaded through signed links the browser navigates to
+# (vault/archivelinks.py); seconds such a link stays valid
+VAULT_ARCHIVE_LINK_TTL = int(os.getenv('VAULT_ARCHIVE_LINK_TTL', 60))
+
+# Bulk endpoints: most files in one bulk upload or IDs in one bulk delete,
+# and rows deleted per transaction when a bulk delete selects by filter
+VAULT_BULK_MAX_ITEMS = int(os.getenv('VAULT_BULK_MAX_ITEMS', 1000))
+VAULT_BULK_BATCH_SIZE = int(os.getenv('VAULT_BULK_BATCH_SIZE', 1000))
+# Django rejects multipart requests with more files than this (default 100)
+DATA_UPLOAD_MAX_NUMBER_FILES = VAULT_BULK_MAX_ITEMS
+
+# How new content is stored:
+#   'file'   - each unique file is kept whole under 'uploads/<hash>'
+#   'chunks' - files of at least VAULT_CHUNKING_MIN_FILE_SIZE bytes are split
+#              with content-defined chunking and each unique chunk is kept once
+#              under 'chunks/<hash>', so files that are mostly identical (e.g.
+#              versions of the same document) share storage too. Chunking runs
+#              in pure Python, at a few MB/s per worker.
+# Switching engines only affects new content, existing blobs stay readable.
+VAULT_STORAGE_ENGINE = os.getenv('VAULT_STORAGE_ENGINE', 'file')
+VAULT_CHUNKING_MIN_FILE_SIZE = int(os.getenv('VAULT_CHUNKING_MIN_FILE_SIZE', 1024 * 1024)) # 1 MB
+# Chunk size bounds in bytes (the average must be a power of two). Changing
+# them only loses deduplication against chunks stored before the change.
+VAULT_CHUNK_MIN_SIZE = int(os.getenv('VAULT_CHUNK_MIN_SIZE', 16 * 1024)) # 16 KB
+VAULT_CHUNK_AVG_SIZE = int(os.getenv('VAULT_CHUNK_AVG_SIZE', 64 * 1024)) # 64 KB
+VAULT_CHUNK_MAX_SIZE = int(os.getenv('VAULT_CHUNK_MAX_SIZE', 256 * 1024)) # 256 KB
+
+# Compression of new blob files (chunked blobs are not compressed):
+#   'off'  - stored as uploaded
+#   'gzip' - gzip, from the standard library
+#   'zstd' - Zstandard, faster and smaller; requires the 'zstandard' package
+# Content types that are already compressed, and content whose sampled entropy
+# says so, are stored as is. Downloads decompress on the fly, or send the
+# stored bytes with Content-Encoding to clients that accept the codec.
+VAULT_COMPRESSION = os.getenv('VAULT_COMPRESSION', 'off')
+# Codec level, 0 for the codec's default (gzip 6, zstd 3)
+VAULT_COMPRESSION_LEVEL = int(os.getenv('VAULT_COMPRESSION_LEVEL', 0)) or None
+VAULT_COMPRESSION_MIN_SIZE = int(os.getenv('VAULT_COMPRESSION_MIN_SIZE', 4096)) # 4 KB
+
+# How blob downloads are delivered:
+#   'stream' - Django streams the file itself (works with any deployment)
+#   'accel'  - Django checks access, then returns an X-Accel-Redirect header and
+#              nginx sends the file with sendfile. Requires the API to be served
+#              through nginx with the internal location from frontend/nginx.conf.
+#              Only for the local blob backend, other blobs are always streamed.
+VAULT_DOWNLOAD_MODE = os.getenv('VAULT_DOWNLOAD_MODE', 'stream')
+# Internal nginx location that maps onto MEDIA_ROOT
+VAULT_ACCEL_REDIRECT_PREFIX = os.getenv('VAULT_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+
+# Async upload and download views (vault/async_views.py). Turned on by
+# backend/asgi.py; leave it off under WSGI, where async views only add overhead.
+VAULT_ASYNC_TRANSFERS = os.getenv('VAULT_ASYNC_TRANSFERS', 'False') == 'True'
+# Threads per process that hash and write uploads in ASGI mode. Uploads beyond
+# this many wait their turn instead of competing for CPU and disk.
+VAULT_IO_THREADS = int(os.getenv('VAULT_IO_THREADS', 8))
+# Transfer requests doing database work at once per ASGI process, i.e. the
+# database connections they hold. Keep it times the number of processes below
+# PostgreSQL's max_connections (default 100).
+VAULT_ASYNC_DB_CONNECTIONS = int(os.getenv('VAULT_ASYNC_DB_CONNECTIONS', 16))
+
+# Cache for the per-user file list responses (vault/listcache.py).
+# With VAULT_CACHE_URL (e.g. redis://redis:6379/0) all workers share one Redis
+# cache, otherwise each process keeps its own bounded in-memory cache.
+VAULT_CACHE_URL = os.getenv('VAULT_CACHE_URL', '')
+if VAULT_CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': VAULT_CACHE_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'OPTIONS': {'MAX_ENTRIES': int(os.getenv('VAULT_CACHE_MAX_ENTRIES', 5000))},
+        }
+    }
+# Seconds a cached list response is kept, 0 to turn the cache off (ETags and
+# 304 responses still work). Writes never wait for this to expire, they move
+# the user to a new cache version.
+VAULT_RESPONSE_CACHE_TIMEOUT = int(os.getenv('VAULT_RESPONSE_CACHE_TIMEOUT', 300))
+
+# Change log long-polls (files/changes/?wait=): the longest a request may
+# wait for a change, and how often waiting requests check for one. Under WSGI
+# a waiting request holds a worker, so long waits are meant for ASGI mode.
+VAULT_CHANGES_MAX_WAIT = float(os.getenv('VAULT_CHANGES_MAX_WAIT', 30))
+VAULT_CHANGES_POLL_INTERVAL = float(os.getenv('VAULT_CHANGES_POLL_INTERVAL', 1.0))
+
+# Cached token authentication (vault/authentication.py). Resolved tokens are
+# also kept in the shared cache (Redis), on by default with VAULT_CACHE_URL and
+# ignored without it: the default cache is per process then.
+VAULT_AUTH_CACHE_SHARED = bool(VAULT_CACHE_URL) and os.getenv('VAULT_AUTH_CACHE_SHARED', 'True') == 'True'
+# Seconds a resolved token is cached (0 turns the cache off). A deleted token
+# or deactivated user is dropped everywhere within a second through the shared
+# cache; without one, other processes may accept it until the TTL runs out,
+# hence the short default.
+VAULT_AUTH_CACHE_TTL = int(os.getenv('VAULT_AUTH_CACHE_TTL', 60 if VAULT_AUTH_CACHE_SHARED else 5))
+VAULT_AUTH_CACHE_SIZE = int(os.getenv('VAULT_AUTH_CACHE_SIZE', 10000)) # Tokens per process
+# Seconds after which an API token expires and login issues a new one,
+# 0 for tokens that never expire
+VAULT_TOKEN_TTL = int(os.getenv('VAULT_TOKEN_TTL', 0))
+
+# Metrics (vault/metrics.py): request timings, per-phase upload/download/delete
+# timings and deduplication counters, served at /metrics in the Prometheus
+# text format. Off by default; when off, nothing is measured.
+VAULT_METRICS_ENABLED = os.getenv('VAULT_METRICS_ENABLED', 'False') == 'True'
+# If set, scrapers must send 'Authorization: Bearer <token>'
+VAULT_METRICS_TOKEN = os.getenv('VAULT_METRICS_TOKEN', '')
+# Directory shared by the worker processes, which write their metrics there
+# so a scrape of any one of them reports the totals. Empty: per process.
+VAULT_METRICS_DIR = os.getenv('VAULT_METRICS_DIR', '')
+VAULT_METRICS_FLUSH_INTERVAL = float(os.getenv('VAULT_METRICS_FLUSH_INTERVAL', 1.0)) # Seconds
+
+# Logging: the vault's own loggers ('vault.*') write to the console, as JSON
+# objects with structured fields (VAULT_LOG_FORMAT=json) or as plain text.
+VAULT_LOG_FORMAT = os.getenv('VAULT_LOG_FORMAT', 'json')
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'vault.logformat.JsonFormatter'},
+        'text': {'format': '%(asctime)s %(levelname)s %(name)s: %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': VAULT_LOG_FORMAT},
+    },
+    'loggers': {
+        'vault': {
+            'handlers': ['console'],
+            'level': os.getenv('VAULT_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -154,7 +371,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Restore REST_FRAMEWORK settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',   # Primary API auth
+        'vault.authentication.CachedTokenAuthentication',      # Primary API auth (TokenAuthentication with cached lookups)
         'rest_framework.authentication.SessionAuthentication', # For browsable API login
     ],
     'DEFAULT_PERMISSION_CLASSES': [
@@ -169,4 +386,8 @@ REST_FRAMEWORK = {
 # Restore CORS settings
 CORS_ALLOWED_ORIGINS = os.getenv('CORS_ALLOWED_ORIGINS', 'http://localhost:3000,http://127.0.0.1:3000').split(',')
 # CORS_ALLOW_CREDENTIALS = True # Uncomment if needed later
+# Chunked uploads send each chunk's checksum in a custom header
+CORS_ALLOW_HEADERS = (*default_headers, 'x-chunk-sha256')
+# Let browser clients read the caching and partial-content headers of downloads
+CORS_EXPOSE_HEADERS = ['Content-Disposition', 'Content-Range', 'Accept-Ranges', 'ETag']
 
@@ -2,7 +2,8 @@
 
 from django.contrib import admin
 from django.urls import path, include
-from rest_framework.authtoken.views import obtain_auth_token # For token endpoint
+from vault.views import ObtainTokenView # For token endpoint (DRF's obtain_auth_token, with expiry)
+from vault.metrics import metrics_view # Prometheus metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls), # Restore admin
@@ -14,7 +15,10 @@ urlpatterns = [
     path('api-auth/', include('rest_framework.urls', namespace='rest_framework')), # <-- Restore this
 
     # Add endpoint for obtaining authentication token
-    path('api/token-auth/', obtain_auth_token, name='api_token_auth'), # <-- Restore this
+    path('api/token-auth/', ObtainTokenView.as_view(), name='api_token_auth'), # <-- Restore this
+
+    # Prometheus scrape endpoint (404 unless VAULT_METRICS_ENABLED)
+    path('metrics', metrics_view, name='metrics'),
 ]
 
 # --- Serve Media Files during Development ---
@@ -0,0 +1,178 @@
+# backend/benchmarks/concurrent_transfers.py
+"""
+Concurrent transfer benchmark: many clients on slow links uploading to or
+downloading from a running backend, to compare deployments (e.g. gunicorn
+sync workers against the ASGI mode) at the same process count.
+
+Only needs the standard library. Each client opens its own connection and
+sends (or reads) at --rate bytes per second. While they run, a probe sends a
+small request every 0.5 s; its latency shows whether the server can still
+take new work or every worker is pinned by a transfer.
+
+    python benchmarks/concurrent_transfers.py --url http://localhost:8000 \
+        --token <api token> --mode upload --clients 200 --size 1048576 --rate 262144
+
+Downloads use one file uploaded up front. Results are printed as JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+import uuid
+from urllib.parse import urlsplit
+
+BLOCK_SIZE = 64 * 1024
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def multipart_body(filename, data):
+    boundary = uuid.uuid4().hex
+    head = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode()
+    return f'multipart/form-data; boundary={boundary}', head + data + f'\r\n--{boundary}--\r\n'.encode()
+
+
+class Client:
+    def __init__(self, url, token):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.token = token
+
+    async def request(self, method, path, body=b'', content_type=None, rate=None, read_rate=None):
+        """
+        Sends one request on a new connection. With rate/read_rate the body is
+        sent/read in blocks at that many bytes per second.
+        Returns (status, response body).
+        """
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            headers = [
+                f'{method} {path} HTTP/1.1',
+                f'Host: {self.host}:{self.port}',
+                f'Authorization: Token {self.token}',
+                'Connection: close',
+                f'Content-Length: {len(body)}',
+            ]
+            if content_type:
+                headers.append(f'Content-Type: {content_type}')
+            writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode())
+            for start in range(0, len(body), BLOCK_SIZE):
+                writer.write(body[start:start + BLOCK_SIZE])
+                await writer.drain()
+                if rate:
+                    await asyncio.sleep(BLOCK_SIZE / rate)
+            await writer.drain()
+
+            status_line = await reader.readline()
+            status = int(status_line.split()[1])
+            length = None
+            while (line := await reader.readline()) not in (b'\r\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value)
+            received = bytearray()
+            while length is None or len(received) < length:
+                block = await reader.read(BLOCK_SIZE)
+                if not block:
+                    break
+                received += block
+                if read_rate:
+                    await asyncio.sleep(len(block) / read_rate)
+            return status, bytes(received)
+        finally:
+            writer.close()
+
+
+async def probe(client, stop, latencies):
+    """Measures the latency of a small request until stop is set."""
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            status, _ = await asyncio.wait_for(client.request('GET', '/api/vault/stats/'), 30)
+            if status == 200:
+                latencies.append(time.perf_counter() - started)
+        except (OSError, asyncio.TimeoutError):
+            latencies.append(30.0)
+        await asyncio.sleep(0.5)
+
+
+async def run(options):
+    client = Client(options.url, options.token)
+    data = os.urandom(options.size)
+    file_id = None
+    if options.mode == 'download':
+        content_type, body = multipart_body('bench.bin', data)
+        status, response = await client.request('POST', '/api/vault/files/', body, content_type)
+        if status != 201:
+            raise SystemExit(f"Setup upload failed ({status}): {response[:200]!r}")
+        file_id = json.loads(response)['id']
+
+    async def transfer(index):
+        started = time.perf_counter()
+        if options.mode == 'upload':
+            # Distinct content per client, so every upload stores a new blob
+            content_type, body = multipart_body(f'bench-{index}.bin', index.to_bytes(8, 'big') + data[8:])
+            status, _ = await client.request('POST', '/api/vault/files/', body, content_type, rate=options.rate)
+            ok = status == 201
+        else:
+            status, body = await client.request(
+                'GET', f'/api/vault/files/{file_id}/download/', read_rate=options.rate
+            )
+            ok = status == 200 and len(body) == options.size
+        return ok, time.perf_counter() - started
+
+    probe_latencies = []
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(client, stop, probe_latencies))
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(transfer(index) for index in range(options.clients)), return_exceptions=True
+    )
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe_task
+
+    durations = [result[1] for result in results if not isinstance(result, BaseException) and result[0]]
+    return {
+        'mode': options.mode,
+        'clients': options.clients,
+        'size': options.size,
+        'rate': options.rate,
+        'completed': len(durations),
+        'failed': options.clients - len(durations),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_mb_s': round(len(durations) * options.size / elapsed / 2 ** 20, 2),
+        'transfer_p50_s': percentile(durations, 0.5),
+        'transfer_p99_s': percentile(durations, 0.99),
+        'probe_p50_s': percentile(probe_latencies, 0.5),
+        'probe_max_s': max(probe_latencies, default=None),
+        'probe_mean_s': statistics.fmean(probe_latencies) if probe_latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--token', required=True, help="API token of the user to transfer as")
+    parser.add_argument('--mode', choices=('upload', 'download'), default='upload')
+    parser.add_argument('--clients', type=int, default=100, help="Concurrent transfers")
+    parser.add_argument('--size', type=int, default=1024 * 1024, help="Bytes per transfer")
+    parser.add_argument('--rate', type=int, default=256 * 1024, help="Bytes per second per client, 0 for unlimited")
+    options = parser.parse_args()
+    print(json.dumps(asyncio.run(run(options)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,729 @@
+# backend/benchmarks/vault_bench.py
+"""
+Benchmark suite for the vault API: uploads (single, concurrent and dedup
+hits), full and ranged downloads, filtered file lists at 10k/100k/1M rows,
+and single and bulk deletes. Run it before and after a change to see
+whether it made things faster or slower.
+
+Everything runs in this process, through the real URLs, middleware, DRF
+views and upload handlers (Django's test client), against a throwaway
+database and a temporary MEDIA_ROOT, so it never touches existing data:
+
+    cd backend
+    python benchmarks/vault_bench.py --output before.json
+    ... change something ...
+    python benchmarks/vault_bench.py --output after.json --compare before.json
+
+--db sqlite (the default) needs nothing else. --db postgres uses the
+server from the POSTGRES_* variables and creates (and afterwards drops) a
+'test_<POSTGRES_DB>' database there, like 'manage.py test'. Uploaded
+content is generated from --seed, so runs with the same options send the
+same bytes.
+
+For every scenario the results hold the request count, errors, throughput,
+latency percentiles, database queries per request and the peak RSS of the
+process. The harness shares the process with the server code, so compare
+RSS between runs rather than reading it as the server's footprint.
+--compare reports scenarios that got slower (or run more queries) than in
+an earlier result file and exits with status 1 if there are any.
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Words and types the synthetic file names of the list corpus are made of
+NAME_WORDS = (
+    'report', 'invoice', 'photo', 'backup', 'notes', 'draft', 'final', 'budget',
+    'scan', 'contract', 'summary', 'meeting', 'design', 'export', 'q1', 'q2', 'q3', 'q4',
+)
+FILE_TYPES = (
+    ('pdf', 'application/pdf'), ('txt', 'text/plain'), ('jpg', 'image/jpeg'),
+    ('png', 'image/png'), ('csv', 'text/csv'), ('zip', 'application/zip'),
+    ('docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+)
+# Distinct blobs the list corpus rows point at (their content is never read)
+LIST_CORPUS_BLOBS = 1000
+SEED_BATCH_SIZE = 5000
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def size_label(count):
+    """10000 -> '10k', 1000000 -> '1M'."""
+    for factor, suffix in ((1_000_000, 'M'), (1_000, 'k')):
+        if count >= factor and count % factor == 0:
+            return f'{count // factor}{suffix}'
+    return str(count)
+
+
+# --- Measurements ---
+
+class QueryCounter:
+    """Database execute wrapper counting the queries of one request."""
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class RssSampler:
+    """
+    Peak resident set size of the process while it is active, sampled from
+    /proc every few milliseconds. Elsewhere only the peak of the whole
+    process so far is available (getrusage).
+    """
+    interval = 0.005
+
+    def __init__(self):
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return None
+
+    @staticmethod
+    def process_peak():
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024 # Bytes on macOS, KB elsewhere
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current() or 0)
+
+    def __enter__(self):
+        if self.current() is not None:
+            self.peak = self.current()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is None:
+            self.peak = self.process_peak()
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, self.current() or 0)
+
+
+class Scenario:
+    """Latency, query count and transferred bytes of every request of one scenario."""
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.queries = []
+        self.bytes = 0
+        self.errors = 0
+        self.statuses = {}
+        self.elapsed = 0.0
+        self.peak_rss = None
+        self._lock = threading.Lock()
+
+    def request(self, send, expected, size=0):
+        """
+        Sends one request with send(), reads the whole response body and
+        records it. size counts the request's own payload (uploads); the
+        response body is counted as well. Returns the response.
+        """
+        from django.db import connection
+
+        counter = QueryCounter()
+        started = time.perf_counter()
+        # Streamed bodies are read inside the wrapper: their queries (e.g.
+        # chunk manifest pages) belong to the request
+        with connection.execute_wrapper(counter):
+            response = send()
+            if response.streaming:
+                body = sum(len(block) for block in response.streaming_content)
+            else:
+                body = len(response.content)
+            response.close()
+        elapsed = time.perf_counter() - started
+
+        with self._lock:
+            self.latencies.append(elapsed)
+            self.queries.append(counter.count)
+            self.bytes += size + body
+            self.statuses[response.status_code] = self.statuses.get(response.status_code, 0) + 1
+            if response.status_code != expected:
+                self.errors += 1
+        return response
+
+    @contextmanager
+    def run(self):
+        """Times the whole scenario (wall clock, for throughput) and samples RSS."""
+        print(f"  {self.name}...", file=sys.stderr, flush=True)
+        with RssSampler() as sampler:
+            started = time.perf_counter()
+            try:
+                yield self
+            finally:
+                self.elapsed = time.perf_counter() - started
+        self.peak_rss = sampler.peak
+
+    def summary(self):
+        count = len(self.latencies)
+        ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+        return {
+            'requests': count,
+            'errors': self.errors,
+            'statuses': {str(status): n for status, n in sorted(self.statuses.items())},
+            'elapsed_s': round(self.elapsed, 3),
+            'throughput_rps': round(count / self.elapsed, 2) if self.elapsed else None,
+            'throughput_mb_s': round(self.bytes / self.elapsed / 2 ** 20, 2) if self.elapsed else None,
+            'bytes': self.bytes,
+            'latency_ms': {
+                'p50': ms(percentile(self.latencies, 0.5)),
+                'p90': ms(percentile(self.latencies, 0.9)),
+                'p99': ms(percentile(self.latencies, 0.99)),
+                'max': ms(max(self.latencies, default=None)),
+                'mean': ms(statistics.fmean(self.latencies)) if count else None,
+            },
+            'db_queries': {
+                'mean': round(statistics.fmean(self.queries), 2) if count else None,
+                'max': max(self.queries, default=None),
+                'total': sum(self.queries),
+            },
+            'peak_rss_bytes': self.peak_rss,
+        }
+
+
+# --- Synthetic upload corpus ---
+
+def parse_size_distribution(spec):
+    """
+    'fixed:BYTES', 'uniform:MIN:MAX' or 'lognormal:MEDIAN:SIGMA' -> a
+    function drawing a size from a random.Random.
+    """
+    kind, _, args = spec.partition(':')
+    try:
+        values = [float(value) for value in args.split(':')] if args else []
+        if kind == 'fixed' and len(values) == 1:
+            return lambda rng: int(values[0])
+        if kind == 'uniform' and len(values) == 2:
+            return lambda rng: rng.randint(int(values[0]), int(values[1]))
+        if kind == 'lognormal' and len(values) == 2:
+            mu = math.log(values[0])
+            return lambda rng: int(rng.lognormvariate(mu, values[1]))
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(
+        f"Invalid size distribution {spec!r}: use fixed:BYTES, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA"
+    )
+
+
+class Corpus:
+    """
+    Generates upload payloads: sizes drawn from the distribution, and with
+    probability dup_ratio the content of an earlier file instead of new
+    content. Content is derived from a per-item seed, so only (seed, size)
+    pairs are remembered, not the bytes.
+    """
+    def __init__(self, seed, sizes, max_size, dup_ratio):
+        self.rng = random.Random(seed)
+        self.sizes = sizes
+        self.max_size = max_size
+        self.dup_ratio = dup_ratio
+        self.contents = [] # (content seed, size) of everything generated so far
+        self.counter = 0
+
+    @staticmethod
+    def content(content_seed, size):
+        return random.Random(content_seed).randbytes(size)
+
+    def _name(self):
+        self.counter += 1
+        extension, content_type = self.rng.choice(FILE_TYPES)
+        return f'{self.rng.choice(NAME_WORDS)}_{self.counter}.{extension}', content_type
+
+    def take(self, count, dup_ratio=None):
+        """count payloads as (filename, content type, bytes, is duplicate)."""
+        dup_ratio = self.dup_ratio if dup_ratio is None else dup_ratio
+        payloads = []
+        for _ in range(count):
+            if self.contents and self.rng.random() < dup_ratio:
+                content_seed, size = self.rng.choice(self.contents)
+                duplicate = True
+            else:
+                content_seed = self.rng.getrandbits(64)
+                size = max(1, min(self.sizes(self.rng), self.max_size))
+                self.contents.append((content_seed, size))
+                duplicate = False
+            name, content_type = self._name()
+            payloads.append((name, content_type, self.content(content_seed, size), duplicate))
+        return payloads
+
+
+# --- Benchmark ---
+
+class Bench:
+    def __init__(self, options):
+        from rest_framework.authtoken.models import Token
+        from django.contrib.auth.models import User
+
+        self.options = options
+        self.results = {}
+        self.list_corpora = {} # size label -> rows and seconds spent inserting them
+        self.rng = random.Random(options.seed)
+        self.corpus = Corpus(options.seed, options.sizes, options.max_size, options.dup_ratio)
+        self.user = User.objects.create_user('bench')
+        self.token = Token.objects.create(user=self.user).key
+        self.files = [] # (id, size) of the files uploaded so far
+        self._local = threading.local()
+
+    @property
+    def client(self):
+        """This thread's API client, authenticated as the benchmark user."""
+        from rest_framework.test import APIClient
+
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            # Server errors become 500 responses, counted like any other failure
+            client = self._local.client = APIClient(raise_request_exception=False)
+            client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+        return client
+
+    def record(self, scenario, **extra):
+        self.results[scenario.name] = {**scenario.summary(), **extra}
+
+    # --- Uploads ---
+
+    def _upload(self, scenario, payload):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        name, content_type, data, _ = payload
+        response = scenario.request(
+            lambda: self.client.post(
+                '/api/vault/files/', {'file': SimpleUploadedFile(name, data, content_type)}, format='multipart',
+            ),
+            expected=201, size=len(data),
+        )
+        if response.status_code == 201:
+            self.files.append((response.data['id'], len(data)))
+
+    def uploads(self):
+        payloads = self.corpus.take(self.options.uploads)
+        with Scenario('upload_single').run() as scenario:
+            for payload in payloads:
+                self._upload(scenario, payload)
+        self.record(scenario, duplicates=sum(p[3] for p in payloads))
+
+        # Every file's content is already stored: the dedup path only
+        payloads = self.corpus.take(self.options.uploads, dup_ratio=1.0)
+        with Scenario('upload_dedup_hit').run() as scenario:
+            for payload in payloads:
+                self._upload(scenario, payload)
+        self.record(scenario, duplicates=len(payloads))
+
+    def concurrent_uploads(self):
+        from django.db import connection
+
+        payloads = self.corpus.take(self.options.uploads)
+        threads = self.options.concurrency
+        with Scenario('upload_concurrent').run() as scenario:
+            def work(offset):
+                try:
+                    for payload in payloads[offset::threads]:
+                        self._upload(scenario, payload)
+                finally:
+                    connection.close() # Each thread opened its own
+            workers = [threading.Thread(target=work, args=(offset,)) for offset in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        self.record(scenario, concurrency=threads, duplicates=sum(p[3] for p in payloads))
+
+    # --- Downloads ---
+
+    def downloads(self):
+        if not self.files:
+            return
+        with Scenario('download_full').run() as scenario:
+            for _ in range(self.options.downloads):
+                file_id, _ = self.rng.choice(self.files)
+                scenario.request(lambda: self.client.get(f'/api/vault/files/{file_id}/download/'), expected=200)
+        self.record(scenario)
+
+        with Scenario('download_range').run() as scenario:
+            for _ in range(self.options.downloads):
+                file_id, size = self.rng.choice(self.files)
+                length = min(self.options.range_size, size)
+                start = self.rng.randint(0, size - length)
+                scenario.request(
+                    lambda: self.client.get(
+                        f'/api/vault/files/{file_id}/download/', HTTP_RANGE=f'bytes={start}-{start + length - 1}',
+                    ),
+                    expected=206,
+                )
+        self.record(scenario, range_size=self.options.range_size)
+
+    # --- Deletes ---
+
+    def deletes(self):
+        files = [file_id for file_id, _ in self.files]
+        self.rng.shuffle(files)
+        single, bulk = files[:len(files) // 2], files[len(files) // 2:]
+
+        with Scenario('delete_single').run() as scenario:
+            for file_id in single:
+                scenario.request(lambda: self.client.delete(f'/api/vault/files/{file_id}/'), expected=204)
+        self.record(scenario)
+
+        batch = self.options.bulk_size
+        with Scenario('delete_bulk').run() as scenario:
+            for start in range(0, len(bulk), batch):
+                ids = bulk[start:start + batch]
+                scenario.request(
+                    lambda: self.client.post('/api/vault/files/bulk-delete/', {'ids': ids}, format='json'),
+                    expected=200,
+                )
+        self.record(scenario, files=len(bulk), batch_size=batch)
+        self.files = []
+
+    # --- File lists ---
+
+    def seed_list_corpus(self, count):
+        """
+        A user with count files: names from NAME_WORDS, assorted types and
+        sizes, upload dates spread over a year. Rows are bulk inserted;
+        their blobs exist as rows only, lists never read content.
+        Returns the user.
+        """
+        from django.contrib.auth.models import User
+        from django.db import transaction
+        from django.utils import timezone
+        from vault.models import Blob, FileMetadata, StorageUsage
+
+        rng = random.Random(f'{self.options.seed}-{count}')
+        user = User.objects.create_user(f'bench_list_{count}')
+        blobs = []
+        for index in range(LIST_CORPUS_BLOBS):
+            content_hash = hashlib.sha256(f'bench-{count}-{index}'.encode()).hexdigest()
+            blobs.append(Blob(hash=content_hash, size=int(rng.lognormvariate(11, 2)) + 1, ref_count=0))
+        Blob.objects.bulk_create(blobs)
+
+        now = timezone.now()
+        references = [0] * len(blobs)
+        logical_bytes = 0
+        # Backdated uploads: upload_date is auto_now_add, which bulk_create would apply
+        upload_date = FileMetadata._meta.get_field('upload_date')
+        upload_date.auto_now_add = False
+        try:
+            for start in range(0, count, SEED_BATCH_SIZE):
+                rows = []
+                for index in range(start, min(start + SEED_BATCH_SIZE, count)):
+                    blob_index = rng.randrange(len(blobs))
+                    blob = blobs[blob_index]
+                    references[blob_index] += 1
+                    logical_bytes += blob.size
+                    extension, content_type = rng.choice(FILE_TYPES)
+                    words = '_'.join(rng.sample(NAME_WORDS, 2))
+                    rows.append(FileMetadata(
+                        owner=user, original_filename=f'{words}-{index}.{extension}',
+                        file_hash=blob.hash, blob=blob, file_size=blob.size, content_type=content_type,
+                        upload_date=now - timedelta(seconds=rng.randrange(365 * 86400)),
+                    ))
+                with transaction.atomic():
+                    FileMetadata.objects.bulk_create(rows)
+        finally:
+            upload_date.auto_now_add = True
+
+        for blob, refs in zip(blobs, references):
+            blob.ref_count = refs
+        Blob.objects.bulk_update(blobs, ['ref_count'], batch_size=SEED_BATCH_SIZE)
+        StorageUsage.objects.create(
+            user=user, file_count=count, logical_bytes=logical_bytes, version=1,
+            physical_bytes=sum(blob.size for blob, refs in zip(blobs, references) if refs),
+        )
+        return user
+
+    def list_queries(self, user):
+        """{name: query string} of the list requests measured at every size."""
+        from django.utils import timezone
+        from vault.models import FileMetadata
+        from vault.pagination import FileKeysetPagination
+
+        # A page from the middle of the list, as reached by following 'next' links
+        middle = (
+            FileMetadata.objects.filter(owner=user).order_by('-upload_date', '-id')
+            .values_list('upload_date', 'id')[FileMetadata.objects.filter(owner=user).count() // 2]
+        )
+        cursor = FileKeysetPagination().encode_cursor(('upload_date', *middle))
+        today = timezone.now().date()
+        return {
+            'first_page': '',
+            'middle_page': f'cursor={cursor}',
+            'filename': 'original_filename=report',
+            'search': 'search=rep%20fin',
+            'content_type': 'content_type=image',
+            'size_range': 'file_size_min=10000&file_size_max=100000',
+            'date_range': f'upload_date_after={today - timedelta(days=30)}&upload_date_before={today}',
+            'combined': 'original_filename=q3&content_type=pdf&file_size_min=1000',
+        }
+
+    def lists(self):
+        from django.test import override_settings
+        from rest_framework.authtoken.models import Token
+        from rest_framework.test import APIClient
+
+        for count in self.options.list_sizes:
+            label = size_label(count)
+            print(f"  seeding {count} files...", file=sys.stderr, flush=True)
+            started = time.perf_counter()
+            user = self.seed_list_corpus(count)
+            seed_seconds = time.perf_counter() - started
+            client = APIClient(raise_request_exception=False)
+            client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=user).key}')
+
+            # The query and serializer cost: response cache off
+            with override_settings(VAULT_RESPONSE_CACHE_TIMEOUT=0):
+                for name, query in self.list_queries(user).items():
+                    with Scenario(f'list_{name}_{label}').run() as scenario:
+                        for _ in range(self.options.list_repeats):
+                            scenario.request(lambda: client.get(f'/api/vault/files/?{query}'), expected=200)
+                    self.record(scenario, rows=count, query=query)
+
+            # Repeated requests as clients make them: from the cache, and revalidated by ETag
+            client.get('/api/vault/files/')
+            with Scenario(f'list_cached_{label}').run() as scenario:
+                for _ in range(self.options.list_repeats):
+                    response = scenario.request(lambda: client.get('/api/vault/files/'), expected=200)
+            self.record(scenario, rows=count)
+
+            etag = response['ETag']
+            with Scenario(f'list_not_modified_{label}').run() as scenario:
+                for _ in range(self.options.list_repeats):
+                    scenario.request(lambda: client.get('/api/vault/files/', HTTP_IF_NONE_MATCH=etag), expected=304)
+            self.record(scenario, rows=count)
+            self.list_corpora[label] = {'rows': count, 'seed_s': round(seed_seconds, 3)}
+
+    def run(self):
+        groups = {
+            'upload': self.uploads,
+            'concurrent': self.concurrent_uploads,
+            'download': self.downloads,
+            'delete': self.deletes,
+            'list': self.lists,
+        }
+        for name, run in groups.items():
+            if name in self.options.only:
+                run()
+
+
+# --- Setup ---
+
+def _begin_immediate(execute, sql, params, many, context):
+    return execute('BEGIN IMMEDIATE' if sql == 'BEGIN' else sql, params, many, context)
+
+
+def _begin_immediate_on_sqlite(sender, connection, **kwargs):
+    # Transactions take SQLite's write lock when they begin, so concurrent
+    # writers wait for each other (up to the timeout). With a plain BEGIN
+    # a transaction that read first fails with "database is locked" when
+    # it tries to write. (Django 5.1's transaction_mode='IMMEDIATE'.)
+    if _begin_immediate not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_begin_immediate)
+
+
+def configure_django(options, media_root):
+    """Settings for a throwaway run: temp MEDIA_ROOT, in-process cache, test database."""
+    sys.path.insert(0, BACKEND_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+    os.environ['DB_ENGINE'] = 'sqlite' if options.db == 'sqlite' else 'postgresql'
+
+    from django.conf import settings
+
+    settings.MEDIA_ROOT = media_root
+    settings.VAULT_UPLOAD_TEMP_DIR = os.path.join(media_root, 'tmp')
+    # Cached lists and tokens must not come from (or leak into) a shared Redis
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    database = settings.DATABASES['default']
+    if database['ENGINE'].endswith('sqlite3'):
+        database['TEST'] = {'NAME': os.path.join(media_root, 'bench.sqlite3')}
+        # Concurrent upload threads wait this long for the write lock
+        database.setdefault('OPTIONS', {}).update(timeout=60)
+        from django.db.backends.signals import connection_created
+        connection_created.connect(_begin_immediate_on_sqlite)
+
+    import django
+    django.setup()
+
+    import logging
+    from django.test.utils import setup_test_environment
+    setup_test_environment() # Lets the test client in (ALLOWED_HOSTS)
+    # One log line per request would dominate the timings
+    logging.getLogger('vault').setLevel(logging.WARNING)
+    logging.getLogger('django.request').setLevel(logging.ERROR)
+
+
+def environment(options):
+    import django
+    from django.conf import settings
+    from django.db import connection
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    with connection.cursor():
+        database_version = '.'.join(map(str, connection.Database.sqlite_version_info)) \
+            if connection.vendor == 'sqlite' else connection.pg_version
+    return {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'database': connection.vendor,
+        'database_version': database_version,
+        'settings': {
+            name: getattr(settings, name) for name in (
+                'VAULT_STORAGE_ENGINE', 'VAULT_COMPRESSION', 'VAULT_BLOB_BACKEND',
+                'VAULT_BLOB_LAYOUT', 'VAULT_DOWNLOAD_MODE',
+            )
+        },
+        'options': {
+            'seed': options.seed, 'uploads': options.uploads, 'size_distribution': options.size_spec,
+            'max_size': options.max_size, 'dup_ratio': options.dup_ratio, 'concurrency': options.concurrency,
+            'downloads': options.downloads, 'range_size': options.range_size, 'bulk_size': options.bulk_size,
+            'list_sizes': options.list_sizes, 'list_repeats': options.list_repeats, 'only': sorted(options.only),
+        },
+    }
+
+
+def run(options):
+    media_root = tempfile.mkdtemp(prefix='vault-bench-')
+    try:
+        configure_django(options, media_root)
+        from django.db import connection
+
+        print(f"Creating the benchmark database ({connection.vendor})...", file=sys.stderr, flush=True)
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            report = {'environment': environment(options)}
+            started = time.perf_counter()
+            bench = Bench(options)
+            bench.run()
+            report['scenarios'] = bench.results
+            report['list_corpora'] = bench.list_corpora
+            report['environment']['elapsed_s'] = round(time.perf_counter() - started, 3)
+            report['environment']['max_rss_bytes'] = RssSampler.process_peak()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+    finally:
+        if options.keep_media:
+            print(f"Media kept in {media_root}", file=sys.stderr)
+        else:
+            shutil.rmtree(media_root, ignore_errors=True)
+    return report
+
+
+# --- Comparison ---
+
+def compare(baseline, current, tolerance):
+    """
+    Lists what got worse from baseline to current: latency p50/p99 or
+    throughput by more than tolerance (a fraction), and any increase in
+    queries per request, which does not vary between runs.
+    """
+    regressions = []
+    for name, now in current['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None or 'latency_ms' not in now or 'latency_ms' not in before:
+            continue
+        for key in ('p50', 'p99'):
+            old, new = before['latency_ms'][key], now['latency_ms'][key]
+            if old and new and new > old * (1 + tolerance):
+                regressions.append(f"{name}: latency {key} {old} -> {new} ms (+{(new / old - 1) * 100:.0f}%)")
+        old, new = before['throughput_rps'], now['throughput_rps']
+        if old and new and new < old * (1 - tolerance):
+            regressions.append(f"{name}: throughput {old} -> {new} req/s ({(new / old - 1) * 100:.0f}%)")
+        old, new = before['db_queries']['mean'], now['db_queries']['mean']
+        if old is not None and new is not None and new > old:
+            regressions.append(f"{name}: queries per request {old} -> {new}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--db', choices=('sqlite', 'postgres'), default='sqlite')
+    parser.add_argument('--output', help="Write the results here (JSON) instead of to stdout")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', default='upload,concurrent,download,delete,list',
+                        help="Comma-separated scenario groups to run")
+    parser.add_argument('--uploads', type=int, default=200, help="Files per upload scenario")
+    parser.add_argument('--sizes', dest='size_spec', default='lognormal:65536:1.5',
+                        help="Upload size distribution: fixed:BYTES, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA")
+    parser.add_argument('--max-size', type=int, default=16 * 1024 * 1024, help="Largest generated upload")
+    parser.add_argument('--dup-ratio', type=float, default=0.3,
+                        help="Share of uploads repeating earlier content (upload_single, upload_concurrent)")
+    parser.add_argument('--concurrency', type=int, default=8, help="Threads uploading at once")
+    parser.add_argument('--downloads', type=int, default=200, help="Requests per download scenario")
+    parser.add_argument('--range-size', type=int, default=64 * 1024, help="Bytes per ranged download")
+    parser.add_argument('--bulk-size', type=int, default=100, help="IDs per bulk delete request")
+    parser.add_argument('--list-sizes', default='10000,100000,1000000', help="Comma-separated row counts")
+    parser.add_argument('--list-repeats', type=int, default=20, help="Requests per list scenario")
+    parser.add_argument('--keep-media', action='store_true', help="Keep the temporary MEDIA_ROOT")
+    parser.add_argument('--compare', metavar='BASELINE', help="Earlier results to check this run against")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="Slowdown (fraction) tolerated by --compare before it is a regression")
+    options = parser.parse_args()
+    options.sizes = parse_size_distribution(options.size_spec)
+    options.list_sizes = [int(size) for size in options.list_sizes.split(',') if size]
+    options.only = set(options.only.split(','))
+    if not 0 <= options.dup_ratio <= 1:
+        parser.error("--dup-ratio must be between 0 and 1")
+
+    report = run(options)
+    output = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if options.compare:
+        with open(options.compare) as f:
+            regressions = compare(json.load(f), report, options.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("No regressions.", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
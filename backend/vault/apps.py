@@ -0,0 +1,11 @@
+# vault/apps.py
+from django.apps import AppConfig
+
+
+class VaultConfig(AppConfig):
+    name = 'vault'
+
+    def ready(self):
+        # Connects the signals that invalidate cached tokens, and the one
+        # that releases a deleted user's files
+        from . import authentication, services # noqa: F401
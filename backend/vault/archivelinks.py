@@ -0,0 +1,70 @@
+# vault/archivelinks.py
+"""
+Short-lived links to ZIP archives (the files/archive/ endpoint).
+
+The archive streams as it is built, but a browser only saves a response
+straight to disk when it navigates to it, and a navigation cannot send the
+Authorization header. Fetching the archive with a script instead holds all
+of it in memory before it can be saved. So the frontend first asks
+files/archive-link/ (authenticated as usual) for a link, then navigates to it.
+
+The link carries a signed token (django.core.signing, like vault/claims.py)
+bound to the user and to the exact selection in the query string, valid
+for VAULT_ARCHIVE_LINK_TTL seconds. ArchiveLinkAuthentication accepts it on
+the archive endpoint only: a leaked link downloads that one archive, for a
+minute, and nothing else.
+"""
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication
+
+SALT = 'vault.archive-links'
+# Query parameter carrying the token
+LINK_PARAM = 'link'
+
+
+def _selection(query_params):
+    """The query string without the token, in a canonical order."""
+    return urlencode(sorted(
+        (key, value)
+        for key, values in query_params.lists() if key != LINK_PARAM
+        for value in values
+    ))
+
+
+def make_archive_link(user_id, query_params, path):
+    """
+    The URL (path and query string) of the archive at path selected by
+    query_params, for user_id, usable without any other credentials.
+    """
+    selection = _selection(query_params)
+    token = signing.dumps({'u': user_id, 'q': selection}, salt=SALT, compress=True)
+    link = urlencode({LINK_PARAM: token})
+    return f"{path}?{selection}&{link}" if selection else f"{path}?{link}"
+
+
+class ArchiveLinkAuthentication(BaseAuthentication):
+    """
+    Authenticates requests carrying a valid archive link token (?link=...),
+    for the selection it was issued for. Requests without one are left to
+    the other authentication classes.
+    """
+
+    def authenticate(self, request):
+        token = request.query_params.get(LINK_PARAM)
+        if not token:
+            return None
+        try:
+            data = signing.loads(token, salt=SALT, max_age=settings.VAULT_ARCHIVE_LINK_TTL)
+        except signing.BadSignature: # Includes SignatureExpired
+            raise exceptions.AuthenticationFailed("Invalid or expired download link.")
+        if data.get('q') != _selection(request.query_params):
+            raise exceptions.AuthenticationFailed("Download link does not match the selection.")
+        user = get_user_model().objects.filter(pk=data.get('u'), is_active=True).first()
+        if user is None:
+            raise exceptions.AuthenticationFailed("User inactive or deleted.")
+        return user, None
@@ -0,0 +1,148 @@
+# vault/archives.py
+"""
+Streaming ZIP archives of several stored files.
+
+The archive is produced by a generator while the response is being sent:
+zipfile writes into a small sink that is emptied after every block, so no
+temp archive is built and memory use does not depend on the archive size.
+The output is not seekable, so entries carry their CRC and sizes in a data
+descriptor after the content (and ZIP64 records where needed), which every
+mainstream unzip tool supports.
+"""
+import logging
+import os
+import zipfile
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .compression import is_compressed_content_type
+from .dbslots import streaming_query
+from .downloads import STREAM_BLOCK_SIZE
+from .services import open_blob
+
+logger = logging.getLogger(__name__)
+
+# Listed in the archive when some blobs could not be read from storage
+MISSING_FILES_ENTRY = 'MISSING_FILES.txt'
+
+# Earliest timestamp a ZIP entry can hold
+_ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+# FileMetadata rows fetched per query while an archive streams
+ARCHIVE_BATCH_SIZE = 500
+
+
+def archive_entry_name(filename, used_names):
+    """
+    Returns a safe, unique entry name for filename and records it in
+    used_names. Path separators are replaced so entries cannot escape the
+    extraction directory, and repeated names become 'name (1).ext', etc.
+    Uniqueness is case-insensitive, as on Windows and macOS filesystems.
+    """
+    name = filename.replace('/', '_').replace('\\', '_').strip()
+    if not name.strip('.'):
+        name = 'file'
+    stem, ext = os.path.splitext(name)
+    candidate, counter = name, 0
+    while candidate.lower() in used_names:
+        counter += 1
+        candidate = f"{stem} ({counter}){ext}"
+    used_names.add(candidate.lower())
+    return candidate
+
+
+class _StreamSink:
+    """
+    Write-only file object for zipfile. Collects written bytes until they
+    are drained into the response. Having no seek() or tell() makes zipfile
+    switch to its streaming mode.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def _zip_date_time(value):
+    if value is None:
+        return _ZIP_EPOCH
+    local = timezone.localtime(value) if timezone.is_aware(value) else value
+    return max(local.timetuple()[:6], _ZIP_EPOCH)
+
+
+def iter_archive_files(queryset, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    The FileMetadata rows of queryset, newest first, fetched a batch at a
+    time as they are consumed. Each batch is a separate keyset query on
+    (upload_date, id), not a server-side cursor, so no connection has to
+    stay open between batches while the archive streams.
+    """
+    queryset = queryset.order_by('-upload_date', '-id')
+    last = None
+    while True:
+        batch = queryset
+        if last is not None:
+            batch = batch.filter(
+                Q(upload_date__lt=last.upload_date) | Q(upload_date=last.upload_date, id__lt=last.id)
+            )
+        with streaming_query():
+            batch = list(batch[:batch_size])
+        yield from batch
+        if len(batch) < batch_size:
+            return
+        last = batch[-1]
+
+
+def iter_zip_archive(files):
+    """
+    Yields a ZIP archive of the given FileMetadata records, block by block.
+    files may be a lazy iterator (e.g. iter_archive_files()), it is consumed
+    as the archive is written; select_related('blob') saves a query per file.
+    """
+    sink = _StreamSink()
+    used_names = set()
+    missing = []
+
+    with zipfile.ZipFile(sink, mode='w', allowZip64=True) as archive:
+        for metadata in files:
+            name = archive_entry_name(metadata.original_filename, used_names)
+            try:
+                file_handle = open_blob(metadata.blob)
+            except OSError as e:
+                logger.error("Could not open blob for archive", extra={'file_hash': metadata.file_hash, 'error': str(e)})
+                missing.append(name)
+                continue
+
+            entry = zipfile.ZipInfo(name, date_time=_zip_date_time(metadata.upload_date))
+            entry.external_attr = 0o644 << 16 # -rw-r--r--
+            entry.compress_type = (
+                zipfile.ZIP_STORED if is_compressed_content_type(metadata.content_type)
+                else zipfile.ZIP_DEFLATED
+            )
+            # Known up front, lets zipfile decide whether ZIP64 fields are needed
+            entry.file_size = metadata.file_size
+
+            with file_handle, archive.open(entry, mode='w') as entry_stream:
+                for block in iter(lambda: file_handle.read(STREAM_BLOCK_SIZE), b''):
+                    entry_stream.write(block)
+                    yield from sink.drain()
+            yield from sink.drain() # Data descriptor
+
+        if missing:
+            archive.writestr(
+                archive_entry_name(MISSING_FILES_ENTRY, used_names),
+                "These files could not be read from storage:\n" + "\n".join(missing) + "\n",
+            )
+    # Central directory, written when the archive is closed
+    yield from sink.drain()
@@ -0,0 +1,315 @@
+# vault/async_views.py
+"""
+Async serving of the transfer endpoints (upload, bulk upload, download,
+archive) when the backend runs under ASGI (backend/asgi.py, which turns
+VAULT_ASYNC_TRANSFERS on).
+
+Django's ASGI handler receives the request body without blocking, so a slow
+client no longer holds a worker while it uploads. The views here then keep
+the event loop free for the rest of the request:
+
+- Multipart bodies are parsed (hashed and written to a temp file by
+  HashingFileUploadHandler) in a bounded thread pool, VAULT_IO_THREADS wide,
+  so a burst of uploads queues for CPU and disk instead of piling up threads.
+- The DRF view itself (ORM work in its transaction, serialization) runs
+  through sync_to_async in the request's own thread. A request that was
+  authenticated before its body was parsed hands the user to the view, so
+  the token is looked up once.
+- Streaming responses are turned into async iterators that read each block
+  in that same thread. Left as is, Django would read the whole file into
+  memory before sending a sync iterator over ASGI.
+
+Each request thread has its own database connection, and at most
+VAULT_ASYNC_DB_CONNECTIONS requests per process use theirs at once, so the
+number of connections does not grow with the number of open transfers (a
+thousand slow downloads must not need a thousand PostgreSQL connections).
+The connection is closed before waiting for the pool and before streaming.
+Streams that still query (chunk manifest pages, archive rows in batches)
+do so through vault/dbslots.py: each query waits for a slot and the
+connection is closed again before the slot is given back.
+
+Long-polls of the change log (files/changes/?wait=) wait here too, without
+a thread or a connection: one ChangeWatcher per event loop checks the
+versions of all waiting users in a single query every
+VAULT_CHANGES_POLL_INTERVAL seconds and wakes those whose files changed.
+"""
+import asyncio
+import functools
+import logging
+import time
+import weakref
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import receiver
+from django.http import JsonResponse
+from django.http.multipartparser import MultiPartParserError
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+
+from .changes import decode_cursor, parse_wait
+from .dbslots import stream_slot
+from .listcache import get_files_version
+from .models import StorageUsage
+
+logger = logging.getLogger(__name__)
+
+_END = object() # Marks the end of a sync iterator
+
+# Event loop -> asyncio.Semaphore bounding the requests doing database work
+_db_slots = weakref.WeakKeyDictionary()
+
+# Event loop -> ChangeWatcher
+_watchers = weakref.WeakKeyDictionary()
+
+
+@functools.cache
+def get_io_pool():
+    """The process-wide thread pool for hashing and writing uploads."""
+    return ThreadPoolExecutor(max_workers=settings.VAULT_IO_THREADS, thread_name_prefix='vault-io')
+
+
+@receiver(setting_changed)
+def _reset_io_pool(setting, **kwargs):
+    if setting == 'VAULT_IO_THREADS':
+        get_io_pool.cache_clear()
+
+
+async def run_in_io_pool(func, *args):
+    """Runs func(*args) in the I/O thread pool and waits for it without blocking."""
+    return await asyncio.get_running_loop().run_in_executor(get_io_pool(), func, *args)
+
+
+def db_slot():
+    """Semaphore to hold while a request (in its thread) uses the database."""
+    loop = asyncio.get_running_loop()
+    if loop not in _db_slots:
+        _db_slots[loop] = asyncio.Semaphore(settings.VAULT_ASYNC_DB_CONNECTIONS)
+    return _db_slots[loop]
+
+
+@contextmanager
+def _hold_slot_from_thread(slot, loop):
+    """
+    Holds slot (a db_slot() of loop) from a request's sync thread for one
+    query of a streaming response, and closes the connection before giving
+    the slot back.
+    """
+    asyncio.run_coroutine_threadsafe(slot.acquire(), loop).result()
+    try:
+        yield
+    finally:
+        try:
+            connections.close_all()
+        finally:
+            loop.call_soon_threadsafe(slot.release)
+
+
+def _next_block(iterator, slot):
+    with stream_slot(slot):
+        return next(iterator, _END)
+
+
+async def iterate_in_thread(iterable):
+    """
+    Async iterator over a sync one, each step run in the request's thread.
+    Queries a step makes through dbslots.streaming_query() hold a db_slot().
+    """
+    next_block = sync_to_async(_next_block, thread_sensitive=True)
+    slot = functools.partial(_hold_slot_from_thread, db_slot(), asyncio.get_running_loop())
+    iterator = iter(iterable)
+    while True:
+        block = await next_block(iterator, slot)
+        if block is _END:
+            return
+        yield block
+
+
+def _authenticated_user(view, request):
+    """
+    Authenticates the request the way the DRF view would. None if that fails.
+    On success the view is handed the result (as DRF's force_authenticate
+    does) instead of authenticating the request again.
+    """
+    # Actions may set their own classes (@action(authentication_classes=...))
+    authentication_classes = view.initkwargs.get('authentication_classes', view.cls.authentication_classes)
+    drf_request = Request(request, authenticators=[auth() for auth in authentication_classes])
+    try:
+        user = drf_request.user
+    except APIException:
+        return None # The view answers with the proper 401/403
+    if not user.is_authenticated:
+        return None
+    request._force_auth_user, request._force_auth_token = user, drf_request.auth
+    return user
+
+
+def _authenticate(view, request):
+    """
+    True if _authenticated_user() finds a user. Frees the connection while
+    the request waits for the pool.
+    """
+    try:
+        return _authenticated_user(view, request) is not None
+    finally:
+        connections.close_all()
+
+
+def _respond(view, request, *args, **kwargs):
+    """Runs the DRF view, then frees the connection while the response streams."""
+    try:
+        return view(request, *args, **kwargs)
+    finally:
+        connections.close_all()
+
+
+def _parse_multipart(request):
+    """Parses the body, which streams each file through the upload handlers."""
+    request.FILES # DRF finds the parsed POST and FILES on the request and reuses them
+
+
+def transfer_view(view):
+    """
+    Wraps a DRF view for ASGI: multipart bodies are parsed in the I/O pool
+    (only for authenticated requests, so anonymous uploads never reach disk),
+    the view runs in the request's thread and its streaming response is
+    served from an async iterator.
+    """
+    @functools.wraps(view)
+    async def async_view(request, *args, **kwargs):
+        if request.method in ('POST', 'PUT') and request.content_type == 'multipart/form-data':
+            async with db_slot():
+                authenticated = await sync_to_async(_authenticate)(view, request)
+            if authenticated:
+                try:
+                    await run_in_io_pool(_parse_multipart, request)
+                except MultiPartParserError as e:
+                    # Same response DRF's MultiPartParser gives
+                    return JsonResponse({'detail': f"Multipart form parse error - {e}"}, status=400)
+
+        async with db_slot():
+            response = await sync_to_async(_respond)(view, request, *args, **kwargs)
+        if response.streaming and not response.is_async:
+            response.streaming_content = iterate_in_thread(response.streaming_content)
+        return response
+
+    return async_view
+
+
+class ChangeWatcher:
+    """
+    Wakes long-polls when their user's files version moves past the one they
+    wait on. One polling task per event loop, one query per interval for all
+    waiting users, whatever their number.
+    """
+    def __init__(self):
+        self.waiters = defaultdict(list) # user ID -> [(version, future)]
+        self.task = None
+
+    async def wait(self, user_id, version, timeout):
+        """Returns True once the user's version is above version, False after timeout seconds."""
+        entry = (version, asyncio.get_running_loop().create_future())
+        self.waiters[user_id].append(entry)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._poll())
+        try:
+            await asyncio.wait_for(entry[1], timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiters[user_id].remove(entry)
+            if not self.waiters[user_id]:
+                del self.waiters[user_id]
+
+    async def _poll(self):
+        while self.waiters:
+            await asyncio.sleep(settings.VAULT_CHANGES_POLL_INTERVAL)
+            user_ids = list(self.waiters)
+            try:
+                async with db_slot():
+                    versions = await sync_to_async(_current_versions, thread_sensitive=False)(user_ids)
+            except Exception as e:
+                # Waiters time out and get the (empty) changes then, nothing is lost
+                logger.error("Could not poll file versions for long-polls", extra={'error': str(e)})
+                continue
+            for user_id in user_ids:
+                for version, future in self.waiters.get(user_id, ()):
+                    if versions.get(user_id, 0) > version and not future.done():
+                        future.set_result(None)
+
+
+def _current_versions(user_ids):
+    try:
+        return dict(StorageUsage.objects.filter(pk__in=user_ids).values_list('pk', 'version'))
+    finally:
+        connections.close_all()
+
+
+def get_change_watcher():
+    loop = asyncio.get_running_loop()
+    if loop not in _watchers:
+        _watchers[loop] = ChangeWatcher()
+    return _watchers[loop]
+
+
+def _long_poll_state(view, request):
+    """
+    (user ID, version to wait past) if the request should wait for a change,
+    None if it can be answered right away (not authenticated, bad parameters,
+    no cursor yet, or changes already there).
+    """
+    try:
+        user = _authenticated_user(view, request)
+        if user is None or 'since' not in request.GET:
+            return None
+        since_version, since_id = decode_cursor(request.GET['since'])
+        if since_id is not None or get_files_version(user) > since_version:
+            return None # More changes are already waiting
+        return user.pk, since_version
+    except ValueError:
+        return None # The view reports the invalid cursor
+    finally:
+        connections.close_all()
+
+
+def long_poll_view(view):
+    """
+    Wraps the change log view for ASGI: a request with ?wait= waits for a
+    change in the ChangeWatcher, then the view answers without waiting again.
+    """
+    @functools.wraps(view)
+    async def async_view(request, *args, **kwargs):
+        try:
+            wait = parse_wait(request.GET.get('wait'))
+        except ValueError:
+            wait = 0 # The view reports it
+        if wait:
+            started = time.monotonic()
+            async with db_slot():
+                state = await sync_to_async(_long_poll_state)(view, request)
+            if state is not None:
+                await get_change_watcher().wait(*state, wait - (time.monotonic() - started))
+            # The waiting is done, the view only reads the log
+            request.GET = request.GET.copy()
+            del request.GET['wait']
+
+        async with db_slot():
+            return await sync_to_async(_respond)(view, request, *args, **kwargs)
+
+    return async_view
+
+
+# Router URL names served by async views, and their wrappers
+ASYNC_ROUTES = {
+    'filemetadata-list': transfer_view, # POST uploads (GET lists go through unchanged)
+    'filemetadata-bulk-upload': transfer_view,
+    'filemetadata-download': transfer_view,
+    'filemetadata-archive': transfer_view,
+    'filemetadata-changes': long_poll_view,
+}
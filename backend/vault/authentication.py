@@ -0,0 +1,286 @@
+# vault/authentication.py
+"""
+Token authentication with cached token lookups, and optional token expiry.
+
+DRF's TokenAuthentication reads the token and its user (authtoken_token JOIN
+auth_user) on every request before the view starts. CachedTokenAuthentication
+keeps resolved tokens in a bounded in-process LRU for VAULT_AUTH_CACHE_TTL
+seconds. With VAULT_AUTH_CACHE_SHARED they are also kept in Django's default
+cache (Redis, VAULT_CACHE_URL), so a token one worker resolved is a hit for
+all the others. The shared cache holds neither the token's key (entries are
+keyed by its hash) nor the user's password hash: only the user's other
+fields and when the token was created, from which the token and user are
+rebuilt.
+
+Entries are dropped through signals when the token is deleted, and when its
+user is saved (deactivated, renamed, ...) or deleted: right away in this
+process and in the shared cache. Every such invalidation also bumps a
+generation counter in the shared cache; each process reads it at most once
+per GENERATION_CHECK_INTERVAL and empties its in-process cache when it
+moved, so a revoked token stops working everywhere within about a second.
+Without a shared cache other processes only notice when their entries
+expire, which is why the TTL defaults to a few seconds then.
+
+With VAULT_TOKEN_TTL, a token expires that many seconds after it was
+created and login (api/token-auth/) issues a new one. Cache entries never
+outlive their token.
+"""
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth import get_user_model
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+# Seconds between reads of the shared invalidation generation, per process
+GENERATION_CHECK_INTERVAL = 1.0
+_GENERATION_KEY = 'vault:token:generation'
+# User fields left out of shared cache entries, loaded from the database if used
+_UNSHARED_USER_FIELDS = {'password'}
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries also expire, safe to share between threads."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # key -> (value, expiry on the monotonic clock)
+        self._lock = threading.Lock()
+        # Bumped by every delete(), see set()
+        self.generation = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, timeout, generation=None):
+        """
+        Stores value for timeout seconds. With generation (read before the
+        value was looked up), nothing is stored if a delete() happened since:
+        the value may be what was just invalidated.
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (value, time.monotonic() + timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False) # Least recently used
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+@functools.cache
+def get_token_cache():
+    """The process-wide cache of resolved tokens."""
+    return TTLCache(settings.VAULT_AUTH_CACHE_SIZE)
+
+
+class SharedGeneration:
+    """
+    This process's view of the shared invalidation generation. check()
+    empties the token cache if another process invalidated tokens since.
+    """
+
+    def __init__(self):
+        self.value = None # Not read yet
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        now = time.monotonic()
+        with self._lock:
+            if self.checked_at is not None and now - self.checked_at < GENERATION_CHECK_INTERVAL:
+                return
+            self.checked_at = now
+            value = cache.get(_GENERATION_KEY, 0)
+            if value != self.value:
+                if self.value is not None:
+                    get_token_cache().clear()
+                self.value = value
+
+
+@functools.cache
+def get_shared_generation():
+    return SharedGeneration()
+
+
+def _bump_shared_generation():
+    try:
+        cache.incr(_GENERATION_KEY)
+    except ValueError: # Not set yet, or evicted
+        cache.add(_GENERATION_KEY, 1, timeout=None)
+
+
+@receiver(setting_changed)
+def _reset_token_cache(setting, **kwargs):
+    if setting in ('VAULT_AUTH_CACHE_SIZE', 'VAULT_AUTH_CACHE_TTL', 'VAULT_AUTH_CACHE_SHARED', 'VAULT_TOKEN_TTL'):
+        get_token_cache.cache_clear()
+        get_shared_generation.cache_clear()
+
+
+def _shared_key(key):
+    # Hashed, so the shared cache never holds usable credentials in its keys
+    # (v2: entries are _shared_entry() dicts, no longer pickled tokens)
+    return f"vault:token:v2:{hashlib.sha256(key.encode()).hexdigest()}"
+
+
+def _shared_entry(token, deadline):
+    """
+    What the shared cache keeps of a resolved token: its user's fields
+    except the password hash, when the token was created, and the deadline
+    after which nobody may keep a copy. Not the key itself.
+    """
+    user = token.user
+    return {
+        'user': {
+            field.attname: getattr(user, field.attname)
+            for field in user._meta.concrete_fields
+            if field.name not in _UNSHARED_USER_FIELDS
+        },
+        'created': token.created,
+        'deadline': deadline,
+    }
+
+
+def _token_from_shared_entry(key, entry):
+    """
+    Rebuilds the token and its user as if they were loaded from the
+    database. The password stays deferred: it is read from the database if
+    ever accessed, and save() leaves it alone.
+    """
+    user = get_user_model().from_db(DEFAULT_DB_ALIAS, list(entry['user']), list(entry['user'].values()))
+    token = Token.from_db(DEFAULT_DB_ALIAS, ['key', 'user_id', 'created'], [key, user.pk, entry['created']])
+    token.user = user
+    return token
+
+
+def token_expires_at(token):
+    """When the token expires, None if tokens do not expire."""
+    if not settings.VAULT_TOKEN_TTL:
+        return None
+    return token.created + timedelta(seconds=settings.VAULT_TOKEN_TTL)
+
+
+def is_token_expired(token):
+    expires_at = token_expires_at(token)
+    return expires_at is not None and expires_at <= timezone.now()
+
+
+def invalidate_token(key):
+    """
+    Drops a token from this process's cache and from the shared cache, and
+    has the other processes empty theirs (see SharedGeneration). Done now
+    and again once the transaction commits: until then other requests still
+    read the old rows and may cache them again.
+    """
+    def drop():
+        get_token_cache().delete(key)
+        if settings.VAULT_AUTH_CACHE_SHARED:
+            cache.delete(_shared_key(key))
+            _bump_shared_generation()
+    drop()
+    transaction.on_commit(drop)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Drop-in replacement for TokenAuthentication ('Authorization: Token <key>')
+    that answers repeated requests from the token cache instead of the
+    database, and rejects expired tokens.
+    """
+
+    def authenticate_credentials(self, key):
+        ttl = settings.VAULT_AUTH_CACHE_TTL
+        token = self._get_cached(key) if ttl else None
+        if token is None:
+            generation = get_token_cache().generation
+            try:
+                token = Token.objects.select_related('user').get(key=key)
+            except Token.DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            if ttl:
+                self._set_cached(key, token, ttl, generation)
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        if is_token_expired(token):
+            raise exceptions.AuthenticationFailed(_('Token has expired.'))
+        return (token.user, token)
+
+    def _get_cached(self, key):
+        if settings.VAULT_AUTH_CACHE_SHARED:
+            get_shared_generation().check()
+        token = get_token_cache().get(key)
+        if token is None and settings.VAULT_AUTH_CACHE_SHARED:
+            entry = cache.get(_shared_key(key))
+            if entry is not None:
+                # Kept locally for what is left of the shared entry's lifetime
+                remaining = entry['deadline'] - time.time()
+                if remaining <= 0:
+                    return None
+                token = _token_from_shared_entry(key, entry)
+                get_token_cache().set(key, token, remaining)
+        return token
+
+    def _set_cached(self, key, token, ttl, generation):
+        expires_at = token_expires_at(token)
+        if expires_at is not None:
+            ttl = min(ttl, (expires_at - timezone.now()).total_seconds())
+            if ttl <= 0:
+                return
+        if generation != get_token_cache().generation:
+            return # Tokens were invalidated while this one was read
+        get_token_cache().set(key, token, ttl, generation)
+        if settings.VAULT_AUTH_CACHE_SHARED:
+            # With its deadline: whoever copies it must not keep it longer
+            cache.set(_shared_key(key), _shared_entry(token, time.time() + ttl), max(1, int(ttl)))
+
+
+# --- Invalidation ---
+# Connected when the app is ready (vault/apps.py), so token and user changes
+# made outside the API (admin, shell, management commands) clear the shared
+# cache too.
+
+@receiver(post_delete, sender=Token)
+def _token_deleted(sender, instance, **kwargs):
+    """A deleted token (logout, rotation, deleted user) must stop working."""
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def _user_saved(sender, instance, **kwargs):
+    """Cached tokens carry a copy of their user, e.g. is_active."""
+    for key in Token.objects.filter(user_id=instance.pk).values_list('key', flat=True):
+        invalidate_token(key)
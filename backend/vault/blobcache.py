@@ -0,0 +1,275 @@
+# vault/blobcache.py
+"""
+Read-through cache of stored files on a local disk (VAULT_BLOB_CACHE_DIR),
+in front of slower primary storage: a network volume or an S3 bucket.
+
+Stored files are named after the hash of their content and never change,
+so a cached copy is valid for as long as it exists. Nothing is ever
+invalidated, entries only go away when they are evicted.
+
+  - Reads: CachedBackend.open() serves the cached copy if there is one
+    (a hit). Otherwise it copies the file from the primary backend into the
+    cache and serves that copy (a miss). Files larger than
+    VAULT_BLOB_CACHE_MAX_FILE_SIZE are read from the primary directly.
+  - Single flight: a miss takes an exclusive lock on a per-file lock file
+    before fetching. Concurrent misses for the same file, in any thread or
+    worker process, wait for that one fetch and then read its copy.
+  - Budget: every process adds up what it fills. After a twentieth of
+    VAULT_BLOB_CACHE_MAX_BYTES, it scans the cache directory and deletes
+    the least recently used files until the total is back under 90% of
+    the budget. A hit refreshes its file's mtime, which orders the eviction.
+  - Everything else (exists, size, writes, deletes) goes to the primary
+    backend, which stays the only authority on what is stored. Deleting a
+    stored file also drops this process's cached copy.
+
+Hits, misses, fills and evictions are counted in the metrics
+(vault/metrics.py) and logged after every sweep.
+"""
+import fcntl
+import logging
+import os
+import shutil
+import threading
+import time
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Work directory inside the cache for lock files and partial copies
+FILL_DIR = '.fill'
+# Bytes copied per read while filling
+COPY_BLOCK_SIZE = 1024 * 1024 # 1 MB
+# A hit refreshes the file's mtime at most this often (seconds)
+TOUCH_INTERVAL = 60
+# A sweep runs after this share of the budget was filled, and evicts down to LOW_WATER
+SWEEP_FRACTION = 0.05
+LOW_WATER = 0.9
+
+
+class BlobCache:
+    """
+    The cache directory: LRU files under a byte budget, filled single-flight.
+    Shared by every process pointing at the same directory.
+    """
+
+    def __init__(self, root, max_bytes, max_file_size):
+        self.root = str(root)
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        os.makedirs(os.path.join(self.root, FILL_DIR), exist_ok=True)
+        self._lock = threading.Lock()
+        # Bytes this process filled since its last sweep; None until the first
+        # fill, which sweeps right away (the directory may be over budget
+        # after a restart with a smaller one)
+        self._filled_since_sweep = None
+        self._stats = dict.fromkeys(
+            ('hits', 'misses', 'bypassed', 'coalesced', 'fill_bytes', 'evictions', 'evicted_bytes'), 0
+        )
+
+    def _count(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self._stats[name] += amount
+
+    def stats(self):
+        """This process's counts since it started, with the hit ratio of its reads."""
+        with self._lock:
+            stats = dict(self._stats)
+        reads = stats['hits'] + stats['misses'] + stats['coalesced']
+        stats['hit_ratio'] = round((stats['hits'] + stats['coalesced']) / reads, 4) if reads else None
+        return stats
+
+    def _cache_path(self, path):
+        return os.path.join(self.root, path)
+
+    def _open_cached(self, path):
+        """The cached copy opened for reading, or None."""
+        try:
+            handle = open(self._cache_path(path), 'rb')
+        except FileNotFoundError:
+            return None
+        # Recently used: kept longer by the next sweep
+        try:
+            if os.fstat(handle.fileno()).st_mtime < time.time() - TOUCH_INTERVAL:
+                os.utime(self._cache_path(path))
+        except OSError:
+            pass # Evicted meantime, the open handle still reads it
+        return handle
+
+    def open(self, path, open_primary):
+        """
+        Opens path from the cache, filling it with open_primary(path) on a
+        miss. Raises what open_primary raises (FileNotFoundError if the file
+        is not stored).
+        """
+        handle = self._open_cached(path)
+        if handle is not None:
+            self._count(hits=1)
+            metrics.BLOB_CACHE_READS.inc(result='hit')
+            return handle
+
+        lock_path = os.path.join(self.root, FILL_DIR, path.replace('/', '_') + '.lock')
+        with open(lock_path, 'a') as lock:
+            # Waits while another thread or process fills the same file
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                handle = self._open_cached(path)
+                if handle is not None:
+                    self._count(coalesced=1)
+                    metrics.BLOB_CACHE_READS.inc(result='coalesced')
+                    return handle
+
+                source = open_primary(path)
+                size = source.seek(0, os.SEEK_END)
+                source.seek(0)
+                if size > self.max_file_size:
+                    # Would push out too much else, read it from the primary
+                    self._count(bypassed=1)
+                    metrics.BLOB_CACHE_READS.inc(result='bypassed')
+                    return source
+                with source:
+                    self._fill(path, source)
+                self._count(misses=1, fill_bytes=size)
+                metrics.BLOB_CACHE_READS.inc(result='miss')
+                metrics.BLOB_CACHE_FILL_BYTES.inc(size)
+            finally:
+                # Waiters already hold the file open and find the copy once
+                # they get the lock; later misses start a new lock file
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+
+        self._maybe_sweep(size)
+        # A sweep may just have evicted it again, then read from the primary
+        handle = self._open_cached(path)
+        return handle if handle is not None else open_primary(path)
+
+    def _fill(self, path, source):
+        """Copies source to the cache under path, atomically."""
+        partial = os.path.join(
+            self.root, FILL_DIR, f"{path.replace('/', '_')}.{os.getpid()}.{threading.get_ident()}.part"
+        )
+        try:
+            with open(partial, 'wb') as copy:
+                shutil.copyfileobj(source, copy, COPY_BLOCK_SIZE)
+                # On disk before it is visible under its name: after a crash a
+                # cached file is complete or absent, never served truncated
+                copy.flush()
+                os.fsync(copy.fileno())
+            target = self._cache_path(path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(partial, target)
+        except BaseException:
+            try:
+                os.remove(partial)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def discard(self, path):
+        """Drops the cached copy of path, if there is one."""
+        try:
+            os.remove(self._cache_path(path))
+        except FileNotFoundError:
+            pass
+
+    # --- Eviction ---
+
+    def _maybe_sweep(self, filled):
+        with self._lock:
+            if self._filled_since_sweep is not None:
+                self._filled_since_sweep += filled
+                if self._filled_since_sweep < self.max_bytes * SWEEP_FRACTION:
+                    return
+            self._filled_since_sweep = 0
+        self.sweep()
+
+    def _entries(self):
+        """(mtime, size, full path) of every cached file."""
+        for directory, subdirectories, filenames in os.walk(self.root):
+            # Files being filled and the sweep lock are not cache entries
+            if directory == self.root and FILL_DIR in subdirectories:
+                subdirectories.remove(FILL_DIR)
+            for filename in filenames:
+                full_path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(full_path)
+                except FileNotFoundError:
+                    continue # Evicted by another process meantime
+                yield stat.st_mtime, stat.st_size, full_path
+
+    def sweep(self):
+        """
+        Evicts least recently used files until the cache is under LOW_WATER of
+        its budget, if it is over budget. One process sweeps at a time, the
+        others skip. Returns the number of bytes evicted.
+        """
+        with open(os.path.join(self.root, FILL_DIR, 'sweep.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0 # Another process is sweeping
+            entries = list(self._entries())
+            total = sum(size for _, size, _ in entries)
+            evicted = evictions = 0
+            if total > self.max_bytes:
+                target = self.max_bytes * LOW_WATER
+                entries.sort()
+                for _, size, full_path in entries:
+                    if total - evicted <= target:
+                        break
+                    try:
+                        os.remove(full_path)
+                    except FileNotFoundError:
+                        continue
+                    evicted += size
+                    evictions += 1
+
+        self._count(evictions=evictions, evicted_bytes=evicted)
+        metrics.BLOB_CACHE_EVICTED_BYTES.inc(evicted)
+        logger.info("Blob cache swept", extra={
+            'cached_bytes': total - evicted,
+            'cached_files': len(entries) - evictions,
+            'budget_bytes': self.max_bytes,
+            'evicted_bytes': evicted,
+            'evicted_files': evictions,
+            'stats': self.stats(),
+        })
+        return evicted
+
+
+class CachedBackend:
+    """
+    Wraps a blob store backend (vault/blobstore.py) so its reads go through
+    a BlobCache. Writes, deletes and lookups go straight to the backend.
+    """
+
+    def __init__(self, backend, cache):
+        self.backend = backend
+        self.cache = cache
+
+    @property
+    def supports_accel(self):
+        # nginx reads the primary files directly, the cache is not involved
+        return self.backend.supports_accel
+
+    def open(self, path):
+        return self.cache.open(path, self.backend.open)
+
+    def delete(self, path):
+        self.backend.delete(path)
+        self.cache.discard(path)
+
+    def save_file(self, temp_path, path, replace=False):
+        stored = self.backend.save_file(temp_path, path, replace=replace)
+        if replace:
+            # The one case where a stored file changes (see
+            # services._store_contents): a copy of the old bytes must go
+            self.cache.discard(path)
+        return stored
+
+    def __getattr__(self, name):
+        # exists, size, save_file, move, iter_paths, ...
+        return getattr(self.backend, name)
@@ -0,0 +1,414 @@
+# vault/blobstore.py
+"""
+The blob store: where stored files (whole blobs and chunks) live.
+
+Everything that reads, writes or deletes a stored file goes through the
+BlobStore returned by get_blob_store(), which combines
+  - a layout, the one place that turns a content hash into a path:
+      'flat'   - uploads/<hash>
+      'fanout' - uploads/ab/cd/<hash> (first two byte pairs of the hash), so
+                 no directory grows past a few thousand entries
+  - a backend, which holds the bytes: the local filesystem under MEDIA_ROOT
+    or an S3-compatible bucket (AWS S3, MinIO, ...).
+
+Files written under another layout stay readable: lookups fall back to the
+other layouts when a file is not at its current path, and
+`manage.py vault_migrate_layout` moves existing files over online.
+
+With VAULT_BLOB_CACHE_DIR set, reads go through a local disk cache in front
+of the backend (vault/blobcache.py).
+"""
+import errno
+import functools
+import io
+import os
+import re
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+# Namespaces (top-level directories) of stored files
+BLOBS = 'uploads'
+CHUNKS = 'chunks'
+
+# Stored files are named after the SHA-256 of their content
+HASH_RE = re.compile(r'[0-9a-f]{64}')
+
+
+# --- Layouts ---
+
+def flat_layout(namespace, content_hash):
+    return f"{namespace}/{content_hash}"
+
+
+def fanout_layout(namespace, content_hash):
+    return f"{namespace}/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}"
+
+
+LAYOUTS = {'flat': flat_layout, 'fanout': fanout_layout}
+
+
+# --- Backends ---
+# A backend stores bytes by relative path and knows nothing about hashes.
+
+class LocalBackend:
+    """Files under a local directory (MEDIA_ROOT)."""
+    supports_accel = True # nginx can serve these paths, see VAULT_DOWNLOAD_MODE
+
+    def __init__(self, root):
+        self.root = str(root)
+
+    def full_path(self, path):
+        return os.path.join(self.root, path)
+
+    def exists(self, path):
+        return os.path.exists(self.full_path(path))
+
+    def size(self, path):
+        return os.path.getsize(self.full_path(path))
+
+    def open(self, path):
+        return open(self.full_path(path), 'rb')
+
+    def save_file(self, temp_path, path, replace=False):
+        """
+        Moves a fully written temp file to path. Returns True if it was stored,
+        or False if a file already existed there (the temp file is dropped),
+        unless replace. The rename is atomic, so readers never observe a
+        partially written file.
+        """
+        final_path = self.full_path(path)
+        if not replace and os.path.exists(final_path):
+            # Identical content is already stored, the new copy is redundant
+            os.remove(temp_path)
+            return False
+
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        # NamedTemporaryFile creates files as 0600, match regular storage saves
+        permissions = settings.FILE_UPLOAD_PERMISSIONS
+        if permissions is not None:
+            os.chmod(temp_path, permissions)
+        # os.replace is atomic on POSIX. If two uploads of the same new content
+        # race here, the second rename swaps in identical bytes, which is harmless.
+        os.replace(temp_path, final_path)
+        return True
+
+    def move(self, source, destination):
+        destination_path = self.full_path(destination)
+        os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+        os.replace(self.full_path(source), destination_path)
+
+    def delete(self, path):
+        """Deletes path. No-op if it does not exist."""
+        try:
+            os.remove(self.full_path(path))
+        except FileNotFoundError:
+            pass
+
+    def iter_paths(self, prefix):
+        """Yields the relative paths of all files under prefix."""
+        top = self.full_path(prefix)
+        for directory, _, filenames in os.walk(top):
+            for filename in filenames:
+                yield os.path.relpath(os.path.join(directory, filename), self.root)
+
+
+class S3Backend:
+    """
+    Objects in an S3-compatible bucket, under an optional key prefix. Works
+    with AWS S3 and with MinIO or other stand-ins (VAULT_S3_ENDPOINT_URL).
+    Credentials come from the usual AWS_* environment variables.
+    """
+    supports_accel = False
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region_name=None):
+        try:
+            import boto3 # Optional dependency, only needed for this backend
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise ImproperlyConfigured("VAULT_BLOB_BACKEND = 's3' requires the 'boto3' package.")
+        if not bucket:
+            raise ImproperlyConfigured("VAULT_BLOB_BACKEND = 's3' requires VAULT_S3_BUCKET.")
+        self.client = boto3.client('s3', endpoint_url=endpoint_url or None, region_name=region_name or None)
+        self.client_error = ClientError
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+
+    def _key(self, path):
+        return self.prefix + path
+
+    def _is_not_found(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def exists(self, path):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(path))
+        except self.client_error as e:
+            if self._is_not_found(e):
+                return False
+            raise OSError(f"S3 error on {path}: {e}") from e
+        return True
+
+    def size(self, path):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(path))['ContentLength']
+        except self.client_error as e:
+            if self._is_not_found(e):
+                raise FileNotFoundError(errno.ENOENT, "No such object", path) from e
+            raise OSError(f"S3 error on {path}: {e}") from e
+
+    def open(self, path):
+        return S3ObjectReader(self, path, self.size(path))
+
+    def save_file(self, temp_path, path, replace=False):
+        """Uploads a fully written temp file to path, see LocalBackend.save_file."""
+        if not replace and self.exists(path):
+            os.remove(temp_path)
+            return False
+        try:
+            # Multipart for large files; the object only appears once complete
+            self.client.upload_file(temp_path, self.bucket, self._key(path))
+        except self.client_error as e:
+            raise OSError(f"S3 upload of {path} failed: {e}") from e
+        os.remove(temp_path)
+        return True
+
+    def move(self, source, destination):
+        try:
+            self.client.copy(
+                {'Bucket': self.bucket, 'Key': self._key(source)}, self.bucket, self._key(destination)
+            )
+            self.client.delete_object(Bucket=self.bucket, Key=self._key(source))
+        except self.client_error as e:
+            if self._is_not_found(e):
+                raise FileNotFoundError(errno.ENOENT, "No such object", source) from e
+            raise OSError(f"S3 move of {source} failed: {e}") from e
+
+    def delete(self, path):
+        """Deletes path. No-op if it does not exist (S3 semantics)."""
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=self._key(path))
+        except self.client_error as e:
+            raise OSError(f"S3 delete of {path} failed: {e}") from e
+
+    def iter_paths(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix) + '/'):
+            for item in page.get('Contents', []):
+                yield item['Key'][len(self.prefix):]
+
+    def get_range(self, path, start):
+        """Streaming body of the object from byte start on."""
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self._key(path), Range=f'bytes={start}-'
+            )
+        except self.client_error as e:
+            if self._is_not_found(e):
+                raise FileNotFoundError(errno.ENOENT, "No such object", path) from e
+            raise OSError(f"S3 read of {path} failed: {e}") from e
+        return response['Body']
+
+
+class S3ObjectReader(io.RawIOBase):
+    """
+    Read-only, seekable file object over an S3 object. Reads stream one GET
+    from the current position; seeking is lazy and only starts a new
+    (ranged) GET when the next read is not where the current one left off.
+    """
+
+    def __init__(self, backend, path, size):
+        super().__init__()
+        self._backend = backend
+        self._path = path
+        self.size = size
+        self._position = 0
+        self._body = None
+        self._body_position = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def readinto(self, buffer):
+        if self._position >= self.size:
+            return 0
+        if self._body is None or self._body_position != self._position:
+            self._close_body()
+            self._body = self._backend.get_range(self._path, self._position)
+            self._body_position = self._position
+        data = self._body.read(len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        self._body_position = self._position
+        return len(data)
+
+    def _close_body(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+
+# --- Store ---
+
+class BlobStore:
+    """Stored files by (namespace, content hash), see the module docstring."""
+
+    def __init__(self, backend, layout='fanout'):
+        if layout not in LAYOUTS:
+            raise ImproperlyConfigured(f"Unknown VAULT_BLOB_LAYOUT {layout!r}.")
+        self.backend = backend
+        self.layout = LAYOUTS[layout]
+        # Where files written under the other layouts would be
+        self.legacy_layouts = [function for name, function in LAYOUTS.items() if name != layout]
+
+    @property
+    def supports_accel(self):
+        return self.backend.supports_accel
+
+    def path(self, namespace, content_hash):
+        """Path a file is written to under the current layout."""
+        return self.layout(namespace, content_hash)
+
+    def legacy_paths(self, namespace, content_hash):
+        return [layout(namespace, content_hash) for layout in self.legacy_layouts]
+
+    def locate(self, namespace, content_hash):
+        """Path the file is actually at (current layout first), or None."""
+        for path in [self.path(namespace, content_hash), *self.legacy_paths(namespace, content_hash)]:
+            if self.backend.exists(path):
+                return path
+        return None
+
+    def exists(self, namespace, content_hash):
+        return self.locate(namespace, content_hash) is not None
+
+    def open(self, namespace, content_hash):
+        """Opens a stored file for reading. Raises FileNotFoundError if missing."""
+        paths = [self.path(namespace, content_hash), *self.legacy_paths(namespace, content_hash)]
+        # The current path is tried again last: a migration may have moved
+        # the file there while the legacy paths were being tried
+        for path in [*paths, paths[0]]:
+            try:
+                return self.backend.open(path)
+            except FileNotFoundError:
+                continue
+        raise FileNotFoundError(errno.ENOENT, "Not in the blob store", self.path(namespace, content_hash))
+
+    def iter_stored(self, namespace):
+        """
+        Yields (content_hash, path) for every stored file in namespace, under
+        any layout, in storage listing order. Files at paths no layout would
+        produce are yielded with content_hash None.
+        """
+        for path in self.backend.iter_paths(namespace):
+            name = path.rsplit('/', 1)[-1]
+            if HASH_RE.fullmatch(name) and path in (self.path(namespace, name), *self.legacy_paths(namespace, name)):
+                yield name, path
+            else:
+                yield None, path
+
+    def save_file(self, namespace, content_hash, temp_path, replace=False):
+        """
+        Stores a fully written temp file, or drops it if the content is
+        already stored (under any layout). Returns True if it was stored.
+        With replace, a file already stored is overwritten instead, e.g. one
+        that turned out not to hold the content its name says.
+        """
+        if replace:
+            for path in self.legacy_paths(namespace, content_hash):
+                self.backend.delete(path)
+        elif any(self.backend.exists(path) for path in self.legacy_paths(namespace, content_hash)):
+            os.remove(temp_path)
+            return False
+        return self.backend.save_file(temp_path, self.path(namespace, content_hash), replace=replace)
+
+    def delete(self, namespace, content_hash):
+        """Deletes a stored file under every layout. No-op if it is missing."""
+        for path in [self.path(namespace, content_hash), *self.legacy_paths(namespace, content_hash)]:
+            self.backend.delete(path)
+
+    def relocate(self, namespace, content_hash):
+        """
+        Moves a file stored under a legacy layout to its current path.
+        Returns 'moved', 'in place' or 'missing'. Callers must hold the
+        Blob / Chunk row lock, so the file cannot be deleted meanwhile.
+        """
+        current = self.path(namespace, content_hash)
+        if self.backend.exists(current):
+            for path in self.legacy_paths(namespace, content_hash):
+                self.backend.delete(path) # Leftover copy
+            return 'in place'
+        for path in self.legacy_paths(namespace, content_hash):
+            if self.backend.exists(path):
+                self.backend.move(path, current)
+                return 'moved'
+        return 'missing'
+
+
+@functools.cache
+def get_blob_store(cached=True):
+    """
+    The BlobStore configured in settings (built once per process). Its reads
+    go through the blob cache if one is configured, unless cached=False
+    (for reads that must see primary storage, or would only flood the cache).
+    """
+    backend_name = settings.VAULT_BLOB_BACKEND
+    if backend_name == 'local':
+        backend = LocalBackend(settings.MEDIA_ROOT)
+    elif backend_name == 's3':
+        backend = S3Backend(
+            bucket=settings.VAULT_S3_BUCKET,
+            prefix=settings.VAULT_S3_PREFIX,
+            endpoint_url=settings.VAULT_S3_ENDPOINT_URL,
+            region_name=settings.VAULT_S3_REGION,
+        )
+    else:
+        raise ImproperlyConfigured(f"Unknown VAULT_BLOB_BACKEND {backend_name!r}.")
+    if cached and settings.VAULT_BLOB_CACHE_DIR:
+        from .blobcache import CachedBackend
+        backend = CachedBackend(backend, get_blob_cache())
+    return BlobStore(backend, settings.VAULT_BLOB_LAYOUT)
+
+
+@functools.cache
+def get_blob_cache():
+    """The local blob cache (VAULT_BLOB_CACHE_DIR), shared by both stores of the process."""
+    from .blobcache import BlobCache
+    return BlobCache(
+        settings.VAULT_BLOB_CACHE_DIR,
+        max_bytes=settings.VAULT_BLOB_CACHE_MAX_BYTES,
+        max_file_size=settings.VAULT_BLOB_CACHE_MAX_FILE_SIZE,
+    )
+
+
+@receiver(setting_changed)
+def _reset_blob_store(setting, **kwargs):
+    if setting.startswith('VAULT_BLOB_') or setting.startswith('VAULT_S3_') or setting == 'MEDIA_ROOT':
+        get_blob_store.cache_clear()
+        get_blob_cache.cache_clear()
@@ -0,0 +1,122 @@
+# vault/changes.py
+"""
+Change log for incremental sync: every file created, updated (e.g. its
+sniffed type, vault/jobs.py) or deleted is recorded as a FileChange row in
+the transaction that changes it, and
+GET /api/vault/files/changes/?since=<cursor> returns only what changed after
+the cursor. Syncing a user with a million files and three changes reads
+three log rows.
+
+Ordering: each row carries its owner's StorageUsage.version after the
+change. The version is bumped with an UPDATE (vault/usage.py), so the
+owner's row stays locked until the transaction commits and versions commit
+strictly in order. A reader that sees version N therefore also sees every
+change up to N, and a cursor never skips a change that commits later. Rows
+of one transaction share a version and become visible together, the ID
+only orders them for paging.
+
+The cursor is opaque to clients: (version, id) of the last change returned,
+or just the version once everything up to it was returned.
+"""
+import base64
+import time
+
+from django.conf import settings
+from django.db.models import Q
+
+from .listcache import get_files_version
+from .models import FileChange, StorageUsage
+
+# Changes returned per request, by default and at most
+PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+
+def log_changes(owner_id, instances, action):
+    """
+    Records that the owner's FileMetadata instances were created, updated or
+    deleted (FileChange.CREATED / UPDATED / DELETED). Call in the same transaction, right
+    after the owner's version was bumped.
+    """
+    # The version row is locked by this transaction, so this is our version
+    version = StorageUsage.objects.filter(pk=owner_id).values_list('version', flat=True).get()
+    FileChange.objects.bulk_create([
+        FileChange(owner_id=owner_id, version=version, file_id=instance.pk, action=action)
+        for instance in instances
+    ])
+
+
+def encode_cursor(version, last_id=None):
+    raw = str(version) if last_id is None else f"{version}|{last_id}"
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(encoded):
+    """Returns (version, last_id or None). Raises ValueError if the cursor is invalid."""
+    try:
+        raw = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
+    version, _, last_id = raw.partition('|')
+    return int(version), int(last_id) if last_id else None
+
+
+def get_changes(user, cursor, limit=PAGE_SIZE):
+    """
+    The user's changes after cursor (None for "from now on"), oldest first.
+    Returns (list of FileChange, next cursor, whether more changes follow).
+    """
+    # Read the version before the log, like vault/listcache.py: every change
+    # up to it is visible to the query below.
+    version = get_files_version(user)
+    if cursor is None:
+        # First call of a new client: nothing to send, just where to start
+        return [], encode_cursor(version), False
+
+    since_version, since_id = cursor
+    after = Q(version__gt=since_version)
+    if since_id is not None:
+        after |= Q(version=since_version, id__gt=since_id)
+    changes = list(
+        FileChange.objects.filter(after, owner=user)
+        .order_by('version', 'id')[:limit + 1]
+    )
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    if has_more:
+        # Stopped in the middle of a version, the next page resumes after this row
+        next_cursor = encode_cursor(changes[-1].version, changes[-1].id)
+    elif changes:
+        # Everything committed is returned, including the last version in full
+        next_cursor = encode_cursor(max(changes[-1].version, version))
+    elif version >= since_version:
+        # Versions can move without log rows (vault_reconcile_usage)
+        next_cursor = encode_cursor(version)
+    else:
+        next_cursor = encode_cursor(since_version, since_id)
+    return changes, next_cursor, has_more
+
+
+def parse_wait(value):
+    """Seconds a long-poll may wait, from the 'wait' parameter, capped by VAULT_CHANGES_MAX_WAIT."""
+    if not value:
+        return 0
+    wait = float(value) # ValueError for the view to report
+    if wait != wait or wait < 0: # NaN or negative
+        raise ValueError("Invalid wait")
+    return min(wait, settings.VAULT_CHANGES_MAX_WAIT)
+
+
+def wait_for_changes(user, since_version, timeout):
+    """
+    Blocks until the user's version moves past since_version or timeout
+    seconds passed, checking every VAULT_CHANGES_POLL_INTERVAL seconds.
+    Under ASGI the async view waits without a thread instead (vault/async_views.py).
+    """
+    deadline = time.monotonic() + timeout
+    while (remaining := deadline - time.monotonic()) > 0:
+        time.sleep(min(settings.VAULT_CHANGES_POLL_INTERVAL, remaining))
+        if get_files_version(user) > since_version:
+            return True
+    return False
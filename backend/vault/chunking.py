@@ -0,0 +1,103 @@
+# vault/chunking.py
+"""
+Content-defined chunking with FastCDC (Xia et al., USENIX ATC 2016).
+
+A rolling "gear" hash is computed over the data and a chunk ends wherever
+the hash matches a mask, so boundaries depend on the content around them
+rather than on absolute offsets: inserting a few bytes into a large file
+only changes the one or two chunks around the edit, and every other chunk
+keeps its hash and is deduplicated against the previous version.
+
+Normalized chunking uses a stricter mask before the average size and a
+looser one after it, which keeps chunk sizes close to the average.
+"""
+import hashlib
+
+# The gear table and masks determine every chunk boundary. Changing them
+# changes the chunks of new uploads, so existing chunks would no longer be
+# matched: treat them as part of the storage format.
+GEAR = [
+    int.from_bytes(hashlib.sha256(bytes([value])).digest()[:4], 'big')
+    for value in range(256)
+]
+_HASH_MASK = 0xFFFFFFFF # 32-bit rolling hash
+
+
+def _mask(bits):
+    """A mask of the highest bits of the 32-bit hash. Bit k of the gear hash
+    depends on the last k + 1 bytes, so high bits see the widest window."""
+    return ((1 << bits) - 1) << (32 - bits)
+
+
+class FastCDC:
+    """
+    Splits byte streams into content-defined chunks of min_size..max_size
+    bytes, avg_size on average (must be a power of two).
+    """
+
+    def __init__(self, min_size, avg_size, max_size):
+        if not (0 < min_size <= avg_size <= max_size):
+            raise ValueError("Chunk sizes must satisfy 0 < min <= avg <= max.")
+        bits = avg_size.bit_length() - 1
+        if 1 << bits != avg_size:
+            raise ValueError("Average chunk size must be a power of two.")
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        # Normalization level 2: two bits harder before avg, two easier after
+        self.mask_strict = _mask(bits + 2)
+        self.mask_loose = _mask(bits - 2)
+
+    def cut_point(self, data, start, end):
+        """Length of the chunk starting at data[start], with data[start:end] available."""
+        length = end - start
+        if length <= self.min_size:
+            return length
+        if length > self.max_size:
+            length = self.max_size
+        normal = min(self.avg_size, length)
+
+        gear = GEAR
+        fingerprint = 0
+        position = start + self.min_size # The first min_size bytes can never end a chunk
+        mask = self.mask_strict
+        normal_end = start + normal
+        while position < normal_end:
+            fingerprint = ((fingerprint << 1) + gear[data[position]]) & _HASH_MASK
+            if not fingerprint & mask:
+                return position - start + 1
+            position += 1
+        mask = self.mask_loose
+        hard_end = start + length
+        while position < hard_end:
+            fingerprint = ((fingerprint << 1) + gear[data[position]]) & _HASH_MASK
+            if not fingerprint & mask:
+                return position - start + 1
+            position += 1
+        return length
+
+    def iter_chunks(self, stream, read_size=4 * 1024 * 1024):
+        """
+        Yields (offset, data) for each chunk of a binary stream. At most
+        read_size + max_size bytes are buffered at any time.
+        """
+        buffer = bytearray()
+        start = 0      # Start of the next chunk within buffer
+        offset = 0     # Its offset within the stream
+        eof = False
+        while True:
+            if not eof and len(buffer) - start < self.max_size:
+                # Compact, then refill so a full max_size chunk is always visible
+                del buffer[:start]
+                start = 0
+                block = stream.read(read_size)
+                if block:
+                    buffer += block
+                    continue
+                eof = True
+            if start >= len(buffer):
+                return
+            length = self.cut_point(buffer, start, len(buffer))
+            yield offset, bytes(buffer[start:start + length])
+            start += length
+            offset += length
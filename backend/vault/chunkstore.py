@@ -0,0 +1,168 @@
+# vault/chunkstore.py
+"""
+The chunk store: blob content split with content-defined chunking
+(vault/chunking.py), each unique chunk kept once in the blob store's
+'chunks' namespace, and a manifest per blob (BlobChunk rows) listing its
+chunks by offset.
+
+This module reads and splits content. Chunk reference counts are kept by
+vault/services.py together with the blob reference counts.
+"""
+import bisect
+import hashlib
+import io
+import os
+import struct
+
+from django.conf import settings
+
+from .blobstore import CHUNKS, get_blob_store
+from .chunking import FastCDC
+from .dbslots import streaming_query
+from .models import BlobChunk
+from .storage import create_temp_file
+
+# Manifest entries fetched per query while reading a chunked blob
+MANIFEST_PAGE_SIZE = 256
+
+# One record of a manifest file (write_manifest): offset, size, raw SHA-256
+MANIFEST_RECORD = struct.Struct('>QI32s')
+
+
+def should_chunk(size):
+    """True if new content of this size goes to the chunk store."""
+    return (
+        settings.VAULT_STORAGE_ENGINE == 'chunks'
+        and size >= settings.VAULT_CHUNKING_MIN_FILE_SIZE
+    )
+
+
+def get_chunker():
+    return FastCDC(
+        settings.VAULT_CHUNK_MIN_SIZE,
+        settings.VAULT_CHUNK_AVG_SIZE,
+        settings.VAULT_CHUNK_MAX_SIZE,
+    )
+
+
+def write_manifest(path):
+    """
+    Splits the file at path into chunks without storing anything, and writes
+    the manifest to a new temp file, one fixed-size record per chunk in file
+    order, so memory use does not grow with the file. Returns the temp file's
+    path; the caller owns it. Read it back with read_manifest().
+    """
+    with open(path, 'rb') as file_handle, create_temp_file(suffix='.manifest') as manifest:
+        try:
+            for offset, data in get_chunker().iter_chunks(file_handle):
+                manifest.write(MANIFEST_RECORD.pack(offset, len(data), hashlib.sha256(data).digest()))
+        except BaseException:
+            manifest.close()
+            os.remove(manifest.name)
+            raise
+    return manifest.name
+
+
+def read_manifest(manifest_path):
+    """Yields (offset, size, chunk_hash) from a manifest file written by write_manifest()."""
+    with open(manifest_path, 'rb') as manifest:
+        while record := manifest.read(MANIFEST_RECORD.size):
+            offset, size, digest = MANIFEST_RECORD.unpack(record)
+            yield offset, size, digest.hex()
+
+
+class ChunkedBlobReader(io.RawIOBase):
+    """
+    Read-only, seekable file object over a chunked blob. The manifest is
+    fetched a page at a time and one chunk is held in memory, so reading a
+    blob of any size (or seeking into it for a Range request) uses bounded
+    memory. read() returns at most the rest of the current chunk.
+    """
+
+    def __init__(self, blob):
+        super().__init__()
+        self.blob_hash = blob.hash
+        self.size = blob.size
+        self._position = 0
+        self._page = []       # [(offset, chunk_hash)] of consecutive manifest entries
+        self._page_end = None # Offset where the chunk after the page starts
+        self._chunk_offset = None
+        self._chunk_data = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def readinto(self, buffer):
+        if self._position >= self.size:
+            return 0
+        if not self._chunk_covers(self._position):
+            self._load_chunk(self._position)
+        start = self._position - self._chunk_offset
+        length = min(len(buffer), len(self._chunk_data) - start)
+        buffer[:length] = self._chunk_data[start:start + length]
+        self._position += length
+        return length
+
+    def _chunk_covers(self, position):
+        return (
+            self._chunk_offset is not None
+            and self._chunk_offset <= position < self._chunk_offset + len(self._chunk_data)
+        )
+
+    def _load_chunk(self, position):
+        """Reads the chunk containing position into memory."""
+        if not self._page or not (self._page[0][0] <= position < self._page_end):
+            self._load_page(position)
+        index = bisect.bisect_right(self._page, position, key=lambda entry: entry[0]) - 1
+        offset, chunk_hash = self._page[index]
+        end = self._page[index + 1][0] if index + 1 < len(self._page) else self._page_end
+
+        with get_blob_store().open(CHUNKS, chunk_hash) as chunk_file:
+            data = chunk_file.read()
+        if len(data) != end - offset:
+            raise OSError(
+                f"Chunk {chunk_hash} of blob {self.blob_hash} has {len(data)} bytes, "
+                f"expected {end - offset}"
+            )
+        self._chunk_offset, self._chunk_data = offset, data
+
+    def _load_page(self, position):
+        """Fetches the manifest entries from the chunk containing position on."""
+        manifest = BlobChunk.objects.filter(blob_id=self.blob_hash)
+        # Usually called while a download streams (see vault/dbslots.py)
+        with streaming_query():
+            start = (
+                manifest.filter(offset__lte=position).order_by('-offset')
+                .values_list('offset', flat=True).first()
+            )
+            if start is None:
+                raise OSError(f"Manifest of blob {self.blob_hash} has no chunk at offset {position}")
+            page = list(
+                manifest.filter(offset__gte=start).order_by('offset')
+                .values_list('offset', 'chunk_id')[:MANIFEST_PAGE_SIZE + 1]
+            )
+        if len(page) > MANIFEST_PAGE_SIZE:
+            # The extra entry only tells where the page's last chunk ends
+            self._page, self._page_end = page[:-1], page[-1][0]
+        else:
+            self._page, self._page_end = page, self.size
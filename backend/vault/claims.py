@@ -0,0 +1,91 @@
+# vault/claims.py
+"""
+Proof of possession for hash-first uploads (the files/claim/ endpoint).
+
+Knowing a file's SHA-256 and size is not the same as having the file:
+hashes get published, logged and shared. If they were enough to claim
+stored content, anyone holding a hash could add another user's file to
+their own vault and download it, or at least find out that somebody
+stores it. So a claim only skips the upload when:
+
+  - the caller already owns a file with that content (nothing new is
+    revealed to them), or
+  - the caller proves it holds the bytes: the server picks random byte
+    ranges of the file and the client answers with the SHA-256 of each.
+
+The challenge is a signed token (django.core.signing) carrying the ranges,
+bound to the user, hash and size and valid for VAULT_CLAIM_CHALLENGE_TTL
+seconds, so the server keeps no state between the two requests. It is
+handed out whether or not the vault stores the content, and a wrong or
+unverifiable proof gets the same "upload required" answer as missing
+content, so neither step tells a client without the bytes anything.
+"""
+import hashlib
+import hmac
+import secrets
+
+from django.conf import settings
+from django.core import signing
+
+from .services import open_blob
+
+SALT = 'vault.claims'
+# Ranges per challenge, and the most bytes in each
+PROOF_RANGES = 3
+PROOF_RANGE_SIZE = 64 * 1024 # 64 KB
+
+
+def make_challenge(user_id, file_hash, size):
+    """
+    A fresh challenge for a claim: {'challenge': token, 'ranges': [[start, end], ...]},
+    end exclusive. Empty files get no ranges, their content is no secret.
+    """
+    length = min(PROOF_RANGE_SIZE, size)
+    ranges = []
+    if length:
+        for _ in range(PROOF_RANGES):
+            start = secrets.randbelow(size - length + 1)
+            ranges.append([start, start + length])
+    token = signing.dumps({'u': user_id, 'h': file_hash, 's': size, 'r': ranges}, salt=SALT, compress=True)
+    return {'challenge': token, 'ranges': ranges}
+
+
+def challenge_ranges(token, user_id, file_hash, size):
+    """
+    The ranges of a challenge issued to this user for this hash and size,
+    or None if the token is invalid, expired or was issued for another claim.
+    """
+    try:
+        data = signing.loads(token, salt=SALT, max_age=settings.VAULT_CLAIM_CHALLENGE_TTL)
+    except signing.BadSignature: # Includes SignatureExpired
+        return None
+    if data.get('u') != user_id or data.get('h') != file_hash or data.get('s') != size:
+        return None
+    return data['r']
+
+
+def _read_range(stream, start, end):
+    stream.seek(start)
+    data = b''
+    while len(data) < end - start:
+        block = stream.read(end - start - len(data))
+        if not block:
+            break
+        data += block
+    return data
+
+
+def verify_proofs(blob, ranges, proofs):
+    """
+    True if proofs (hex SHA-256s) match the blob's content in ranges.
+    Raises OSError if the content cannot be read.
+    """
+    if len(proofs) != len(ranges):
+        return False
+    matches = True
+    with open_blob(blob) as stream:
+        for (start, end), proof in zip(ranges, proofs):
+            digest = hashlib.sha256(_read_range(stream, start, end)).hexdigest()
+            # Every range is checked, and in constant time
+            matches &= hmac.compare_digest(digest, proof)
+    return matches
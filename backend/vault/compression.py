@@ -0,0 +1,244 @@
+# vault/compression.py
+"""
+Optional compression of stored blobs (VAULT_COMPRESSION).
+
+New content is compressed after deduplication, streaming from its temp file
+into a second temp file, so only content new to the vault is compressed and
+memory use does not depend on the file size. The SHA-256 (the dedup key)
+is always that of the original content. Blob.codec records how a blob is
+stored and Blob.stored_size how many bytes it takes up.
+
+Each codec produces a standard stream (gzip member, Zstandard frame), which
+downloads can send as is with a matching Content-Encoding.
+"""
+import gzip
+import io
+import math
+import os
+import shutil
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .storage import create_temp_file
+
+# Content that is already compressed gains nothing from compressing it again
+COMPRESSED_CONTENT_TYPE_PREFIXES = ('image/', 'video/', 'audio/')
+COMPRESSED_CONTENT_TYPES = {
+    'application/zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/x-7z-compressed',
+    'application/x-rar-compressed',
+    'application/vnd.rar',
+    'application/x-bzip2',
+    'application/x-xz',
+    'application/zstd',
+    'application/pdf',
+    'application/epub+zip',
+    'application/java-archive',
+    # Office Open XML and OpenDocument files are ZIP containers
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    'application/vnd.oasis.opendocument.text',
+    'application/vnd.oasis.opendocument.spreadsheet',
+    'application/vnd.oasis.opendocument.presentation',
+}
+# Exceptions to the prefixes above: uncompressed media formats
+UNCOMPRESSED_MEDIA_TYPES = {'image/bmp', 'image/svg+xml', 'image/tiff', 'audio/wav', 'audio/x-wav'}
+
+# Bytes sampled (from the start and the middle of the file) to estimate entropy
+ENTROPY_SAMPLE_SIZE = 64 * 1024
+# Above this many bits per byte the content is treated as incompressible.
+# Text, CSV and JSON sit around 4-6, compressed or encrypted data near 8.
+ENTROPY_THRESHOLD = 7.5
+# Compressed output must be at most this fraction of the original to be kept
+MAX_COMPRESSED_RATIO = 0.9
+
+# Bytes read per iteration while compressing
+COPY_BLOCK_SIZE = 1024 * 1024 # 1 MB
+
+
+def is_compressed_content_type(content_type):
+    """True if content of this MIME type is normally already compressed."""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in UNCOMPRESSED_MEDIA_TYPES:
+        return False
+    return content_type in COMPRESSED_CONTENT_TYPES or content_type.startswith(COMPRESSED_CONTENT_TYPE_PREFIXES)
+
+
+def byte_entropy(data):
+    """Shannon entropy of data in bits per byte (0.0 to 8.0)."""
+    if not data:
+        return 0.0
+    total = len(data)
+    counts = [data.count(value) for value in set(data)]
+    return -sum(count / total * math.log2(count / total) for count in counts)
+
+
+def _sample(path, size):
+    with open(path, 'rb') as file_handle:
+        sample = file_handle.read(ENTROPY_SAMPLE_SIZE)
+        if size > 2 * ENTROPY_SAMPLE_SIZE:
+            file_handle.seek(size // 2)
+            sample += file_handle.read(ENTROPY_SAMPLE_SIZE)
+    return sample
+
+
+# --- Codecs ---
+
+class GzipCodec:
+    name = 'gzip'
+
+    def compress(self, source, destination):
+        level = settings.VAULT_COMPRESSION_LEVEL
+        # mtime=0 keeps the output identical for identical content
+        with gzip.GzipFile(
+            fileobj=destination, mode='wb', mtime=0,
+            compresslevel=6 if level is None else level,
+        ) as compressed:
+            shutil.copyfileobj(source, compressed, COPY_BLOCK_SIZE)
+
+    def decompressing_reader(self, file_handle):
+        return gzip.GzipFile(fileobj=file_handle, mode='rb')
+
+
+class ZstdCodec:
+    name = 'zstd'
+
+    def __init__(self):
+        try:
+            import zstandard # Optional dependency, only needed for this codec
+        except ImportError:
+            raise ImproperlyConfigured(
+                "VAULT_COMPRESSION = 'zstd' requires the 'zstandard' package."
+            )
+        self.zstandard = zstandard
+
+    def compress(self, source, destination):
+        level = settings.VAULT_COMPRESSION_LEVEL
+        compressor = self.zstandard.ZstdCompressor(level=3 if level is None else level)
+        compressor.copy_stream(source, destination, read_size=COPY_BLOCK_SIZE)
+
+    def decompressing_reader(self, file_handle):
+        return self.zstandard.ZstdDecompressor().stream_reader(file_handle)
+
+
+CODECS = {'gzip': GzipCodec, 'zstd': ZstdCodec}
+# First bytes of every stream each codec writes
+CODEC_MAGIC = {'gzip': b'\x1f\x8b', 'zstd': b'\x28\xb5\x2f\xfd'}
+
+
+def get_codec(name):
+    """Returns the codec called name (a Blob.codec value)."""
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ImproperlyConfigured(f"Unknown compression codec {name!r}.")
+
+
+def choose_codec(content_type, path, size):
+    """
+    Returns the name of the codec new content should be stored with, or ''
+    to store it as is: compression is off, the content is small, its type
+    is already compressed, or a sample of it looks incompressible.
+    """
+    codec = settings.VAULT_COMPRESSION
+    if codec in ('', 'off'):
+        return ''
+    if size < settings.VAULT_COMPRESSION_MIN_SIZE or is_compressed_content_type(content_type):
+        return ''
+    if byte_entropy(_sample(path, size)) > ENTROPY_THRESHOLD:
+        return ''
+    return codec
+
+
+def compress_file(path, codec_name):
+    """
+    Compresses the file at path into a new temp file, block by block.
+    Returns the temp file's path; the caller owns it.
+    """
+    codec = get_codec(codec_name)
+    with open(path, 'rb') as source, create_temp_file(suffix=f'.{codec_name}') as destination:
+        try:
+            codec.compress(source, destination)
+        except BaseException:
+            destination.close()
+            os.remove(destination.name)
+            raise
+    return destination.name
+
+
+class DecompressingReader(io.RawIOBase):
+    """
+    Read-only file object over a compressed blob, decompressing as it is
+    read. Seeking is lazy and forward seeks decompress and discard the bytes
+    in between; a backward seek starts over from the beginning. That keeps
+    Range requests working, at a cost proportional to the offset.
+    """
+
+    def __init__(self, open_stored, codec_name, size):
+        super().__init__()
+        self._open_stored = open_stored # Callable returning the stored file, opened
+        self._codec = get_codec(codec_name)
+        self.size = size
+        self._position = 0   # Position requested by the caller
+        self._stored = None
+        self._stream = None
+        self._stream_position = 0 # Position of the decompressed stream
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return position
+
+    def readinto(self, buffer):
+        if self._position >= self.size:
+            return 0
+        if self._stream is None or self._stream_position > self._position:
+            self._reopen()
+        while self._stream_position < self._position:
+            skipped = self._stream.read(min(COPY_BLOCK_SIZE, self._position - self._stream_position))
+            if not skipped:
+                return 0
+            self._stream_position += len(skipped)
+        data = self._stream.read(len(buffer))
+        buffer[:len(data)] = data
+        self._stream_position += len(data)
+        self._position += len(data)
+        return len(data)
+
+    def _reopen(self):
+        self._close_stream()
+        self._stored = self._open_stored()
+        self._stream = self._codec.decompressing_reader(self._stored)
+        self._stream_position = 0
+
+    def _close_stream(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stored.close()
+            self._stream = self._stored = None
+
+    def close(self):
+        self._close_stream()
+        super().close()
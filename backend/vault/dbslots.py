@@ -0,0 +1,34 @@
+# vault/dbslots.py
+"""
+Database queries made while a response streams.
+
+Under ASGI (vault/async_views.py) a request only uses the database while it
+holds one of the process's VAULT_ASYNC_DB_CONNECTIONS slots, and its
+connection is closed before the response starts streaming. Code that queries
+from inside a streaming response (chunk manifest pages, archive rows) wraps
+each query in streaming_query(), which then waits for a slot and closes the
+connection again before giving the slot back. Anywhere else, e.g. under WSGI,
+it does nothing.
+"""
+import contextvars
+from contextlib import contextmanager, nullcontext
+
+# Context manager factory set by async_views while it reads a block of a
+# streaming response, None otherwise
+_stream_slot = contextvars.ContextVar('vault_stream_slot', default=None)
+
+
+def streaming_query():
+    """Context manager to hold around each query a streaming response makes."""
+    slot = _stream_slot.get()
+    return slot() if slot is not None else nullcontext()
+
+
+@contextmanager
+def stream_slot(slot):
+    """Makes streaming_query() use slot (a context manager factory) inside the block."""
+    token = _stream_slot.set(slot)
+    try:
+        yield
+    finally:
+        _stream_slot.reset(token)
@@ -0,0 +1,274 @@
+# vault/downloads.py
+"""
+HTTP helpers for serving blobs: strong ETags, conditional GET, byte ranges,
+Content-Encoding pass-through of compressed blobs and the nginx
+X-Accel-Redirect hand-off.
+Blobs are content-addressed by their SHA-256, so a blob never changes and its
+hash is a perfect strong validator.
+"""
+import re
+import uuid
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import content_disposition_header
+
+# Blobs never change, so clients may cache them for as long as they like.
+# 'private' because every download is behind per-user authentication.
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+# Upper bound on ranges honoured in one request. Past this, the Range header
+# is ignored and the whole file is sent (allowed by RFC 9110, section 14.2).
+MAX_RANGES = 16
+
+# Bytes read from storage per iteration when streaming partial content
+STREAM_BLOCK_SIZE = 256 * 1024 # 256 KB
+
+_RANGE_SPEC_RE = re.compile(r'^(\d*)-(\d*)$')
+
+# A media type as sent in Content-Type (RFC 9110, section 8.3.1): type/subtype
+# and optional parameters, printable ASCII only. Anything else (a CR or LF in
+# particular) cannot be put in a response header.
+_MEDIA_TYPE_RE = re.compile(
+    r"[!#$%&'*+.^_`|~0-9A-Za-z-]+/[!#$%&'*+.^_`|~0-9A-Za-z-]+(?: *;[ -~]*)?"
+)
+
+
+def is_valid_media_type(value):
+    """True if value can be sent as a Content-Type header."""
+    return bool(_MEDIA_TYPE_RE.fullmatch(value))
+
+
+def _media_type(content_type):
+    """The stored content type to send, application/octet-stream if it is unusable."""
+    return content_type if content_type and is_valid_media_type(content_type) else 'application/octet-stream'
+
+
+def make_etag(file_hash, content_encoding=None):
+    """
+    Strong ETag for a blob. Each content coding of a blob is a different
+    representation (different bytes), so it gets a tag of its own.
+    """
+    if content_encoding:
+        return f'"{file_hash}+{content_encoding}"'
+    return f'"{file_hash}"'
+
+
+def accepts_encoding(header_value, coding):
+    """
+    True if an Accept-Encoding header allows the content coding: listed with
+    a q-value above 0, or covered by '*' and not refused by name
+    (RFC 9110, section 12.5.3).
+    """
+    if not header_value:
+        return False
+    qualities = {}
+    for item in header_value.split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name.strip():
+            qualities[name.strip().lower()] = quality
+    if coding in qualities:
+        return qualities[coding] > 0
+    return qualities.get('*', 0) > 0
+
+
+def etag_matches(header_value, etag):
+    """
+    Checks an If-None-Match style header (a list of ETags or '*') against etag.
+    Uses weak comparison, as RFC 9110 requires for If-None-Match.
+    """
+    if not header_value:
+        return False
+    if header_value.strip() == '*':
+        return True
+    candidates = [value.strip() for value in header_value.split(',')]
+    return any(candidate.removeprefix('W/') == etag for candidate in candidates)
+
+
+def parse_range_header(header_value, size):
+    """
+    Parses a 'Range: bytes=...' header against a representation of size bytes.
+
+    Returns None if the header is absent, malformed or should be ignored
+    (the full content is sent), an empty list if no range is satisfiable
+    (416), or a sorted list of merged, inclusive (start, end) tuples.
+    """
+    if not header_value:
+        return None
+    unit, _, range_set = header_value.partition('=')
+    if unit.strip().lower() != 'bytes' or not range_set:
+        return None
+
+    ranges = []
+    specs = range_set.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    for spec in specs:
+        match = _RANGE_SPEC_RE.match(spec.strip())
+        if not match:
+            return None # Syntactically invalid: ignore the whole header
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+        elif last:
+            # Suffix range: the final N bytes
+            start = max(size - int(last), 0)
+            end = size - 1
+        else:
+            return None
+        if start >= size or (not first and not int(last)):
+            continue # Unsatisfiable on its own, other ranges may still apply
+        ranges.append((start, min(end, size - 1)))
+
+    # Merge overlapping or adjacent ranges so no byte is sent twice
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _iter_range(file_handle, start, end):
+    """Yields bytes start..end (inclusive) of file_handle in bounded blocks."""
+    file_handle.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        block = file_handle.read(min(STREAM_BLOCK_SIZE, remaining))
+        if not block:
+            break
+        remaining -= len(block)
+        yield block
+
+
+def _iter_multipart(file_handle, ranges, size, content_type, boundary):
+    """Yields a multipart/byteranges body for the given ranges."""
+    try:
+        for start, end in ranges:
+            yield _part_header(boundary, content_type, start, end, size)
+            yield from _iter_range(file_handle, start, end)
+            yield b'\r\n'
+        yield f'--{boundary}--\r\n'.encode('ascii')
+    finally:
+        file_handle.close()
+
+
+def _iter_single(file_handle, start, end):
+    try:
+        yield from _iter_range(file_handle, start, end)
+    finally:
+        file_handle.close()
+
+
+def _part_header(boundary, content_type, start, end, size):
+    return (
+        f'--{boundary}\r\n'
+        f'Content-Type: {content_type}\r\n'
+        f'Content-Range: bytes {start}-{end}/{size}\r\n'
+        f'\r\n'
+    ).encode('ascii')
+
+
+def _set_common_headers(response, etag, filename):
+    response['ETag'] = etag
+    response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    response['Accept-Ranges'] = 'bytes'
+    if filename is not None:
+        response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
+
+
+def not_modified_response(request, file_hash, content_encoding=None):
+    """
+    Returns a 304 response if the request's If-None-Match matches the blob
+    (in the content coding that would be sent), otherwise None. Lets callers
+    skip opening storage for cached clients.
+    """
+    etag = make_etag(file_hash, content_encoding)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return _set_common_headers(HttpResponseNotModified(), etag, None)
+    return None
+
+
+def blob_response(request, file_handle, size, file_hash, filename, content_type):
+    """
+    Builds the response for a blob download, honouring Range and If-Range.
+    Takes ownership of file_handle (it is closed when the response is done).
+    """
+    etag = make_etag(file_hash)
+    content_type = _media_type(content_type)
+
+    ranges = parse_range_header(request.headers.get('Range'), size)
+    if_range = request.headers.get('If-Range')
+    if ranges is not None and if_range is not None and if_range.strip() != etag:
+        ranges = None # Client's copy is a different version: send everything
+
+    if ranges is None:
+        response = FileResponse(file_handle, content_type=content_type)
+        response['Content-Length'] = str(size)
+        return _set_common_headers(response, etag, filename)
+
+    if not ranges:
+        file_handle.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return _set_common_headers(response, etag, None)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(
+            _iter_single(file_handle, start, end), status=206, content_type=content_type
+        )
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+        return _set_common_headers(response, etag, filename)
+
+    boundary = uuid.uuid4().hex
+    content_length = len(f'--{boundary}--\r\n')
+    for start, end in ranges:
+        content_length += len(_part_header(boundary, content_type, start, end, size))
+        content_length += (end - start + 1) + len(b'\r\n')
+    response = StreamingHttpResponse(
+        _iter_multipart(file_handle, ranges, size, content_type, boundary),
+        status=206,
+        content_type=f'multipart/byteranges; boundary={boundary}',
+    )
+    response['Content-Length'] = str(content_length)
+    return _set_common_headers(response, etag, filename)
+
+
+def encoded_blob_response(file_handle, stored_size, file_hash, content_encoding, filename, content_type):
+    """
+    Sends a compressed blob file as stored, labelled with its Content-Encoding,
+    to a client that accepts that coding: no decompression on the server and
+    fewer bytes on the wire. Takes ownership of file_handle.
+    """
+    response = FileResponse(file_handle, content_type=_media_type(content_type))
+    response['Content-Length'] = str(stored_size)
+    response['Content-Encoding'] = content_encoding
+    return _set_common_headers(response, make_etag(file_hash, content_encoding), filename)
+
+
+def accel_redirect_response(storage_path, file_hash, filename, content_type):
+    """
+    Hands the transfer over to nginx: returns an empty response whose
+    X-Accel-Redirect header points at an internal location mapped onto
+    MEDIA_ROOT (storage_path is relative to it, see vault/blobstore.py). nginx then serves the blob (including Range requests) with
+    sendfile, and the Python worker is free as soon as this returns.
+    """
+    response = HttpResponse(content_type=_media_type(content_type))
+    response['X-Accel-Redirect'] = quote(settings.VAULT_ACCEL_REDIRECT_PREFIX + storage_path)
+    return _set_common_headers(response, make_etag(file_hash), filename)
@@ -1,11 +1,31 @@
 # vault/filters.py
+import re
+
 import django_filters
+from django.core.validators import EMPTY_VALUES
+from django.db import connection
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
 from .models import FileMetadata
 
+# Filenames are split into words on whitespace and these separators,
+# matching the filename_search column (migration 0007)
+SEARCH_TERM_SPLIT_RE = re.compile(r'[\s_.\-]+')
+
+
+def search_terms(value):
+    """Lowercased words of a search string."""
+    return [term for term in SEARCH_TERM_SPLIT_RE.split(value.lower()) if term]
+
+
 class FileMetadataFilter(django_filters.FilterSet):
     """
     Defines filters for the FileMetadata model for use with the API.
-    Allows filtering by filename, content type, date range, and size range.
+    Allows filtering by filename, content type, date range, and size range,
+    plus word-based filename search.
+    On PostgreSQL the substring filters are served by pg_trgm GIN indexes and
+    the search by a GIN-indexed tsvector (see migration 0007).
     """
     # --- Define specific filters for more control ---
 
@@ -23,6 +43,11 @@ class FileMetadataFilter(django_filters.FilterSet):
         lookup_expr='icontains'
     )
 
+    # Word-based filename search: every word must match the start of a word
+    # in the filename, e.g. 'rep fin' matches 'q3_report-final.pdf'.
+    # Query params: ?search=...  (add &rank=true to order results by relevance)
+    search = django_filters.CharFilter(method='filter_search')
+
     # Allow filtering by upload date range
     # Query params: ?upload_date_after=YYYY-MM-DD&upload_date_before=YYYY-MM-DD
     upload_date = django_filters.DateFromToRangeFilter(field_name='upload_date')
@@ -39,3 +64,73 @@ class FileMetadataFilter(django_filters.FilterSet):
         fields = ['original_filename', 'content_type', 'upload_date', 'file_size']
         # Note: Filtering by 'owner' is already handled by get_queryset in the view.
 
+    @classmethod
+    def get_param_names(cls):
+        """Every parameter this filterset reads. Range filters use suffixed names."""
+        names = {'rank'}
+        for name, filter_ in cls.base_filters.items():
+            widget = filter_.field.widget
+            if hasattr(widget, 'suffixes'):
+                names.update(widget.suffixed(name, suffix) for suffix in widget.suffixes)
+            else:
+                names.add(name)
+        return names
+
+    def is_restrictive(self):
+        """
+        True if at least one filter narrows down the results. Call after
+        is_valid(). Used to refuse filter-based bulk deletes that would
+        silently match every file.
+        """
+        for name, value in self.form.cleaned_data.items():
+            if value in EMPTY_VALUES:
+                continue
+            if isinstance(value, slice) and value.start is None and value.stop is None:
+                continue # Range with neither bound
+            if name == 'search' and not search_terms(value):
+                continue
+            return True
+        return False
+
+    def filter_search(self, queryset, name, value):
+        """
+        Filters by filename words. Uses the indexed tsvector on PostgreSQL and
+        falls back to one icontains per word elsewhere (SQLite in development).
+        With rank=true (PostgreSQL only) results are annotated with search_rank,
+        which the list pagination then orders by.
+        """
+        terms = search_terms(value)
+        if not terms:
+            return queryset
+
+        if connection.vendor != 'postgresql':
+            for term in terms:
+                queryset = queryset.filter(original_filename__icontains=term)
+            return queryset
+
+        # Imported here: django.contrib.postgres requires the PostgreSQL driver
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField
+
+        # Prefix match for each word ('rep:* & fin:*'). Only word characters
+        # are kept, so user input cannot inject tsquery syntax.
+        words = [re.sub(r'\W', '', term) for term in terms]
+        raw_query = ' & '.join(f"{word}:*" for word in words if word)
+        if not raw_query:
+            return queryset.none()
+        query = SearchQuery(raw_query, config='simple', search_type='raw')
+
+        filename_search = RawSQL(
+            f'{connection.ops.quote_name(FileMetadata._meta.db_table)}.filename_search',
+            [],
+            output_field=SearchVectorField(),
+        )
+        queryset = queryset.alias(filename_search=filename_search).filter(filename_search=query)
+
+        if self.data.get('rank') in ('1', 'true', 'True'):
+            # ts_rank returns a 4-byte real. Cast to double precision so the
+            # value sent back in a pagination cursor compares exactly equal.
+            queryset = queryset.annotate(
+                search_rank=Cast(SearchRank(filename_search, query), FloatField())
+            )
+        return queryset
+
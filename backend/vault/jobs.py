@@ -0,0 +1,221 @@
+# vault/jobs.py
+"""
+Background jobs on stored content, run by 'manage.py vault_worker' outside
+the request cycle, so uploads return as soon as the blob and its metadata
+are committed.
+
+  - Queue: one BlobJob row per blob and kind (VAULT_BLOB_JOBS), inserted
+    by vault/services.py in the upload's own transaction when content gains
+    its first reference. A job is therefore queued exactly when its blob
+    becomes durable, and never for content that is already stored:
+    deduplicated uploads and later copies add nothing.
+  - Claiming: workers take due jobs with SELECT ... FOR UPDATE SKIP LOCKED,
+    so concurrent workers never wait for or take the same row, and mark
+    them running with a lease (VAULT_JOB_LEASE seconds, kept in run_after).
+    A job whose worker died is taken over once its lease runs out.
+  - Outcome: a worker only finishes a job while it still holds the claim
+    (claimed_by and attempts unchanged). A failed job is retried with
+    exponential backoff and jitter, up to VAULT_JOB_MAX_ATTEMPTS attempts;
+    then, or straight away for an unknown kind, it is marked failed.
+
+Handlers are registered with @job_handler(kind) and get the claimed BlobJob.
+A handler may run more than once for the same blob (a retry, a takeover
+after a lease ran out), so it must be idempotent. SQLite has no row locks:
+run a single worker process against it.
+"""
+import logging
+import os
+import random
+import socket
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .changes import log_changes
+from .models import Blob, BlobJob, FileChange, FileMetadata, StorageUsage
+from .sniffing import SNIFF_SIZE, sniff_content_type
+
+logger = logging.getLogger(__name__)
+
+# kind -> handler(job)
+HANDLERS = {}
+
+
+def job_handler(kind):
+    """Registers the decorated function as the handler of jobs of this kind."""
+    def register(handler):
+        HANDLERS[kind] = handler
+        return handler
+    return register
+
+
+def worker_id():
+    """Identifies this process in BlobJob.claimed_by."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# --- Queue ---
+
+def enqueue_blob_jobs(blobs):
+    """
+    Queues the VAULT_BLOB_JOBS for blobs that just gained their first
+    reference. Call in the transaction that stores them, with the Blob rows
+    locked; jobs already queued for a blob are left as they are.
+    """
+    kinds = settings.VAULT_BLOB_JOBS
+    if not kinds or not blobs:
+        return
+    BlobJob.objects.bulk_create(
+        [BlobJob(blob_id=blob.hash, kind=kind) for blob in blobs for kind in kinds],
+        ignore_conflicts=True,
+    )
+
+
+def claim_jobs(worker, limit):
+    """
+    Claims up to limit due jobs for worker (a worker_id()): pending jobs
+    whose retry time has come, and running jobs whose lease ran out.
+    Returns them, marked running.
+    """
+    now = timezone.now()
+    lease_until = now + timedelta(seconds=settings.VAULT_JOB_LEASE)
+    with transaction.atomic():
+        ids = list(
+            BlobJob.objects.select_for_update(skip_locked=True)
+            .filter(state__in=[BlobJob.PENDING, BlobJob.RUNNING], run_after__lte=now)
+            .order_by('run_after')
+            .values_list('pk', flat=True)[:limit]
+        )
+        if not ids:
+            return []
+        # Still due: without row locks (SQLite) another worker may have
+        # claimed some of them since, and only its claim counts
+        BlobJob.objects.filter(pk__in=ids, run_after__lte=now).update(
+            state=BlobJob.RUNNING, claimed_by=worker, attempts=F('attempts') + 1, run_after=lease_until,
+        )
+    return list(
+        BlobJob.objects.filter(pk__in=ids, claimed_by=worker, run_after=lease_until).order_by('pk')
+    )
+
+
+def release_jobs(jobs):
+    """
+    Hands claimed jobs that were not started back to the queue, due now,
+    e.g. when a worker stops in the middle of a batch.
+    """
+    for job in jobs:
+        BlobJob.objects.filter(
+            pk=job.pk, state=BlobJob.RUNNING, claimed_by=job.claimed_by, attempts=job.attempts,
+        ).update(state=BlobJob.PENDING, attempts=F('attempts') - 1, run_after=timezone.now())
+
+
+def _retry_delay(attempts):
+    """Seconds before attempt attempts + 1: doubling from VAULT_JOB_RETRY_DELAY, capped, with jitter."""
+    delay = min(settings.VAULT_JOB_RETRY_DELAY * 2 ** (attempts - 1), settings.VAULT_JOB_MAX_RETRY_DELAY)
+    # Jobs that failed together (e.g. storage was down) do not retry together
+    return delay * random.uniform(0.5, 1.0)
+
+
+def run_job(job):
+    """
+    Runs a claimed job and records the outcome. Returns its new state, or
+    None if the claim was lost meanwhile (the lease ran out and another
+    worker took the job over, or the blob was deleted with its jobs).
+    """
+    handler = HANDLERS.get(job.kind)
+    started = time.monotonic()
+    error = exc_info = None
+    try:
+        if handler is None:
+            raise LookupError(f"No handler for job kind '{job.kind}'.")
+        handler(job)
+    except Exception as e:
+        error, exc_info = f"{type(e).__name__}: {e}", e
+    duration_ms = round((time.monotonic() - started) * 1000, 3)
+
+    now = timezone.now()
+    if error is None:
+        state, changes = BlobJob.DONE, {'finished_at': now, 'last_error': ''}
+    elif handler is None or job.attempts >= settings.VAULT_JOB_MAX_ATTEMPTS:
+        state, changes = BlobJob.FAILED, {'finished_at': now, 'last_error': error}
+    else:
+        state = BlobJob.PENDING
+        changes = {'run_after': now + timedelta(seconds=_retry_delay(job.attempts)), 'last_error': error}
+    finished = BlobJob.objects.filter(
+        pk=job.pk, state=BlobJob.RUNNING, claimed_by=job.claimed_by, attempts=job.attempts,
+    ).update(state=state, **changes)
+
+    log_fields = {
+        'job_id': job.pk, 'kind': job.kind, 'blob': job.blob_id,
+        'worker': job.claimed_by, 'attempts': job.attempts, 'duration_ms': duration_ms,
+    }
+    if not finished:
+        logger.warning("Job claim lost", extra=log_fields)
+        return None
+    if state == BlobJob.DONE:
+        logger.info("Job done", extra=log_fields)
+    elif state == BlobJob.PENDING:
+        logger.warning("Job failed, retrying", exc_info=exc_info, extra={
+            **log_fields, 'error': error, 'retry_at': changes['run_after'].isoformat(),
+        })
+    else:
+        logger.error("Job failed", exc_info=exc_info, extra={**log_fields, 'error': error})
+    return state
+
+
+# --- Handlers ---
+
+def _read_head(stream, size):
+    """Up to size bytes from the start of stream (raw streams may return fewer per read)."""
+    head = b''
+    while len(head) < size:
+        block = stream.read(size - len(head))
+        if not block:
+            break
+        head += block
+    return head
+
+
+@job_handler('sniff_content_type')
+def sniff_blob_content_type(job):
+    """
+    Sets Blob.detected_type from the content's first bytes (vault/sniffing.py),
+    bumps the version of every user with a file on the blob, so their cached
+    lists and ETags pick it up, and logs those files as updated in their
+    owners' change logs, so sync clients fetch the new type too.
+    """
+    from .services import open_blob # services queues jobs, import at run time
+
+    try:
+        blob = Blob.objects.get(pk=job.blob_id)
+        with open_blob(blob) as stream:
+            head = _read_head(stream, SNIFF_SIZE)
+    except (Blob.DoesNotExist, FileNotFoundError):
+        if not Blob.objects.filter(pk=job.blob_id).exists():
+            return # Deleted meanwhile, and the job with it
+        raise
+    detected_type = sniff_content_type(head)
+
+    with transaction.atomic():
+        # Same lock order as uploads and deletes: the Blob row, then usage rows
+        if not Blob.objects.filter(pk=blob.pk).exclude(detected_type=detected_type).update(
+            detected_type=detected_type
+        ):
+            return # Already set (a repeated run) or deleted
+        owner_ids = FileMetadata.objects.filter(blob_id=blob.pk).values('owner_id')
+        # Locked in key order, so two jobs sharing owners cannot deadlock
+        locked = list(
+            StorageUsage.objects.select_for_update().filter(pk__in=owner_ids)
+            .order_by('pk').values_list('pk', flat=True)
+        )
+        StorageUsage.objects.filter(pk__in=locked).update(version=F('version') + 1)
+        files_by_owner = defaultdict(list)
+        for instance in FileMetadata.objects.filter(blob_id=blob.pk).only('id', 'owner_id').order_by('pk'):
+            files_by_owner[instance.owner_id].append(instance)
+        for owner_id in locked:
+            log_changes(owner_id, files_by_owner[owner_id], FileChange.UPDATED)
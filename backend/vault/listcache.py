@@ -0,0 +1,81 @@
+# vault/listcache.py
+"""
+Per-user cache of the file list and detail responses, with ETags.
+
+Every change to a user's files (upload, claim, bulk upload, finalize, delete,
+bulk delete) bumps StorageUsage.version in the same transaction as the change
+itself (vault/usage.py). A cached response is keyed by the user, that version
+and the full request path with its query string, so it is never invalidated
+explicitly: a write moves the user to a new version and the old entries are
+simply never asked for again until the cache evicts them. Because the version
+lives in the database, this holds across every process and server.
+
+Each response also carries a weak ETag derived from the same key. A client
+that sends it back in If-None-Match gets a 304 without the list query, the
+serializer or the cache being touched, only one primary-key lookup for the
+version.
+
+The cache itself is Django's default cache (settings.CACHES): a bounded
+in-process LocMem cache unless VAULT_CACHE_URL points at Redis, which is
+shared by all workers. Only the serialized data is stored, so the response
+is rendered for each request in the format it asks for.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from rest_framework import status
+from rest_framework.response import Response
+
+from .downloads import etag_matches
+from .models import StorageUsage
+
+# Clients must revalidate every time, the ETag makes that cheap
+LIST_CACHE_CONTROL = 'private, no-cache'
+
+
+def get_files_version(user):
+    """Current version of the user's files, 0 before their first upload."""
+    version = StorageUsage.objects.filter(pk=user.pk).values_list('version', flat=True).first()
+    return version or 0
+
+
+def _cache_key(request, version):
+    path_digest = hashlib.sha256(request.get_full_path().encode()).hexdigest()
+    return f"vault:files:{request.user.pk}:{version}:{path_digest}"
+
+
+def cached_response(request, build_response):
+    """
+    Answers a read-only request on the user's files from the cache when it
+    can: 304 if the client's ETag is current, the cached data if another
+    request already built it, otherwise build_response() (cached if it
+    returns 200).
+    """
+    # Read the version before the data: a write committed in between then
+    # caches newer data under the older version, never the other way round.
+    version = get_files_version(request.user)
+    key = _cache_key(request, version)
+    etag = f'"files-{request.user.pk}-{version}-{key[-8:]}"'
+
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        response = HttpResponseNotModified()
+    else:
+        timeout = settings.VAULT_RESPONSE_CACHE_TIMEOUT
+        data = cache.get(key) if timeout else None
+        if data is not None:
+            response = Response(data)
+        else:
+            response = build_response()
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            if timeout:
+                cache.set(key, response.data, timeout)
+
+    response['ETag'] = f'W/{etag}'
+    response['Cache-Control'] = LIST_CACHE_CONTROL
+    # Different users see different lists at the same URL
+    patch_vary_headers(response, ('Authorization', 'Cookie'))
+    return response
@@ -0,0 +1,104 @@
+# vault/management/commands/vault_expire_uploads.py
+"""
+Deletes resumable upload sessions that expired (no chunk received for
+VAULT_UPLOAD_SESSION_TTL seconds), with their part files, and part files
+that have no session at all, e.g. left behind by a crash right after the
+session was created. Run it periodically, e.g. from cron.
+
+Safe to run while the vault is in use: sessions are deleted in batches
+under the same row lock chunk uploads and finalize take, so a session is
+either finalized or expired, never both, and a chunk arriving for an
+expired session gets a 404.
+"""
+import os
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from vault.models import UploadSession
+from vault.storage import get_session_part_path
+
+
+class Command(BaseCommand):
+    help = "Deletes expired resumable upload sessions and leftover part files."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Only report what would be deleted.",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help="Sessions deleted per transaction (default: 1000).",
+        )
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.batch_size = options['batch_size']
+
+        expired = self.expire_sessions()
+        strays = self.remove_stray_part_files()
+
+        verb = "Would delete" if self.dry_run else "Deleted"
+        self.stdout.write(f"{verb} {expired} expired upload session(s).")
+        self.stdout.write(f"{verb} {strays} part file(s) without a session.")
+        self.stdout.write(self.style.SUCCESS("Done."))
+
+    def expire_sessions(self):
+        """Deletes the expired sessions a batch at a time, then their part files."""
+        now = timezone.now()
+        if self.dry_run:
+            return UploadSession.objects.filter(expires_at__lte=now).count()
+        expired = 0
+        while True:
+            with transaction.atomic():
+                # Sessions a chunk upload or finalize holds are skipped, the
+                # next run gets them if they are still expired then
+                ids = list(
+                    UploadSession.objects.select_for_update(skip_locked=True)
+                    .filter(expires_at__lte=now)
+                    .values_list('pk', flat=True)[:self.batch_size]
+                )
+                if not ids:
+                    break
+                UploadSession.objects.filter(pk__in=ids).delete() # Chunks cascade
+            # Committed: no request can write to these part files any more
+            for session_id in ids:
+                self.remove(get_session_part_path(session_id))
+            expired += len(ids)
+        return expired
+
+    def remove_stray_part_files(self):
+        """
+        Removes part files older than the session TTL whose session row is
+        gone. Younger ones may belong to a session being created right now.
+        """
+        session_dir = os.path.dirname(get_session_part_path(uuid.UUID(int=0)))
+        cutoff = time.time() - settings.VAULT_UPLOAD_SESSION_TTL
+        candidates = {}
+        with os.scandir(session_dir) as entries:
+            for entry in entries:
+                name, ext = os.path.splitext(entry.name)
+                if ext != '.part' or not entry.is_file() or entry.stat().st_mtime > cutoff:
+                    continue
+                try:
+                    candidates[uuid.UUID(name)] = entry.path
+                except ValueError:
+                    continue # Not a session's part file
+        # Checked after listing, so a session created meanwhile is seen
+        live = set(UploadSession.objects.filter(pk__in=list(candidates)).values_list('pk', flat=True))
+        strays = [path for session_id, path in candidates.items() if session_id not in live]
+        if not self.dry_run:
+            for path in strays:
+                self.remove(path)
+        return len(strays)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
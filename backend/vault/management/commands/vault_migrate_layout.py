@@ -0,0 +1,95 @@
+# vault/management/commands/vault_migrate_layout.py
+"""
+Moves stored blob and chunk files to the path layout configured in
+VAULT_BLOB_LAYOUT, e.g. from the flat 'uploads/<hash>' to the fan-out
+'uploads/ab/cd/<hash>'.
+
+Safe to run while the vault is in use. Reads fall back to the other layouts
+until a file is moved, and rows are processed in batches. Each batch runs in
+its own transaction that locks the Blob / Chunk rows (in hash order, like
+the upload and delete paths), so a file cannot be deleted or re-stored while
+it is being moved. Interrupted runs can simply be started again.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from vault.blobstore import BLOBS, CHUNKS, get_blob_store
+from vault.models import Blob, Chunk
+
+
+class Command(BaseCommand):
+    help = "Moves stored files to the configured VAULT_BLOB_LAYOUT, in batches, while the vault is online."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Only count the files that would be moved.",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help="Rows locked and files moved per transaction (default: 500).",
+        )
+        parser.add_argument(
+            '--pause', type=float, default=0.0,
+            help="Seconds to wait between batches, to limit the load on storage (default: 0).",
+        )
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.batch_size = options['batch_size']
+        self.pause = options['pause']
+        self.store = get_blob_store()
+
+        # Chunked blobs have no file of their own
+        for model, namespace, rows in (
+            (Blob, BLOBS, Blob.objects.filter(chunked=False)),
+            (Chunk, CHUNKS, Chunk.objects.all()),
+        ):
+            counts = self.migrate(rows, namespace)
+            verb = "would be moved" if self.dry_run else "moved"
+            self.stdout.write(
+                f"{model._meta.verbose_name_plural.capitalize()}: {counts['moved']} {verb}, "
+                f"{counts['in place']} already in place, {counts['missing']} missing."
+            )
+            if counts['missing']:
+                self.stdout.write(self.style.WARNING(
+                    f"{counts['missing']} {model._meta.verbose_name}(s) have no stored file under any layout."
+                ))
+        self.stdout.write(self.style.SUCCESS("Done."))
+
+    def migrate(self, rows, namespace):
+        """Returns the number of files per outcome of BlobStore.relocate()."""
+        counts = {'moved': 0, 'in place': 0, 'missing': 0}
+        last_hash = ''
+        while True:
+            with transaction.atomic():
+                # Keyset batches in hash order, the order bulk operations lock rows in
+                hashes = list(
+                    rows.select_for_update()
+                    .filter(hash__gt=last_hash)
+                    .order_by('hash')
+                    .values_list('hash', flat=True)[:self.batch_size]
+                )
+                if not hashes:
+                    break
+                last_hash = hashes[-1]
+
+                for content_hash in hashes:
+                    if self.dry_run:
+                        outcome = self.check(namespace, content_hash)
+                    else:
+                        outcome = self.store.relocate(namespace, content_hash)
+                    counts[outcome] += 1
+                    if outcome == 'missing':
+                        self.stdout.write(f"Missing: {namespace} {content_hash}")
+            if self.pause:
+                time.sleep(self.pause)
+        return counts
+
+    def check(self, namespace, content_hash):
+        path = self.store.locate(namespace, content_hash)
+        if path is None:
+            return 'missing'
+        return 'in place' if path == self.store.path(namespace, content_hash) else 'moved'
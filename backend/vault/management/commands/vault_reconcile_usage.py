@@ -0,0 +1,249 @@
+# vault/management/commands/vault_reconcile_usage.py
+"""
+Recomputes every counter the vault maintains incrementally (Blob.ref_count,
+Chunk.ref_count, StorageUsage and VaultUsage) from the FileMetadata, Blob and
+BlobChunk tables, and corrects the rows that drifted. Counters can drift when rows are removed
+outside the API, e.g. with raw SQL or a partial restore.
+
+Files removed or restored that way also left no trace in the change log
+(vault/changes.py), so for every user whose counters drifted the log is
+replayed and compared with the files that actually exist: a DELETED entry
+is written for each logged file that is gone, and a CREATED entry for each
+file the log does not know about, in the transaction that bumps the
+user's version. Sync clients then pick the repair up like any other change.
+
+Safe to run while the vault is in use: rows are processed in batches, each
+in its own transaction that locks the counter rows before counting, just like
+the upload and delete paths do.
+"""
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Exists, F, Max, OuterRef, Sum
+
+from vault.changes import log_changes
+from vault.models import Blob, BlobChunk, Chunk, FileChange, FileMetadata, StorageUsage, VaultUsage
+from vault.usage import VAULT_USAGE_PK
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Recomputes blob reference counts and storage usage counters, fixing any that drifted."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Only report the counters that differ, do not write anything.",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help="Rows counted and locked per transaction (default: 1000).",
+        )
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.batch_size = options['batch_size']
+
+        fixed_blobs, orphans = self.reconcile_ref_counts(Blob, FileMetadata, 'blob_id')
+        fixed_chunks, orphan_chunks = self.reconcile_ref_counts(Chunk, BlobChunk, 'chunk_id')
+        self.logged_changes = 0
+        fixed_users = self.reconcile_user_usage()
+        fixed_vault = self.reconcile_vault_usage()
+
+        verb = "Would fix" if self.dry_run else "Fixed"
+        self.stdout.write(f"{verb} {fixed_blobs} blob reference count(s).")
+        self.stdout.write(f"{verb} {fixed_chunks} chunk reference count(s).")
+        self.stdout.write(f"{verb} {fixed_users} user usage row(s).")
+        write = "Would write" if self.dry_run else "Wrote"
+        self.stdout.write(f"{write} {self.logged_changes} change log entries for files changed outside the API.")
+        self.stdout.write(f"{verb} the vault usage row." if fixed_vault else "Vault usage row is correct.")
+        if orphans:
+            self.stdout.write(self.style.WARNING(
+                f"{orphans} blob(s) have no references left and still take up storage."
+            ))
+        if orphan_chunks:
+            self.stdout.write(self.style.WARNING(
+                f"{orphan_chunks} chunk(s) have no references left and still take up storage."
+            ))
+        self.stdout.write(self.style.SUCCESS("Done."))
+
+    def reconcile_ref_counts(self, model, ref_model, ref_field):
+        """
+        Recounts model.ref_count (Blob or Chunk) as the number of ref_model
+        rows pointing at each row through ref_field.
+        Returns (number of corrected rows, number of unreferenced rows).
+        """
+        name = model._meta.verbose_name
+        fixed = orphans = 0
+        last_hash = ''
+        while True:
+            with transaction.atomic():
+                # Keyset batches in hash order, the order bulk operations lock rows in
+                rows = list(
+                    model.objects.select_for_update()
+                    .filter(hash__gt=last_hash)
+                    .order_by('hash')[:self.batch_size]
+                )
+                if not rows:
+                    break
+                last_hash = rows[-1].hash
+
+                actual = dict(
+                    ref_model.objects
+                    .filter(**{f'{ref_field}__in': [row.hash for row in rows]})
+                    .values_list(ref_field)
+                    .annotate(refs=Count('id'))
+                    .order_by()
+                )
+                changed = []
+                for row in rows:
+                    refs = actual.get(row.hash, 0)
+                    if refs == 0:
+                        orphans += 1
+                    if row.ref_count != refs:
+                        self.stdout.write(f"{name.capitalize()} {row.hash}: ref_count {row.ref_count} -> {refs}")
+                        row.ref_count = refs
+                        changed.append(row)
+                if changed and not self.dry_run:
+                    model.objects.bulk_update(changed, ['ref_count'])
+                fixed += len(changed)
+        return fixed, orphans
+
+    def reconcile_user_usage(self):
+        """Returns the number of corrected (or created) StorageUsage rows."""
+        fixed = 0
+        last_pk = 0
+        while True:
+            with transaction.atomic():
+                user_ids = list(
+                    User.objects.filter(pk__gt=last_pk).order_by('pk')
+                    .values_list('pk', flat=True)[:self.batch_size]
+                )
+                if not user_ids:
+                    break
+                last_pk = user_ids[-1]
+
+                # Lock first, count second: an upload in flight either has
+                # already updated the row (and we wait for it to commit) or
+                # will add its own delta on top of what we write.
+                rows = {
+                    row.pk: row
+                    for row in StorageUsage.objects.select_for_update()
+                    .filter(pk__in=user_ids).order_by('pk')
+                }
+                expected = self.count_usage(user_ids)
+
+                changed, missing = [], []
+                for user_id in user_ids:
+                    counts = expected.get(user_id, (0, 0, 0))
+                    row = rows.get(user_id)
+                    if row is None:
+                        if any(counts):
+                            # Version 1, so the change entries logged below are
+                            # newer than the cursor (version 0) clients hold
+                            missing.append(StorageUsage(
+                                user_id=user_id, file_count=counts[0],
+                                logical_bytes=counts[1], physical_bytes=counts[2], version=1,
+                            ))
+                        continue
+                    current = (row.file_count, row.logical_bytes, row.physical_bytes)
+                    if current != counts:
+                        self.stdout.write(f"User {user_id}: (files, logical, physical) {current} -> {counts}")
+                        row.file_count, row.logical_bytes, row.physical_bytes = counts
+                        # The files changed outside the API, cached lists may be stale
+                        row.version += 1
+                        changed.append(row)
+
+                for row in missing:
+                    self.stdout.write(
+                        f"User {row.user_id}: missing usage row, creating "
+                        f"{(row.file_count, row.logical_bytes, row.physical_bytes)}"
+                    )
+                if not self.dry_run:
+                    StorageUsage.objects.bulk_update(
+                        changed, ['file_count', 'logical_bytes', 'physical_bytes', 'version']
+                    )
+                    # A concurrent first upload may have created the row meanwhile,
+                    # a second run picks up whatever that leaves behind.
+                    StorageUsage.objects.bulk_create(missing, ignore_conflicts=True)
+                # Still under the row locks, so no upload or delete of these
+                # users can log a change in between
+                for user_id in [row.pk for row in changed] + [row.user_id for row in missing]:
+                    self.log_repairs(user_id)
+                fixed += len(changed) + len(missing)
+        return fixed
+
+    def log_repairs(self, user_id):
+        """
+        Writes the change log entries that bring the user's log in line with
+        their files. Call with the user's StorageUsage row locked and its
+        version already bumped.
+        """
+        # Replay the log: the last entry of each file says whether it exists
+        logged = {}
+        changes = (
+            FileChange.objects.filter(owner_id=user_id)
+            .order_by('version', 'id').values_list('file_id', 'action')
+        )
+        for file_id, action in changes.iterator(chunk_size=self.batch_size):
+            logged[file_id] = action
+        logged_ids = {file_id for file_id, action in logged.items() if action != FileChange.DELETED}
+        existing_ids = set(FileMetadata.objects.filter(owner_id=user_id).values_list('pk', flat=True))
+
+        for action, file_ids in (
+            (FileChange.DELETED, sorted(logged_ids - existing_ids)),
+            (FileChange.CREATED, sorted(existing_ids - logged_ids)),
+        ):
+            if not file_ids:
+                continue
+            self.stdout.write(f"User {user_id}: logging {len(file_ids)} file(s) as {action}")
+            if not self.dry_run:
+                # log_changes only needs the IDs
+                log_changes(user_id, [FileMetadata(pk=file_id) for file_id in file_ids], action)
+            self.logged_changes += len(file_ids)
+
+    def count_usage(self, user_ids):
+        """Returns {user_id: (file_count, logical_bytes, physical_bytes)} computed from FileMetadata."""
+        files = FileMetadata.objects.filter(owner_id__in=user_ids)
+        totals = {
+            row['owner_id']: [row['files'], row['logical'], 0]
+            for row in files.values('owner_id').annotate(
+                files=Count('id'), logical=Sum('file_size')
+            ).order_by()
+        }
+        # Each distinct (owner, blob) pair counts once towards physical bytes
+        for row in files.values('owner_id', 'blob_id').annotate(size=Max('file_size')).order_by():
+            totals[row['owner_id']][2] += row['size']
+        return {user_id: tuple(counts) for user_id, counts in totals.items()}
+
+    def reconcile_vault_usage(self):
+        """Returns True if the VaultUsage row was corrected."""
+        with transaction.atomic():
+            VaultUsage.objects.get_or_create(pk=VAULT_USAGE_PK)
+            vault = VaultUsage.objects.select_for_update().get(pk=VAULT_USAGE_PK)
+            # Only referenced blobs and chunks count, see VaultUsage
+            referenced = Blob.objects.filter(Exists(FileMetadata.objects.filter(blob_id=OuterRef('pk'))))
+            totals = referenced.aggregate(blobs=Count('hash'), size=Sum('size'))
+            chunked = referenced.filter(chunked=True).aggregate(size=Sum('size'))
+            compressed = referenced.exclude(codec='').aggregate(saved=Sum(F('size') - F('stored_size')))
+            chunks = Chunk.objects.filter(
+                Exists(BlobChunk.objects.filter(chunk_id=OuterRef('pk')))
+            ).aggregate(chunks=Count('hash'), size=Sum('size'))
+            counts = (
+                totals['blobs'], totals['size'] or 0, chunked['size'] or 0,
+                chunks['chunks'], chunks['size'] or 0, compressed['saved'] or 0,
+            )
+            fields = [
+                'blob_count', 'physical_bytes', 'chunked_bytes', 'chunk_count', 'chunk_bytes',
+                'compression_saved_bytes',
+            ]
+            current = tuple(getattr(vault, field) for field in fields)
+            if current == counts:
+                return False
+            self.stdout.write(f"Vault: ({', '.join(fields)}) {current} -> {counts}")
+            if not self.dry_run:
+                for field, value in zip(fields, counts):
+                    setattr(vault, field, value)
+                vault.save(update_fields=fields)
+            return True
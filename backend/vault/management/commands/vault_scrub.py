@@ -0,0 +1,369 @@
+# vault/management/commands/vault_scrub.py
+"""
+Checks that the blob store and the database agree, and optionally that
+stored content is still intact.
+
+Jobs (orphans and dangling run when none is selected):
+  --orphans   Stored files (blobs and chunks) without a Blob / Chunk row, e.g.
+              left behind by a crash after a file was stored but before its
+              transaction committed. Deleted unless --dry-run.
+  --dangling  Blob / Chunk rows whose file is missing, chunked blobs whose
+              manifest does not add up to their size, and the files (metadata
+              rows) affected. Only reported: the content is gone.
+  --rehash    Reads back every stored blob file and chunk in a process pool
+              and compares its SHA-256 and size with its row, to catch
+              bit rot. Chunked blobs are covered by their chunks.
+
+Both sides are streamed: stored files are listed lazily and checked against
+the database a batch at a time, rows are read in keyset batches, so memory
+use does not depend on the size of the vault. --pause and --read-rate keep
+the scrub from starving live traffic. --report writes the findings as JSON.
+
+Safe to run while the vault is in use. An orphan is confirmed by inserting a
+placeholder row for its hash, which waits for (or holds off) any upload of
+the same content, and the file is only deleted while that placeholder is
+held. The placeholders are rolled back afterwards.
+"""
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from vault.blobstore import BLOBS, CHUNKS, get_blob_store
+from vault.compression import get_codec
+from vault.models import Blob, BlobChunk, Chunk, FileMetadata
+
+# Bytes read per iteration while re-hashing
+READ_BLOCK_SIZE = 1024 * 1024 # 1 MB
+
+
+def _init_worker():
+    django.setup()
+    # Never share the parent's storage client (sockets) across processes
+    get_blob_store.cache_clear()
+
+
+def rehash_stored(namespace, content_hash, codec):
+    """
+    Runs in a worker process: reads a stored file back (decompressed, if it
+    is) and returns (content_hash, digest, size, stored bytes read, error).
+    """
+    read = 0
+    try:
+        # Past the blob cache: checks what primary storage holds, and a full
+        # read of the vault must not push the hot files out of the cache
+        with get_blob_store(cached=False).open(namespace, content_hash) as stored:
+            stream = get_codec(codec).decompressing_reader(stored) if codec else stored
+            hasher = hashlib.sha256()
+            size = 0
+            for block in iter(lambda: stream.read(READ_BLOCK_SIZE), b''):
+                hasher.update(block)
+                size += len(block)
+            read = stored.tell() if codec else size
+            return content_hash, hasher.hexdigest(), size, read, None
+    except Exception as e: # Corrupt compressed data raises all sorts of errors
+        return content_hash, None, None, read, f"{type(e).__name__}: {e}"
+
+
+class Throttle:
+    """Sleeps as needed to keep a running byte count under a rate."""
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.started = time.monotonic()
+        self.total = 0
+
+    def consume(self, count):
+        self.total += count
+        if self.bytes_per_second:
+            ahead = self.total / self.bytes_per_second - (time.monotonic() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+class Command(BaseCommand):
+    help = "Finds orphan files, dangling rows and (optionally) corrupt content in the blob store."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orphans', action='store_true', help="Find (and delete) stored files without a row.")
+        parser.add_argument('--dangling', action='store_true', help="Find rows whose stored data is missing.")
+        parser.add_argument('--rehash', action='store_true', help="Verify the SHA-256 of every stored file.")
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help="Only report orphan files, do not delete them.",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help="Files or rows checked per database round trip (default: 1000).",
+        )
+        parser.add_argument(
+            '--pause', type=float, default=0.0,
+            help="Seconds to wait between batches, to limit the load on the database (default: 0).",
+        )
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help="Processes re-hashing in parallel (default: one per CPU).",
+        )
+        parser.add_argument(
+            '--read-rate', type=float, default=0.0,
+            help="Most MB per second read while re-hashing, 0 for no limit (default: 0).",
+        )
+        parser.add_argument(
+            '--report', metavar='PATH',
+            help="Write the findings as JSON to PATH ('-' for standard output).",
+        )
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.batch_size = options['batch_size']
+        self.pause = options['pause']
+        self.store = get_blob_store()
+        if options['report'] == '-':
+            # Keep standard output for the JSON document
+            self.stdout = self.stderr
+
+        run_all = not (options['orphans'] or options['dangling'] or options['rehash'])
+        report = {'started_at': timezone.now().isoformat(), 'dry_run': self.dry_run}
+        if options['orphans'] or run_all:
+            report['orphans'] = {
+                'blobs': self.find_orphans(Blob, BLOBS),
+                'chunks': self.find_orphans(Chunk, CHUNKS),
+            }
+        if options['dangling'] or run_all:
+            report['dangling'] = self.find_dangling()
+        if options['rehash']:
+            report['rehash'] = self.rehash(options['workers'], options['read_rate'])
+        report['finished_at'] = timezone.now().isoformat()
+
+        self.print_summary(report)
+        if options['report'] == '-':
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        elif options['report']:
+            with open(options['report'], 'w') as report_file:
+                json.dump(report, report_file, indent=2)
+            self.stdout.write(f"Report written to {options['report']}.")
+
+    def batches(self, iterable):
+        """Lists of up to batch_size items from iterable, pausing in between."""
+        batch = []
+        for item in iterable:
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+                if self.pause:
+                    time.sleep(self.pause)
+        if batch:
+            yield batch
+
+    def keyset(self, queryset, *fields):
+        """Streams queryset in primary key order, a batch per query."""
+        last_pk = None
+        while True:
+            page = queryset.order_by('pk')
+            if last_pk is not None:
+                page = page.filter(pk__gt=last_pk)
+            rows = list(page.values_list('pk', *fields)[:self.batch_size])
+            if not rows:
+                return
+            last_pk = rows[-1][0]
+            yield rows
+            if self.pause:
+                time.sleep(self.pause)
+
+    # --- Orphans ---
+
+    def find_orphans(self, model, namespace):
+        result = {'checked': 0, 'orphans': 0, 'bytes': 0, 'unrecognized': [], 'hashes': []}
+        for batch in self.batches(self.store.iter_stored(namespace)):
+            result['checked'] += len(batch)
+            stored = {}
+            for content_hash, path in batch:
+                if content_hash is None:
+                    result['unrecognized'].append(path) # Not ours to delete
+                else:
+                    stored.setdefault(content_hash, []).append(path)
+            known = set(model.objects.filter(pk__in=list(stored)).values_list('pk', flat=True))
+            candidates = sorted(set(stored) - known)
+            if not candidates:
+                continue
+
+            sizes = {content_hash: self.stored_size(stored[content_hash]) for content_hash in candidates}
+            for content_hash in self.confirm_and_delete_orphans(model, namespace, candidates):
+                result['orphans'] += 1
+                result['bytes'] += sizes[content_hash]
+                result['hashes'].append(content_hash)
+        return result
+
+    def stored_size(self, paths):
+        size = 0
+        for path in paths:
+            try:
+                size += self.store.backend.size(path)
+            except OSError:
+                pass # Deleted meanwhile
+        return size
+
+    def confirm_and_delete_orphans(self, model, namespace, candidates):
+        """
+        Returns the candidates that still have no row, deleting their files
+        (unless dry-run) while placeholder rows hold off uploads of the
+        same content. A running upload that stored the file but has not
+        committed yet makes the insert wait, then fail: not an orphan.
+        """
+        orphans = []
+        with transaction.atomic():
+            for content_hash in candidates: # Hash order, like every other row lock
+                try:
+                    with transaction.atomic():
+                        model.objects.create(hash=content_hash, size=0)
+                except IntegrityError:
+                    continue # Uploaded again meanwhile, the file is in use
+                orphans.append(content_hash)
+
+            if not self.dry_run:
+                for content_hash in orphans:
+                    self.store.delete(namespace, content_hash)
+            # The placeholder rows only served as locks
+            transaction.set_rollback(True)
+        return orphans
+
+    # --- Dangling rows ---
+
+    def find_dangling(self):
+        missing_blobs = []
+        missing_chunks = []
+        bad_manifests = []
+        for rows in self.keyset(Blob.objects.filter(chunked=False)):
+            missing_blobs += self.missing_files(Blob, BLOBS, [row[0] for row in rows])
+        for rows in self.keyset(Chunk.objects.all()):
+            missing_chunks += self.missing_files(Chunk, CHUNKS, [row[0] for row in rows])
+        for rows in self.keyset(Blob.objects.filter(chunked=True), 'size'):
+            sizes = dict(rows)
+            # One aggregate per batch: chunk count and total size of each manifest
+            manifests = {
+                entry['blob_id']: entry
+                for entry in BlobChunk.objects.filter(blob_id__in=list(sizes))
+                .order_by().values('blob_id').annotate(chunks=Count('id'), size=Sum('chunk__size'))
+            }
+            for blob_hash, size in sizes.items():
+                entry = manifests.get(blob_hash)
+                if entry is None or entry['size'] != size:
+                    bad_manifests.append(blob_hash)
+
+        # Blobs left incomplete by the missing chunks
+        broken_by_chunks = set()
+        for batch in self.batches(missing_chunks):
+            broken_by_chunks.update(
+                BlobChunk.objects.filter(chunk_id__in=batch).values_list('blob_id', flat=True).distinct()
+            )
+        affected = sorted(set(missing_blobs) | set(bad_manifests) | broken_by_chunks)
+        files = []
+        for batch in self.batches(affected):
+            files += FileMetadata.objects.filter(blob_id__in=batch).order_by('pk').values_list('pk', flat=True)
+
+        return {
+            'missing_blobs': missing_blobs,
+            'missing_chunks': missing_chunks,
+            'incomplete_manifests': bad_manifests,
+            'unreadable_blobs': affected,
+            'affected_files': files,
+        }
+
+    def missing_files(self, model, namespace, hashes):
+        """Hashes among rows whose file is missing, re-checked against the rows."""
+        missing = [content_hash for content_hash in hashes if not self.store.exists(namespace, content_hash)]
+        if not missing:
+            return []
+        # A row deleted (with its file) during the check is not dangling
+        return sorted(model.objects.filter(pk__in=missing).values_list('pk', flat=True))
+
+    # --- Re-hash ---
+
+    def rehash(self, workers, read_rate):
+        result = {'checked': 0, 'bytes_read': 0, 'corrupt': []}
+        throttle = Throttle(read_rate * 1024 * 1024)
+        work = self.rehash_work()
+
+        # Worker processes must not inherit open database connections
+        connections.close_all()
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            pending = {}
+            max_pending = 2 * workers # Bounded look-ahead, for the throttle and memory
+            while True:
+                for item in work:
+                    namespace, content_hash, codec, size = item
+                    future = executor.submit(rehash_stored, namespace, content_hash, codec)
+                    pending[future] = item
+                    if len(pending) >= max_pending:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    namespace, content_hash, codec, size = pending.pop(future)
+                    _, digest, actual_size, read, error = future.result()
+                    result['checked'] += 1
+                    result['bytes_read'] += read
+                    throttle.consume(read)
+                    if error is None and digest == content_hash and actual_size == size:
+                        continue
+                    result['corrupt'].append({
+                        'namespace': namespace,
+                        'hash': content_hash,
+                        'size': size,
+                        'actual_hash': digest,
+                        'actual_size': actual_size,
+                        'error': error,
+                    })
+        return result
+
+    def rehash_work(self):
+        """Yields (namespace, hash, codec, size) for every stored file, streamed from the rows."""
+        for rows in self.keyset(Blob.objects.filter(chunked=False), 'codec', 'size'):
+            for content_hash, codec, size in rows:
+                yield BLOBS, content_hash, codec, size
+        for rows in self.keyset(Chunk.objects.all(), 'size'):
+            for content_hash, size in rows:
+                yield CHUNKS, content_hash, '', size
+
+    # --- Output ---
+
+    def print_summary(self, report):
+        verb = "Would delete" if self.dry_run else "Deleted"
+        for name, result in report.get('orphans', {}).items():
+            self.stdout.write(
+                f"Orphan {name}: {result['checked']} stored files checked, "
+                f"{verb.lower()} {result['orphans']} ({result['bytes']} bytes)."
+            )
+            if result['unrecognized']:
+                self.stdout.write(self.style.WARNING(
+                    f"{len(result['unrecognized'])} file(s) under '{name}' are not named after their hash, left alone."
+                ))
+        dangling = report.get('dangling')
+        if dangling is not None:
+            problems = len(dangling['missing_blobs']) + len(dangling['missing_chunks']) + len(dangling['incomplete_manifests'])
+            style = self.style.ERROR if problems else self.style.SUCCESS
+            self.stdout.write(style(
+                f"Dangling: {len(dangling['missing_blobs'])} blob(s) and {len(dangling['missing_chunks'])} "
+                f"chunk(s) missing from storage, {len(dangling['incomplete_manifests'])} incomplete manifest(s), "
+                f"{len(dangling['affected_files'])} file(s) affected."
+            ))
+        rehash = report.get('rehash')
+        if rehash is not None:
+            style = self.style.ERROR if rehash['corrupt'] else self.style.SUCCESS
+            self.stdout.write(style(
+                f"Re-hash: {rehash['checked']} stored file(s) verified ({rehash['bytes_read']} bytes read), "
+                f"{len(rehash['corrupt'])} corrupt."
+            ))
+        self.stdout.write(self.style.SUCCESS("Done."))
@@ -0,0 +1,176 @@
+# vault/management/commands/vault_worker.py
+"""
+Runs the background jobs queued on stored content (vault/jobs.py).
+
+Starts --processes worker processes (VAULT_WORKER_PROCESSES by default).
+Each claims up to --batch-size due jobs at a time, runs them, and polls
+again every --poll-interval seconds while the queue is empty. Workers that
+die are restarted; their claimed jobs are taken over by any worker once
+their lease (VAULT_JOB_LEASE) runs out.
+
+SIGTERM or SIGINT stops the workers after the job each is running; jobs
+they claimed but had not started go back to the queue. --once runs until
+the queue is empty instead, e.g. from cron or a one-off container.
+
+  --status        Prints the number of jobs per kind and state, and exits.
+  --retry-failed  Queues the failed jobs again (attempts reset), and exits.
+"""
+import logging
+import multiprocessing
+import signal
+import threading
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, close_old_connections, connections
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from vault.blobstore import get_blob_store
+from vault.jobs import claim_jobs, release_jobs, run_job, worker_id
+from vault.models import BlobJob
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of the worker processes
+SUPERVISE_INTERVAL = 1.0
+
+
+def work(stop, batch_size, poll_interval, once):
+    """
+    Claims and runs jobs until stop (an Event) is set, or until no job is
+    due if once. The loop of every worker process.
+    """
+    worker = worker_id()
+    while not stop.is_set():
+        # Long-running: drop connections past CONN_MAX_AGE or broken ones
+        close_old_connections()
+        try:
+            jobs = claim_jobs(worker, batch_size)
+            for index, job in enumerate(jobs):
+                if stop.is_set():
+                    release_jobs(jobs[index:])
+                    break
+                run_job(job)
+        except DatabaseError:
+            # Database restarting or unreachable: keep the worker, try again
+            logger.exception("Worker could not reach the database", extra={'worker': worker})
+            jobs = []
+        if not jobs:
+            if once:
+                return
+            stop.wait(poll_interval)
+
+
+def _worker_process(stop, batch_size, poll_interval, once):
+    # Ctrl-C reaches the whole process group: let the parent stop us in order.
+    # A SIGTERM sent to this process alone kills it, as it would without
+    # the handler inherited from the parent.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    django.setup()
+    # Never share the parent's storage client (sockets) across processes
+    get_blob_store.cache_clear()
+    logger.info("Worker started", extra={'worker': worker_id()})
+    work(stop, batch_size, poll_interval, once)
+
+
+class Command(BaseCommand):
+    help = "Runs the background job workers (post-upload processing of stored content)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int, default=None,
+            help="Worker processes, 0 to run jobs in this process "
+                 "(default: VAULT_WORKER_PROCESSES).",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=10,
+            help="Jobs claimed per database round trip (default: 10).",
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=2.0,
+            help="Seconds to wait before looking again when no job is due (default: 2).",
+        )
+        parser.add_argument('--once', action='store_true', help="Exit once no job is due.")
+        parser.add_argument('--status', action='store_true', help="Print the queue's job counts and exit.")
+        parser.add_argument('--retry-failed', action='store_true', help="Queue the failed jobs again and exit.")
+
+    def handle(self, *args, **options):
+        if options['status']:
+            return self.print_status()
+        if options['retry_failed']:
+            retried = BlobJob.objects.filter(state=BlobJob.FAILED).update(
+                state=BlobJob.PENDING, attempts=0, run_after=timezone.now(), finished_at=None,
+            )
+            self.stdout.write(f"Queued {retried} failed job(s) again.")
+            return
+
+        processes = options['processes']
+        if processes is None:
+            processes = settings.VAULT_WORKER_PROCESSES
+        args = (options['batch_size'], options['poll_interval'], options['once'])
+
+        # Set by the signal handlers. Not the Event shared with the worker
+        # processes: setting that one deadlocks while this thread waits on it.
+        stopping = threading.Event()
+        self.handle_signals(stopping)
+
+        if processes <= 0:
+            logger.info("Worker started", extra={'worker': worker_id()})
+            work(stopping, *args)
+            return
+
+        # Each process opens its own connections, inherited ones would be shared
+        connections.close_all()
+        stop = multiprocessing.Event()
+        workers = [self.start_worker(stop, args) for _ in range(processes)]
+        logger.info("Workers started", extra={'processes': processes, 'pids': [p.pid for p in workers]})
+
+        while not stopping.wait(SUPERVISE_INTERVAL):
+            if options['once']:
+                if not any(p.is_alive() for p in workers):
+                    break
+                continue
+            for index, process in enumerate(workers):
+                if not process.is_alive():
+                    logger.error("Worker process died, restarting", extra={
+                        'pid': process.pid, 'exitcode': process.exitcode,
+                    })
+                    workers[index] = self.start_worker(stop, args)
+
+        logger.info("Stopping workers", extra={'processes': processes})
+        stop.set()
+        for process in workers:
+            process.join()
+        logger.info("Workers stopped", extra={'processes': processes})
+
+    @staticmethod
+    def start_worker(stop, args):
+        process = multiprocessing.Process(target=_worker_process, args=(stop, *args), name='vault-worker')
+        process.start()
+        return process
+
+    @staticmethod
+    def handle_signals(stopping):
+        def request_stop(signum, frame):
+            stopping.set()
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+    def print_status(self):
+        counts = (
+            BlobJob.objects.values('kind', 'state')
+            .annotate(count=Count('id'), oldest=Min('run_after'))
+            .order_by('kind', 'state')
+        )
+        if not counts:
+            self.stdout.write("No jobs.")
+            return
+        now = timezone.now()
+        for row in counts:
+            line = f"{row['kind']:<24} {row['state']:<8} {row['count']:>10}"
+            if row['state'] == BlobJob.PENDING and row['oldest'] <= now:
+                line += f"  (due for {(now - row['oldest']).total_seconds():.0f}s)"
+            self.stdout.write(line)
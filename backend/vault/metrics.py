@@ -0,0 +1,333 @@
+# vault/metrics.py
+"""
+Prometheus metrics: counters and histograms kept in memory and served in the
+Prometheus text format at /metrics (see metrics_view), plus PhaseTimer, which
+times the phases of uploads, downloads and deletes for both the metrics and
+the structured logs.
+
+Nothing here needs a client library. Updating a metric takes a lock and a
+dict update; with VAULT_METRICS_ENABLED off it returns straight away and the
+request middleware is not installed at all.
+
+Each process counts on its own. With several worker processes, set
+VAULT_METRICS_DIR to a directory they share (an empty one, e.g. a tmpfs):
+every process then writes a snapshot of its metrics there every
+VAULT_METRICS_FLUSH_INTERVAL seconds, and whichever process answers the
+scrape adds them all up.
+"""
+import hmac
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a fast metadata query to a slow upload
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 20, 50, 100, 200)
+
+_registry = {} # name -> Counter or Histogram
+
+
+def metrics_enabled():
+    return settings.VAULT_METRICS_ENABLED
+
+
+class Counter:
+    """A counter per combination of label values."""
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {} # label values -> float
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    def inc(self, amount=1, **labels):
+        if not metrics_enabled():
+            return
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    @staticmethod
+    def merge(total, value):
+        return (total or 0) + value
+
+    def render(self, samples):
+        for key, value in samples.items():
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+
+
+class Histogram:
+    """A histogram (cumulative buckets, sum and count) per combination of label values."""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {} # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    def observe(self, value, **labels):
+        if not metrics_enabled():
+            return
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), list(state)] for key, state in self._values.items()]
+
+    @staticmethod
+    def merge(total, state):
+        if total is None:
+            return list(state)
+        return [a + b for a, b in zip(total, state)]
+
+    def render(self, samples):
+        for key, state in samples.items():
+            for bound, count in zip(self.buckets, state):
+                labels = _format_labels(self.labels + ('le',), key + (_format_value(bound),))
+                yield f"{self.name}_bucket{labels} {count}"
+            labels = _format_labels(self.labels + ('le',), key + ('+Inf',))
+            yield f"{self.name}_bucket{labels} {state[-1]}"
+            yield f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(state[-2])}"
+            yield f"{self.name}_count{_format_labels(self.labels, key)} {state[-1]}"
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if value.is_integer() and abs(value) < 1e15:
+            return str(int(value))
+        return repr(value)
+    return str(value)
+
+
+# --- Metrics ---
+
+HTTP_REQUESTS = Counter(
+    'vault_http_requests_total', "HTTP requests by route and status.", ('method', 'route', 'status'),
+)
+HTTP_REQUEST_DURATION = Histogram(
+    'vault_http_request_duration_seconds',
+    "Time to build the response (streamed bodies are sent afterwards).", ('method', 'route'),
+)
+HTTP_REQUEST_QUERIES = Histogram(
+    'vault_http_request_db_queries', "Database queries per request.", ('route',),
+    buckets=QUERY_COUNT_BUCKETS,
+)
+PHASE_DURATION = Histogram(
+    'vault_phase_duration_seconds', "Time spent in each phase of an upload, download or delete.",
+    ('operation', 'phase'),
+)
+UPLOADS = Counter(
+    'vault_uploads_total',
+    "Files added: 'new' content was stored, 'duplicate' content was already stored, "
+    "'claimed' files were added by hash without sending their bytes.",
+    ('result',),
+)
+UPLOAD_BYTES = Counter('vault_upload_bytes_total', "Logical bytes of the files added.", ('result',))
+DEDUP_BYTES_SAVED = Counter(
+    'vault_dedup_bytes_saved_total', "Bytes not stored again because identical content already was.",
+)
+DOWNLOADS = Counter('vault_downloads_total', "Download responses by how they are sent.", ('mode',))
+DOWNLOAD_BYTES = Counter('vault_download_bytes_total', "Body bytes of download responses.", ('mode',))
+DELETES = Counter('vault_deletes_total', "Files deleted.")
+BLOBS_REMOVED = Counter('vault_blobs_removed_total', "Blobs removed from storage with their last reference.")
+BLOB_CACHE_READS = Counter(
+    'vault_blob_cache_reads_total',
+    "Stored files opened through the local blob cache: 'hit', 'miss' (fetched from primary storage), "
+    "'coalesced' (waited for another fetch of the same file), 'bypassed' (too large to cache).",
+    ('result',),
+)
+BLOB_CACHE_FILL_BYTES = Counter('vault_blob_cache_fill_bytes_total', "Bytes copied into the blob cache.")
+BLOB_CACHE_EVICTED_BYTES = Counter('vault_blob_cache_evicted_bytes_total', "Bytes evicted from the blob cache.")
+
+
+def record_upload(file_size, is_new_blob, claimed=False):
+    """Counts one file added to the vault, and the bytes deduplication saved."""
+    result = 'claimed' if claimed else ('new' if is_new_blob else 'duplicate')
+    UPLOADS.inc(result=result)
+    UPLOAD_BYTES.inc(file_size, result=result)
+    if not is_new_blob:
+        DEDUP_BYTES_SAVED.inc(file_size)
+
+
+# --- Phase timers ---
+
+class PhaseTimer:
+    """
+    Times the phases of one operation (an upload, a download, a delete).
+    Each phase is observed in vault_phase_duration_seconds, and durations
+    collects them for the operation's log line.
+    """
+    def __init__(self, operation):
+        self.operation = operation
+        self.durations = {}
+
+    @contextmanager
+    def __call__(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - started)
+
+    def record(self, phase, seconds):
+        """Adds a phase measured elsewhere (e.g. hashing, done while the body was parsed)."""
+        self.durations[phase] = self.durations.get(phase, 0) + seconds
+        PHASE_DURATION.observe(seconds, operation=self.operation, phase=phase)
+
+    def as_ms(self):
+        return {phase: round(seconds * 1000, 3) for phase, seconds in self.durations.items()}
+
+
+class _NoTimer:
+    """Stand-in PhaseTimer for callers that do not time their phases."""
+    def __call__(self, phase):
+        return nullcontext()
+
+    def record(self, phase, seconds):
+        pass
+
+
+NO_TIMER = _NoTimer()
+
+
+# --- Snapshots shared between processes ---
+
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def _snapshot():
+    return {name: metric.snapshot() for name, metric in _registry.items()}
+
+
+def _flush_loop():
+    directory = settings.VAULT_METRICS_DIR
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    while True:
+        time.sleep(settings.VAULT_METRICS_FLUSH_INTERVAL)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(_snapshot(), f)
+            os.replace(path + '.tmp', path) # Readers never see a partial file
+        except OSError as e:
+            logger.error("Could not write metrics snapshot", extra={'path': path, 'error': str(e)})
+
+
+def start_flusher():
+    """Starts this process's snapshot writer (once per process) if VAULT_METRICS_DIR is set."""
+    global _flusher_pid
+    if not settings.VAULT_METRICS_DIR or _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher_pid != os.getpid(): # A forked child starts its own
+            os.makedirs(settings.VAULT_METRICS_DIR, exist_ok=True)
+            threading.Thread(target=_flush_loop, name='vault-metrics', daemon=True).start()
+            _flusher_pid = os.getpid()
+
+
+def _collect():
+    """{name: {label values: merged value}} over this process and the snapshots of the others."""
+    snapshots = [_snapshot()]
+    directory = settings.VAULT_METRICS_DIR
+    if directory and os.path.isdir(directory):
+        own = f'{os.getpid()}.json'
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.json') and entry.name != own:
+                try:
+                    with open(entry.path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue # Written concurrently or corrupt, skip this round
+    merged = {}
+    for snapshot in snapshots:
+        for name, samples in snapshot.items():
+            metric = _registry.get(name)
+            if metric is None:
+                continue
+            values = merged.setdefault(name, {})
+            for key, value in samples:
+                key = tuple(key)
+                values[key] = metric.merge(values.get(key), value)
+    return merged
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+    merged = _collect()
+    lines = []
+    for name, metric in _registry.items():
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.type}")
+        lines.extend(metric.render(merged.get(name, {})))
+
+    # Share of added files whose content was already stored
+    uploads = merged.get(UPLOADS.name, {})
+    added = sum(uploads.values())
+    deduplicated = added - uploads.get(('new',), 0)
+    lines.append("# HELP vault_dedup_hit_ratio Share of added files whose content was already stored.")
+    lines.append("# TYPE vault_dedup_hit_ratio gauge")
+    lines.append(f"vault_dedup_hit_ratio {_format_value(deduplicated / added if added else math.nan)}")
+
+    # Share of blob cache reads that did not fetch from primary storage
+    reads = merged.get(BLOB_CACHE_READS.name, {})
+    served = reads.get(('hit',), 0) + reads.get(('coalesced',), 0)
+    total = served + reads.get(('miss',), 0)
+    lines.append("# HELP vault_blob_cache_hit_ratio Share of cacheable reads served from the local blob cache.")
+    lines.append("# TYPE vault_blob_cache_hit_ratio gauge")
+    lines.append(f"vault_blob_cache_hit_ratio {_format_value(served / total if total else math.nan)}")
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """
+    GET /metrics for Prometheus. 404 unless VAULT_METRICS_ENABLED; with
+    VAULT_METRICS_TOKEN set, scrapers must send 'Authorization: Bearer <token>'.
+    """
+    if not metrics_enabled():
+        raise Http404("Metrics are disabled.")
+    if settings.VAULT_METRICS_TOKEN:
+        expected = f'Bearer {settings.VAULT_METRICS_TOKEN}'
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+            return HttpResponse("Unauthorized\n", status=401, content_type='text/plain')
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
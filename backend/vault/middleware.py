@@ -0,0 +1,102 @@
+# vault/middleware.py
+"""
+Request timing: how long each request took to build its response, how many
+database queries it ran, and under which route, for the metrics endpoint
+and as one structured log line per request ('vault.requests' logger).
+Only installed with VAULT_METRICS_ENABLED. Works under WSGI and ASGI
+(as an async middleware, so the async transfer views stay async).
+"""
+import contextvars
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from . import metrics
+
+logger = logging.getLogger('vault.requests')
+
+# One-item list counting the current request's queries. Context variables
+# follow the request into sync_to_async threads, so queries the view runs
+# there are counted too.
+_query_count = contextvars.ContextVar('vault_query_count', default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    counter = _query_count.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def _install_query_counter(sender, connection, **kwargs):
+    # Runs on every (re)connect of the same connection object, install once
+    if settings.VAULT_METRICS_ENABLED and _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+class RequestMetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.VAULT_METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        metrics.start_flusher()
+        # Connections opened before this module was imported (e.g. by the
+        # system checks) missed the signal
+        for connection in connections.all(initialized_only=True):
+            _install_query_counter(None, connection)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        counter, token, started = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _query_count.reset(token)
+        self._finish(request, response, counter, started)
+        return response
+
+    async def __acall__(self, request):
+        counter, token, started = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _query_count.reset(token)
+        self._finish(request, response, counter, started)
+        return response
+
+    @staticmethod
+    def _start():
+        counter = [0]
+        return counter, _query_count.set(counter), time.perf_counter()
+
+    @staticmethod
+    def _finish(request, response, counter, started):
+        elapsed = time.perf_counter() - started
+        match = request.resolver_match
+        # URL names keep the label set small (no IDs from the path)
+        route = (match.url_name or match.view_name) if match else 'unmatched'
+        metrics.HTTP_REQUESTS.inc(method=request.method, route=route, status=response.status_code)
+        metrics.HTTP_REQUEST_DURATION.observe(elapsed, method=request.method, route=route)
+        metrics.HTTP_REQUEST_QUERIES.observe(counter[0], route=route)
+        logger.info("Request", extra={
+            'method': request.method,
+            'path': request.path,
+            'route': route,
+            'status': response.status_code,
+            'duration_ms': round(elapsed * 1000, 3),
+            'db_queries': counter[0],
+        })
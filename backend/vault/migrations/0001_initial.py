@@ -0,0 +1,32 @@
+# Generated by Django 5.0.4 on 2026-10-18 05:59
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileMetadata',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('original_filename', models.CharField(max_length=255)),
+                ('file_hash', models.CharField(db_index=True, max_length=64)),
+                ('file_size', models.BigIntegerField()),
+                ('content_type', models.CharField(max_length=100)),
+                ('upload_date', models.DateTimeField(auto_now_add=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='files', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-upload_date'],
+            },
+        ),
+    ]
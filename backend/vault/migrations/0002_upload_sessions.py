@@ -0,0 +1,45 @@
+# Generated by Django 5.0.4 on 2026-10-18 05:59
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('original_filename', models.CharField(max_length=255)),
+                ('content_type', models.CharField(max_length=100)),
+                ('file_size', models.BigIntegerField()),
+                ('chunk_size', models.PositiveIntegerField()),
+                ('expected_hash', models.CharField(blank=True, max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UploadChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('size', models.PositiveIntegerField()),
+                ('chunk_hash', models.CharField(max_length=64)),
+                ('received_at', models.DateTimeField(auto_now=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='vault.uploadsession')),
+            ],
+            options={
+                'ordering': ['index'],
+                'unique_together': {('session', 'index')},
+            },
+        ),
+    ]
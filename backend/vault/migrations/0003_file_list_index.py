@@ -0,0 +1,23 @@
+# Generated by Django 5.0.4 on 2026-10-18 06:02
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault', '0002_upload_sessions'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='filemetadata',
+            options={'ordering': ['-upload_date', '-id']},
+        ),
+        migrations.AddIndex(
+            model_name='filemetadata',
+            index=models.Index(fields=['owner', '-upload_date', '-id'], name='vault_file_owner_date_id_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Data migration: build the Blob table from the existing file_hash values
+
+from django.db import migrations
+from django.db.models import Count, F, Max
+
+BATCH_SIZE = 1000
+
+
+def backfill_blobs(apps, schema_editor):
+    """
+    Creates one Blob per distinct file_hash, with ref_count set to the number
+    of FileMetadata rows using it, then points every row at its blob.
+    """
+    FileMetadata = apps.get_model('vault', 'FileMetadata')
+    Blob = apps.get_model('vault', 'Blob')
+
+    grouped = (
+        FileMetadata.objects
+        .values('file_hash')
+        .annotate(size=Max('file_size'), refs=Count('id'))
+        .order_by('file_hash')
+    )
+    batch = []
+    for row in grouped.iterator(chunk_size=BATCH_SIZE):
+        batch.append(Blob(hash=row['file_hash'], size=row['size'], ref_count=row['refs']))
+        if len(batch) >= BATCH_SIZE:
+            Blob.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        Blob.objects.bulk_create(batch)
+
+    # A single set-based UPDATE instead of one query per row
+    FileMetadata.objects.update(blob_id=F('file_hash'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault', '0004_blob'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_blobs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.4 on 2026-10-18 06:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault', '0005_backfill_blobs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='filemetadata',
+            name='blob',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='files', to='vault.blob'),
+        ),
+    ]
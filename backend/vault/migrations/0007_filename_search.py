@@ -0,0 +1,103 @@
+# PostgreSQL search indexes for the file list filters.
+#
+# - pg_trgm GIN indexes on UPPER(col) serve the icontains filters on
+#   original_filename and content_type: Django renders icontains as
+#   UPPER(col::text) LIKE UPPER('%x%'), which a plain b-tree cannot help with.
+# - A tsvector column, with '_', '-' and '.' turned into spaces so
+#   'q3_report-final.pdf' becomes the words 'q3 report final pdf', backs the
+#   ranked full-text 'search' filter. A trigger fills it in on every insert
+#   and rename.
+#
+# Built so uploads keep going while it runs on a large table. The indexes are
+# created CONCURRENTLY. The column is added nullable and without a default,
+# which only changes the catalog: a GENERATED ... STORED column would rewrite
+# the whole table under an ACCESS EXCLUSIVE lock. Existing rows are then
+# filled in batches of BACKFILL_BATCH_SIZE ids, each its own short
+# transaction, and only after that is the column's index built. The ALTER
+# TABLE and CREATE TRIGGER statements still take brief exclusive locks, so
+# they wait for (and hold up new queries behind) transactions already
+# running on the table.
+#
+# Other databases (SQLite for local development) get none of this; the
+# filters fall back to unindexed substring matching there.
+
+from django.db import migrations
+
+BACKFILL_BATCH_SIZE = 10000
+
+FILENAME_WORDS = "to_tsvector('simple', regexp_replace({}, '[_.-]+', ' ', 'g'))"
+
+BEFORE_BACKFILL_SQL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS vault_file_name_trgm_idx "
+    "ON vault_filemetadata USING gin (UPPER(original_filename::text) gin_trgm_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS vault_file_ctype_trgm_idx "
+    "ON vault_filemetadata USING gin (UPPER(content_type::text) gin_trgm_ops)",
+    "ALTER TABLE vault_filemetadata ADD COLUMN IF NOT EXISTS filename_search tsvector",
+    "CREATE OR REPLACE FUNCTION vault_filename_search_update() RETURNS trigger AS $$ "
+    "BEGIN NEW.filename_search := " + FILENAME_WORDS.format('NEW.original_filename') + "; RETURN NEW; END "
+    "$$ LANGUAGE plpgsql",
+    "DROP TRIGGER IF EXISTS vault_filename_search_trigger ON vault_filemetadata",
+    "CREATE TRIGGER vault_filename_search_trigger "
+    "BEFORE INSERT OR UPDATE OF original_filename ON vault_filemetadata "
+    "FOR EACH ROW EXECUTE FUNCTION vault_filename_search_update()",
+]
+
+AFTER_BACKFILL_SQL = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS vault_file_name_search_idx "
+    "ON vault_filemetadata USING gin (filename_search)",
+]
+
+REVERSE_SQL = [
+    "DROP INDEX CONCURRENTLY IF EXISTS vault_file_name_search_idx",
+    "DROP TRIGGER IF EXISTS vault_filename_search_trigger ON vault_filemetadata",
+    "DROP FUNCTION IF EXISTS vault_filename_search_update()",
+    "ALTER TABLE vault_filemetadata DROP COLUMN IF EXISTS filename_search",
+    "DROP INDEX CONCURRENTLY IF EXISTS vault_file_ctype_trgm_idx",
+    "DROP INDEX CONCURRENTLY IF EXISTS vault_file_name_trgm_idx",
+]
+
+
+def forward(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for statement in BEFORE_BACKFILL_SQL:
+        schema_editor.execute(statement)
+
+    # Rows inserted from here on are filled by the trigger. The others are
+    # walked by id range, so each batch is an index range scan, and every
+    # UPDATE commits on its own (the migration is not atomic).
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT MIN(id), MAX(id) FROM vault_filemetadata")
+        low, high = cursor.fetchone()
+        while low is not None and low <= high:
+            cursor.execute(
+                "UPDATE vault_filemetadata SET filename_search = " + FILENAME_WORDS.format('original_filename') +
+                " WHERE id >= %s AND id < %s AND filename_search IS NULL",
+                [low, low + BACKFILL_BATCH_SIZE],
+            )
+            low += BACKFILL_BATCH_SIZE
+
+    for statement in AFTER_BACKFILL_SQL:
+        schema_editor.execute(statement)
+
+
+def reverse(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for statement in REVERSE_SQL:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction, and the
+    # backfill commits batch by batch
+    atomic = False
+
+    dependencies = [
+        ('vault', '0006_blob_not_null'),
+    ]
+
+    operations = [
+        migrations.RunPython(forward, reverse),
+    ]
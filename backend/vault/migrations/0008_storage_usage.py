@@ -0,0 +1,71 @@
+# Generated by Django 5.0.4 on 2026-10-18 06:11
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Exists, Max, OuterRef, Sum
+
+BATCH_SIZE = 1000
+
+
+def backfill_usage(apps, schema_editor):
+    """
+    Fills the counter tables from the existing rows with grouped queries:
+    one StorageUsage per user with files, and the single VaultUsage row.
+    """
+    FileMetadata = apps.get_model('vault', 'FileMetadata')
+    Blob = apps.get_model('vault', 'Blob')
+    StorageUsage = apps.get_model('vault', 'StorageUsage')
+    VaultUsage = apps.get_model('vault', 'VaultUsage')
+
+    usage = {}
+    per_user = FileMetadata.objects.values('owner_id').annotate(
+        files=Count('id'), logical=Sum('file_size')
+    ).order_by()
+    for row in per_user.iterator(chunk_size=BATCH_SIZE):
+        usage[row['owner_id']] = StorageUsage(
+            user_id=row['owner_id'], file_count=row['files'], logical_bytes=row['logical']
+        )
+    # Each distinct (owner, blob) pair counts once towards physical bytes
+    pairs = FileMetadata.objects.values('owner_id', 'blob_id').annotate(size=Max('file_size')).order_by()
+    for row in pairs.iterator(chunk_size=BATCH_SIZE):
+        usage[row['owner_id']].physical_bytes += row['size']
+    StorageUsage.objects.bulk_create(usage.values(), batch_size=BATCH_SIZE)
+
+    referenced = Blob.objects.filter(Exists(FileMetadata.objects.filter(blob_id=OuterRef('pk'))))
+    totals = referenced.aggregate(blobs=Count('hash'), size=Sum('size'))
+    VaultUsage.objects.create(pk=1, blob_count=totals['blobs'], physical_bytes=totals['size'] or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('vault', '0007_filename_search'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageUsage',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='storage_usage', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('file_count', models.BigIntegerField(default=0)),
+                ('logical_bytes', models.BigIntegerField(default=0)),
+                ('physical_bytes', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='VaultUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('blob_count', models.BigIntegerField(default=0)),
+                ('physical_bytes', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='filemetadata',
+            index=models.Index(fields=['owner', 'blob'], name='vault_file_owner_blob_idx'),
+        ),
+        migrations.RunPython(backfill_usage, migrations.RunPython.noop),
+    ]
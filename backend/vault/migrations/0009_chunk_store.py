@@ -0,0 +1,56 @@
+# Generated by Django 5.0.4 on 2026-10-18 06:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault', '0008_storage_usage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Chunk',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('size', models.PositiveIntegerField()),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='blob',
+            name='chunked',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='vaultusage',
+            name='chunk_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='vaultusage',
+            name='chunk_count',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='vaultusage',
+            name='chunked_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='BlobChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('offset', models.BigIntegerField()),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='manifest', to='vault.blob')),
+                ('chunk', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='vault.chunk')),
+            ],
+            options={
+                'ordering': ['blob', 'offset'],
+                'unique_together': {('blob', 'offset')},
+            },
+        ),
+    ]
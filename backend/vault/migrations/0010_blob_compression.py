@@ -0,0 +1,28 @@
+# Generated by Django 5.0.4 on 2026-10-18 06:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault', '0009_chunk_store'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='codec',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='blob',
+            name='stored_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='vaultusage',
+            name='compression_saved_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.4 on 2026-10-18 06:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault', '0010_blob_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storageusage',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
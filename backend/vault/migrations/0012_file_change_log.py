@@ -0,0 +1,30 @@
+# Generated by Django 5.0.4 on 2026-10-18 06:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault', '0011_storage_usage_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField()),
+                ('file_id', models.BigIntegerField()),
+                ('action', models.CharField(choices=[('created', 'Created'), ('deleted', 'Deleted')], max_length=7)),
+                ('changed_at', models.DateTimeField(auto_now_add=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='file_changes', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner', 'version', 'id'], name='vault_change_owner_ver_idx')],
+            },
+        ),
+    ]
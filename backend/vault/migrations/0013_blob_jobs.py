@@ -0,0 +1,39 @@
+# Generated by Django 5.0.4 on 2026-10-18 07:15
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault', '0012_file_change_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='detected_type',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.CreateModel(
+            name='BlobJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=32)),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=7)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('claimed_by', models.CharField(blank=True, max_length=100)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='vault.blob')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('state__in', ['pending', 'running'])), fields=['run_after'], name='vault_job_due_idx')],
+                'unique_together': {('blob', 'kind')},
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.4 on 2026-10-18 07:33
+
+import vault.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault', '0013_blob_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True, default=vault.models.session_expiry),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.4 on 2026-10-18 07:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault', '0014_upload_session_expiry'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='filechange',
+            name='action',
+            field=models.CharField(choices=[('created', 'Created'), ('updated', 'Updated'), ('deleted', 'Deleted')], max_length=7),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.4 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault', '0015_file_change_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='finalizing',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,8 +1,104 @@
 # vault/models.py
+import uuid
+from datetime import timedelta
+
 from django.db import models
 from django.conf import settings # To get the User model
+from django.utils import timezone
 
 # Create your models here.
+class Blob(models.Model):
+    """
+    One physically stored file content, keyed by its SHA-256.
+    ref_count is the number of FileMetadata rows pointing at it; it is only
+    changed with row-level locks (see vault/services.py), and the stored file
+    is removed together with the row when the last reference goes away.
+    """
+    # SHA-256 of the content, also its storage key ('uploads/<hash>')
+    hash = models.CharField(max_length=64, primary_key=True)
+
+    # Size of the content in bytes
+    size = models.BigIntegerField()
+
+    # Number of FileMetadata records referencing this blob
+    ref_count = models.PositiveIntegerField(default=0)
+
+    # True if the content is kept in the chunk store (see BlobChunk) instead
+    # of as a single file under 'uploads/'
+    chunked = models.BooleanField(default=False)
+
+    # Compression of the stored file ('gzip', 'zstd'), empty if stored as is.
+    # See vault/compression.py; hash and size always describe the original.
+    codec = models.CharField(max_length=16, blank=True, default='')
+
+    # Bytes the file takes up in 'uploads/' (null for blobs stored before
+    # this was recorded, which are uncompressed: stored_size == size)
+    stored_size = models.BigIntegerField(null=True, blank=True)
+
+    # MIME type sniffed from the content by a background job (vault/jobs.py),
+    # empty until it has run. Clients only declare content_type.
+    detected_type = models.CharField(max_length=100, blank=True, default='')
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        """String representation of the model."""
+        return f"Blob {self.hash[:8]}... ({self.size} bytes, {self.ref_count} refs)"
+
+
+class Chunk(models.Model):
+    """
+    A piece of blob content cut by content-defined chunking (vault/chunking.py),
+    stored once under its own SHA-256 ('chunks/<hash>'). ref_count is the
+    number of BlobChunk entries using it, maintained under row locks like
+    Blob.ref_count; the chunk is removed when it drops to zero.
+    """
+    hash = models.CharField(max_length=64, primary_key=True)
+
+    # Size of the chunk in bytes
+    size = models.PositiveIntegerField()
+
+    # Number of BlobChunk entries referencing this chunk
+    ref_count = models.PositiveIntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        """String representation of the model."""
+        return f"Chunk {self.hash[:8]}... ({self.size} bytes, {self.ref_count} refs)"
+
+
+class BlobChunk(models.Model):
+    """
+    One entry of a chunked blob's manifest: the chunk holding the blob's bytes
+    from offset on. Reading the entries in offset order reassembles the blob.
+    Every FileMetadata pointing at the blob shares its manifest.
+    """
+    blob = models.ForeignKey(
+        Blob,
+        on_delete=models.CASCADE, # The manifest goes with the blob
+        related_name='manifest'
+    )
+    # Position of the chunk's first byte within the blob
+    offset = models.BigIntegerField()
+
+    # PROTECT: a chunk can only go away through its reference count
+    chunk = models.ForeignKey(
+        Chunk,
+        on_delete=models.PROTECT,
+        related_name='+'
+    )
+
+    def __str__(self):
+        """String representation of the model."""
+        return f"Chunk {self.chunk_id[:8]}... at {self.offset} of blob {self.blob_id[:8]}..."
+
+    class Meta:
+        ordering = ['blob', 'offset']
+        # Also serves reads: WHERE blob = ? AND offset <= ? ORDER BY offset
+        unique_together = ('blob', 'offset')
+
+
 class FileMetadata(models.Model):
     """
     Stores metadata about uploaded files, handling deduplication via file_hash.
@@ -19,6 +115,14 @@ class FileMetadata(models.Model):
     # SHA-256 hash of the file content, used for deduplication
     # Indexed for faster lookups during upload and deletion checks
     file_hash = models.CharField(max_length=64, db_index=True)
+
+    # The stored content this record points at (same value as file_hash).
+    # PROTECT: a blob can only go away through its reference count.
+    blob = models.ForeignKey(
+        Blob,
+        on_delete=models.PROTECT,
+        related_name='files'
+    )
     
     # Size of the file in bytes
     file_size = models.BigIntegerField()
@@ -39,8 +143,246 @@ class FileMetadata(models.Model):
 
     class Meta:
         # Optional: Add ordering if desired
-        ordering = ['-upload_date'] 
+        ordering = ['-upload_date', '-id']
+        indexes = [
+            # Serves the per-user file list and its keyset pagination
+            # (WHERE owner = ? AND (upload_date, id) < cursor ORDER BY upload_date DESC, id DESC)
+            models.Index(fields=['owner', '-upload_date', '-id'], name='vault_file_owner_date_id_idx'),
+            # "Does this user already reference this blob?" when usage counters change
+            models.Index(fields=['owner', 'blob'], name='vault_file_owner_blob_idx'),
+        ]
         # Optional: Ensure a user cannot upload the exact same original filename twice?
         # Usually not needed as hash handles content duplication.
         # unique_together = ('owner', 'original_filename') 
 
+
+
+def session_expiry():
+    """Expiry time of an upload session that sees activity now."""
+    return timezone.now() + timedelta(seconds=settings.VAULT_UPLOAD_SESSION_TTL)
+
+
+class UploadSession(models.Model):
+    """
+    A resumable upload in progress. The client sends the file as numbered,
+    independently retryable chunks, which are written in place into a
+    preallocated part file until the session is finalized.
+    Sessions without a chunk for VAULT_UPLOAD_SESSION_TTL seconds expire;
+    'manage.py vault_expire_uploads' deletes them and their part files.
+    """
+    # Random ID so sessions cannot be guessed or enumerated
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='upload_sessions'
+    )
+    # Metadata the final FileMetadata record is created with
+    original_filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    file_size = models.BigIntegerField()
+
+    # Every chunk is exactly chunk_size bytes, except possibly the last one
+    chunk_size = models.PositiveIntegerField()
+
+    # Optional SHA-256 declared by the client, checked on finalize
+    expected_hash = models.CharField(max_length=64, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Pushed back by every chunk received
+    expires_at = models.DateTimeField(default=session_expiry, db_index=True)
+    # Set (under the row lock) once finalize starts hashing the part file;
+    # from then on no chunk may be written into it
+    finalizing = models.BooleanField(default=False)
+
+    def __str__(self):
+        """String representation of the model."""
+        return f"Upload {self.id} of {self.original_filename} (Owner: {self.owner.username})"
+
+    @property
+    def total_chunks(self):
+        """Number of chunks needed to cover file_size."""
+        return -(-self.file_size // self.chunk_size) # Ceiling division
+
+    def chunk_bounds(self, index):
+        """Returns (offset, length) of the chunk with the given index."""
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.file_size - offset)
+
+
+class UploadChunk(models.Model):
+    """
+    Records a chunk of an UploadSession that was received and verified.
+    Re-sending a chunk simply overwrites the previous attempt.
+    """
+    session = models.ForeignKey(
+        UploadSession,
+        on_delete=models.CASCADE,
+        related_name='chunks'
+    )
+    index = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()
+    # SHA-256 of this chunk's bytes, as verified on receipt
+    chunk_hash = models.CharField(max_length=64)
+    received_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        """String representation of the model."""
+        return f"Chunk {self.index} of upload {self.session_id}"
+
+    class Meta:
+        ordering = ['index']
+        unique_together = ('session', 'index')
+
+
+class StorageUsage(models.Model):
+    """
+    Running storage totals for one user, kept in step with their FileMetadata
+    rows in the same transaction (see vault/usage.py), so reading them is a
+    primary key lookup instead of an aggregate over every file.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='storage_usage'
+    )
+    # Number of FileMetadata records owned by the user
+    file_count = models.BigIntegerField(default=0)
+
+    # Sum of file_size over those records, duplicates included
+    logical_bytes = models.BigIntegerField(default=0)
+
+    # Sum of the sizes of the distinct blobs the user references
+    physical_bytes = models.BigIntegerField(default=0)
+
+    # Bumped by every change to the user's files, in the same transaction.
+    # Keys the cached file list responses (vault/listcache.py) and orders the
+    # user's change log (FileChange.version).
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        """String representation of the model."""
+        return f"Usage of user {self.user_id}: {self.file_count} files, {self.logical_bytes} bytes"
+
+
+class VaultUsage(models.Model):
+    """
+    Running totals over all referenced blobs and chunks. A single row (pk=1),
+    only written when a blob or chunk gains its first reference or loses its
+    last one, so duplicate uploads never touch it.
+    """
+    blob_count = models.BigIntegerField(default=0)
+
+    # Sum of Blob.size: the size of all unique content
+    physical_bytes = models.BigIntegerField(default=0)
+
+    # Part of physical_bytes held by chunked blobs. The chunk store keeps
+    # these in chunk_bytes instead, so the chunk dedup ratio is
+    # chunked_bytes / chunk_bytes.
+    chunked_bytes = models.BigIntegerField(default=0)
+
+    # Chunks referenced by at least one manifest, and the sum of their sizes
+    chunk_count = models.BigIntegerField(default=0)
+    chunk_bytes = models.BigIntegerField(default=0)
+
+    # Sum of size - stored_size over compressed blobs
+    compression_saved_bytes = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        """String representation of the model."""
+        return f"Vault usage: {self.blob_count} blobs, {self.physical_bytes} bytes"
+
+
+class BlobJob(models.Model):
+    """
+    Background work on one blob (vault/jobs.py), queued in the transaction
+    that stores new content and run by 'manage.py vault_worker'. Unique per
+    blob and kind, so content shared by any number of files is processed
+    once; the row goes away with the blob.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATE_CHOICES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    blob = models.ForeignKey(
+        Blob,
+        on_delete=models.CASCADE, # Nothing left to process
+        related_name='jobs'
+    )
+    # Name of the handler to run, see vault/jobs.py
+    kind = models.CharField(max_length=32)
+
+    state = models.CharField(max_length=7, choices=STATE_CHOICES, default=PENDING)
+
+    # Pending: when to (re)try. Running: when the worker's lease expires and
+    # another worker may take the job over (the first one presumably died).
+    run_after = models.DateTimeField(default=timezone.now)
+
+    # Times the job was claimed so far
+    attempts = models.PositiveIntegerField(default=0)
+
+    # Worker holding the job ('host:pid'), with attempts the claim token
+    claimed_by = models.CharField(max_length=100, blank=True)
+
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        """String representation of the model."""
+        return f"Job {self.kind} on blob {self.blob_id[:8]}... ({self.state}, {self.attempts} attempts)"
+
+    class Meta:
+        unique_together = ('blob', 'kind')
+        indexes = [
+            # Serves the claim query; finished jobs stay out of the index
+            models.Index(
+                fields=['run_after'],
+                condition=models.Q(state__in=['pending', 'running']),
+                name='vault_job_due_idx',
+            ),
+        ]
+
+
+class FileChange(models.Model):
+    """
+    Append-only log of the files created, updated and deleted per owner,
+    written in the same transaction as the change (see vault/changes.py),
+    so sync clients fetch what changed since their cursor instead of the
+    whole file list.
+    """
+    CREATED = 'created'
+    # Metadata set after the upload, e.g. the sniffed type (vault/jobs.py)
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+    ACTION_CHOICES = [(CREATED, 'Created'), (UPDATED, 'Updated'), (DELETED, 'Deleted')]
+
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='file_changes'
+    )
+    # The owner's StorageUsage.version after the change. All changes of one
+    # transaction share it, and the owner's row lock makes versions commit
+    # in order, so no change can appear behind a cursor already handed out.
+    version = models.BigIntegerField()
+
+    # FileMetadata ID; not a foreign key, deleted files stay in the log
+    file_id = models.BigIntegerField()
+
+    action = models.CharField(max_length=7, choices=ACTION_CHOICES)
+
+    changed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Serves "changes of this owner after (version, id)"
+            models.Index(fields=['owner', 'version', 'id'], name='vault_change_owner_ver_idx'),
+        ]
+
+    def __str__(self):
+        """String representation of the model."""
+        return f"File {self.file_id} {self.action} (owner {self.owner_id}, version {self.version})"
@@ -0,0 +1,117 @@
+# vault/pagination.py
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class FileKeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination over (upload_date, id), newest first, or over
+    (search_rank, id) when the search filter ranked the results.
+
+    Each page continues strictly after the last row of the previous one using
+    a WHERE clause on the sort key, instead of OFFSET. With the composite
+    (owner, upload_date DESC, id DESC) index the cost of a page is the same
+    whether it is the first or the ten-thousandth. The cursor is opaque to
+    clients; they just follow the 'next' link.
+
+    The 'next' link is relative (path and query string), resolved by clients
+    against the URL they requested. An absolute link would carry whatever
+    host the request arrived with: behind a proxy that is not necessarily
+    the one the client used, and cached pages (vault/listcache.py) would
+    hand the first client's host to everyone.
+    """
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.get_full_path()
+
+        field = self.get_ordering_field(queryset)
+        queryset = queryset.order_by(f'-{field}', '-id')
+        position = self.decode_cursor(request, field)
+        if position is not None:
+            value, pk = position
+            # The leading <= bound lets the index seek directly to the
+            # cursor, the OR only breaks ties between equal sort values.
+            queryset = queryset.filter(
+                Q(**{f'{field}__lte': value})
+                & (Q(**{f'{field}__lt': value}) | Q(id__lt=pk))
+            )
+
+        # Fetch one extra row to find out whether another page follows
+        page = list(queryset[:self.page_size + 1])
+        self.has_next = len(page) > self.page_size
+        page = page[:self.page_size]
+        self.next_position = (field, getattr(page[-1], field), page[-1].pk) if self.has_next else None
+        return page
+
+    def get_ordering_field(self, queryset):
+        """Relevance if the search filter ranked the results, otherwise upload date."""
+        if 'search_rank' in queryset.query.annotations:
+            return 'search_rank'
+        return 'upload_date'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return replace_query_param(
+            self.base_url, self.cursor_query_param, self.encode_cursor(self.next_position)
+        )
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri-reference'},
+                'results': schema,
+            },
+        }
+
+    def encode_cursor(self, position):
+        field, value, pk = position
+        value = value.isoformat() if field == 'upload_date' else repr(value)
+        raw = f"{field}|{value}|{pk}"
+        return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, request, field):
+        """Returns (value, id) from the request's cursor, or None on the first page."""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            cursor_field, value, pk = raw.split('|')
+            if cursor_field != field:
+                raise ValueError("Cursor was issued for a different ordering")
+            if field == 'upload_date':
+                value = datetime.fromisoformat(value)
+            else:
+                value = float(value)
+            return value, int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
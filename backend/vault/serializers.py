@@ -1,16 +1,30 @@
 # vault/serializers.py
 from rest_framework import serializers
-from .models import FileMetadata
+from django.conf import settings
+from .downloads import is_valid_media_type
+from .models import FileChange, FileMetadata, UploadSession
 from django.contrib.auth import get_user_model # Import user model helper
 
 User = get_user_model() # Get the active User model
 
+
+def validate_content_type(value):
+    """Content types are sent back in download headers, so they must be valid media types."""
+    if value and not is_valid_media_type(value):
+        raise serializers.ValidationError("Must be a media type such as 'text/plain'.")
+    return value
+
+
 class FileMetadataSerializer(serializers.ModelSerializer):
     """
     Serializer for the FileMetadata model.
     Handles conversion between model instances and JSON representation for the API.
     Defines which fields are read-only (set by server logic).
     """
+    # MIME type sniffed from the content in the background (vault/jobs.py),
+    # empty until then. Query with select_related('blob').
+    detected_type = serializers.CharField(source='blob.detected_type', read_only=True)
+
     class Meta:
         model = FileMetadata
         # These are the fields that will be included in the API JSON representation (output)
@@ -21,6 +35,7 @@ class FileMetadataSerializer(serializers.ModelSerializer):
             'file_hash',         # Hash (read-only, set by view)
             'file_size',         # Size (read-only, set by view)
             'content_type',      # Type (read-only, set by view)
+            'detected_type',     # Sniffed type (read-only, set by a background job)
             'upload_date',       # Upload date (read-only, set by model)
         ]
         # Mark all fields that are set by the server/view logic,
@@ -34,6 +49,148 @@ class FileMetadataSerializer(serializers.ModelSerializer):
             'content_type',      # Derived from uploaded file in perform_create
         ]
 
+# --- Change Log ---
+class FileChangeSerializer(serializers.ModelSerializer):
+    """
+    One entry of a user's change log. 'file' carries the metadata of created
+    or updated files that still exist (null for deletions and for files
+    deleted since), looked up in the 'files' dict ({id: FileMetadata}) of
+    the context.
+    """
+    file = serializers.SerializerMethodField()
+
+    class Meta:
+        model = FileChange
+        fields = ['action', 'file_id', 'changed_at', 'file']
+
+    def get_file(self, change):
+        instance = self.context['files'].get(change.file_id) if change.action != FileChange.DELETED else None
+        return FileMetadataSerializer(instance).data if instance else None
+
+# --- Hash-First Upload Claim ---
+class FileClaimSerializer(serializers.Serializer):
+    """
+    Validates a hash-first upload probe: the client describes a file by its
+    SHA-256 and size before sending any bytes. The second request of a claim
+    also carries the challenge it was given and its proofs, the SHA-256 of
+    each challenged byte range (see vault/claims.py).
+    """
+    sha256 = serializers.RegexField(r'^[0-9a-f]{64}$', help_text="Lowercase hex SHA-256 of the file content")
+    size = serializers.IntegerField(min_value=0)
+    filename = serializers.CharField(max_length=255)
+    content_type = serializers.CharField(
+        max_length=100, required=False, default='application/octet-stream', validators=[validate_content_type]
+    )
+    challenge = serializers.CharField(required=False)
+    proofs = serializers.ListField(
+        child=serializers.RegexField(r'^[0-9a-f]{64}$'), required=False, max_length=16
+    )
+
+    def validate(self, data):
+        if ('challenge' in data) != ('proofs' in data):
+            raise serializers.ValidationError("Send 'challenge' and 'proofs' together.")
+        return data
+
+# --- Bulk Delete ---
+class BulkDeleteSerializer(serializers.Serializer):
+    """
+    Selects the files for a bulk delete: either explicit IDs, or a filter
+    expression using the same parameters as the file list
+    (e.g. {"content_type": "image", "file_size_max": 1024}).
+    """
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        required=False,
+        allow_empty=False,
+        max_length=settings.VAULT_BULK_MAX_ITEMS,
+    )
+    filter = serializers.DictField(required=False, allow_empty=False)
+
+    def validate(self, data):
+        if ('ids' in data) == ('filter' in data):
+            raise serializers.ValidationError("Provide either 'ids' or 'filter'.")
+        return data
+
+# --- Resumable Upload Sessions ---
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """
+    Serializer for resumable upload sessions.
+    On output it reports which chunks have been received so a client can
+    resume by sending only the missing ones.
+    """
+    chunk_size = serializers.IntegerField(required=False)
+    expected_hash = serializers.RegexField(r'^[0-9a-f]{64}$', required=False)
+    total_chunks = serializers.IntegerField(read_only=True)
+    received_chunks = serializers.SerializerMethodField()
+    received_ranges = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = [
+            'id',
+            'original_filename',
+            'content_type',
+            'file_size',
+            'chunk_size',       # Defaults to VAULT_UPLOAD_CHUNK_SIZE
+            'expected_hash',    # Optional whole-file SHA-256, verified on finalize
+            'created_at',
+            'expires_at',       # Pushed back by every chunk received
+            'finalizing',       # Chunks are refused while set
+            'total_chunks',
+            'received_chunks',  # Indexes of chunks already stored
+            'received_ranges',  # Same, as merged [start, end) byte ranges
+        ]
+        read_only_fields = ['id', 'created_at', 'expires_at', 'finalizing']
+
+    def validate_content_type(self, value):
+        return validate_content_type(value)
+
+    def validate_file_size(self, value):
+        if value < 0:
+            raise serializers.ValidationError("File size cannot be negative.")
+        if value > settings.VAULT_UPLOAD_MAX_FILE_SIZE:
+            raise serializers.ValidationError(
+                f"File size cannot exceed {settings.VAULT_UPLOAD_MAX_FILE_SIZE} bytes."
+            )
+        return value
+
+    def validate_chunk_size(self, value):
+        if value < settings.VAULT_UPLOAD_MIN_CHUNK_SIZE:
+            raise serializers.ValidationError(
+                f"Chunk size must be at least {settings.VAULT_UPLOAD_MIN_CHUNK_SIZE} bytes."
+            )
+        if value > settings.VAULT_UPLOAD_MAX_CHUNK_SIZE:
+            raise serializers.ValidationError(
+                f"Chunk size cannot exceed {settings.VAULT_UPLOAD_MAX_CHUNK_SIZE} bytes."
+            )
+        return value
+
+    def validate(self, data):
+        """
+        Caps the number of chunks: finalize and the status output walk
+        every one of them.
+        """
+        chunk_size = data.get('chunk_size') or settings.VAULT_UPLOAD_CHUNK_SIZE
+        if -(-data['file_size'] // chunk_size) > settings.VAULT_UPLOAD_MAX_CHUNKS:
+            raise serializers.ValidationError({'chunk_size': (
+                f"A file of {data['file_size']} bytes needs a chunk size of at least "
+                f"{-(-data['file_size'] // settings.VAULT_UPLOAD_MAX_CHUNKS)} bytes."
+            )})
+        return data
+
+    def get_received_chunks(self, obj):
+        return [chunk.index for chunk in obj.chunks.all()]
+
+    def get_received_ranges(self, obj):
+        ranges = []
+        for chunk in obj.chunks.all():
+            start, length = obj.chunk_bounds(chunk.index)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = start + length # Extend the contiguous range
+            else:
+                ranges.append([start, start + length])
+        return ranges
+
 # --- User Serializer for Registration ---
 class UserSerializer(serializers.ModelSerializer):
     """
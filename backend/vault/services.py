@@ -0,0 +1,574 @@
+# vault/services.py
+"""
+Blob reference counting. Every change to Blob.ref_count goes through these
+functions, which must run inside transaction.atomic(): the Blob row is
+locked with SELECT ... FOR UPDATE, so concurrent uploads and deletes of the
+same content are serialized and a blob file is never removed while a new
+reference to it is being created. Blobs gaining their first reference or
+losing their last one are also counted in the vault-wide usage totals here
+(vault/usage.py), and the former get their background jobs queued
+(vault/jobs.py).
+
+Chunked blobs (VAULT_STORAGE_ENGINE = 'chunks') keep their content in the
+chunk store, whose Chunk.ref_count is maintained the same way, one level
+down: Chunk rows are only locked while their blobs are, always after them,
+and always before the VaultUsage row.
+
+Chunking and compression of new content are slow (pure-Python FastCDC,
+gzip/zstd), so they run on the temp file before any lock is taken, see
+prepare_content(). The locked part only moves the results into place.
+"""
+import hashlib
+import itertools
+import logging
+import os
+from collections import Counter, defaultdict
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+
+from .blobstore import BLOBS, CHUNKS, get_blob_store
+from .chunkstore import ChunkedBlobReader, read_manifest, should_chunk, write_manifest
+from .compression import (
+    CODEC_MAGIC, COPY_BLOCK_SIZE, MAX_COMPRESSED_RATIO, DecompressingReader, choose_codec, compress_file,
+)
+from .jobs import enqueue_blob_jobs
+from .metrics import NO_TIMER
+from .models import Blob, BlobChunk, Chunk, FileMetadata
+from .storage import create_temp_file
+from .usage import (
+    count_blobs_added, count_blobs_removed, count_chunks_added, count_chunks_removed, count_files_removed,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def open_blob(blob):
+    """
+    Opens a blob's original content for reading, however it is stored
+    (chunked, compressed or whole). The returned file object is seekable.
+    Raises OSError if the content is missing.
+    """
+    if blob.chunked:
+        return ChunkedBlobReader(blob)
+    if blob.codec:
+        return DecompressingReader(lambda: open_stored_blob(blob), blob.codec, blob.size)
+    return open_stored_blob(blob)
+
+
+def open_stored_blob(blob):
+    """Opens a blob file as stored, i.e. still compressed if blob.codec is set."""
+    return get_blob_store().open(BLOBS, blob.hash)
+
+
+def _lock_or_create_blob(file_hash, size):
+    """Returns the locked Blob row for file_hash, creating it if needed."""
+    blob = Blob.objects.select_for_update().filter(hash=file_hash).first()
+    if blob is not None:
+        return blob
+    try:
+        # Savepoint, so a lost creation race does not abort the outer transaction
+        with transaction.atomic():
+            return Blob.objects.create(hash=file_hash, size=size, ref_count=0)
+    except IntegrityError:
+        # A concurrent upload created it first: wait for its lock
+        return Blob.objects.select_for_update().get(hash=file_hash)
+
+
+# --- Preparing new content ---
+
+class PreparedContent:
+    """
+    Work done on an upload's temp file before its blob is locked: the chunk
+    manifest file (manifest_path), or the codec chosen for it ('' for none,
+    None if not decided yet) and the compressed copy (compressed_path).
+    Use it as a context manager around the transaction that stores the
+    content: files the transaction did not move into storage are deleted
+    on exit.
+    """
+
+    def __init__(self):
+        self.manifest_path = None
+        self.codec = None
+        self.compressed_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.discard()
+
+    def discard(self):
+        for path in (self.manifest_path, self.compressed_path):
+            if path:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        self.manifest_path = self.compressed_path = None
+
+
+def prepare_content(file_hash, size, temp_path, content_type='', timer=NO_TIMER):
+    """
+    Chunks or compresses the content of temp_path, as acquire_blob would if
+    it turns out new, without holding any lock. Call it right before the
+    transaction that calls acquire_blob(..., prepared=...), so a 1 GB upload
+    holds the Blob row lock for a file move instead of minutes of chunking.
+
+    Content the vault already stores is left alone (checked again under
+    the lock). This is only a head start: if it fails, or the blob changed
+    meanwhile, acquire_blob does the missing work itself and reports errors
+    as usual. timer gets the 'prepare' phase.
+    """
+    prepared = PreparedContent()
+    if Blob.objects.filter(hash=file_hash, ref_count__gt=0).exists():
+        return prepared # A duplicate, nothing new to store
+    with timer('prepare'):
+        try:
+            if should_chunk(size):
+                prepared.manifest_path = write_manifest(temp_path)
+            else:
+                _compress_new_content(prepared, temp_path, content_type, size)
+        except OSError as e:
+            prepared.discard()
+            prepared.codec = None
+            logger.warning("Could not prepare content, storing it under the lock", extra={
+                'hash': file_hash, 'error': str(e),
+            })
+    return prepared
+
+
+@contextmanager
+def prepare_contents(uploads):
+    """
+    prepare_content for a batch, as a context manager around the transaction
+    that calls acquire_blobs(..., prepared=...). uploads is a list of
+    (file_hash, size, temp_path, content_type); yields {hash: PreparedContent}.
+    """
+    with ExitStack() as stack:
+        prepared = {}
+        for file_hash, size, temp_path, content_type in uploads:
+            if file_hash not in prepared:
+                prepared[file_hash] = stack.enter_context(
+                    prepare_content(file_hash, size, temp_path, content_type)
+                )
+        yield prepared
+
+
+def _compress_new_content(prepared, temp_path, content_type, size):
+    """Chooses the codec for new content and compresses it into prepared."""
+    codec = choose_codec(content_type, temp_path, size)
+    if codec:
+        compressed_path = compress_file(temp_path, codec)
+        if os.path.getsize(compressed_path) > size * MAX_COMPRESSED_RATIO:
+            # The sample was misleading, the content barely compresses
+            os.remove(compressed_path)
+            codec = ''
+        else:
+            prepared.compressed_path = compressed_path
+    prepared.codec = codec
+
+
+# --- Blob references ---
+
+def acquire_blob(file_hash, size, temp_path, content_type='', timer=NO_TIMER, prepared=None):
+    """
+    Adds a reference to the blob for file_hash, storing its content if needed.
+
+    temp_path is a fully written temp file with that content; it is moved
+    into storage if the blob is not stored yet, or dropped otherwise.
+    content_type helps decide whether new content is worth compressing.
+    prepared is the PreparedContent from prepare_content(), if it was called.
+    timer (a metrics.PhaseTimer) gets the 'dedup_lookup' and 'blob_write' phases.
+    Returns (blob, is_new_blob).
+    """
+    with timer('dedup_lookup'):
+        blob = _lock_or_create_blob(file_hash, size)
+    # Done under the row lock, so a concurrent release of the last reference
+    # cannot delete the content between storing it and our ref_count increment.
+    with timer('blob_write'), ExitStack() as stack:
+        if prepared is None:
+            prepared = stack.enter_context(PreparedContent())
+        is_new_blob = file_hash in _store_contents([(blob, temp_path, content_type, prepared)])
+        if blob.ref_count == 0:
+            enqueue_blob_jobs([blob])
+            count_blobs_added([blob])
+        Blob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+    return blob, is_new_blob
+
+
+def claim_blob(file_hash, size):
+    """
+    Adds a reference to an already stored blob without receiving its content.
+    Returns the Blob, or None if no blob with this hash and size exists.
+    The caller must have checked that the user may have the content: they
+    own it already, or proved they hold it (vault/claims.py).
+    """
+    blob = Blob.objects.select_for_update().filter(hash=file_hash, size=size).first()
+    if blob is None:
+        return None
+    if blob.ref_count == 0:
+        enqueue_blob_jobs([blob])
+        count_blobs_added([blob])
+    Blob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+    return blob
+
+
+def release_blob(file_hash):
+    """
+    Drops a reference to a blob. The FileMetadata row must already be deleted.
+    When the last reference goes, the Blob row and the stored file are removed
+    in the same transaction. Returns True if the blob was removed.
+    """
+    blob = Blob.objects.select_for_update().get(hash=file_hash)
+    if blob.ref_count > 1:
+        Blob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') - 1)
+        return False
+
+    _remove_blobs([blob])
+    return True
+
+
+def _store_contents(items):
+    """
+    Stores the content of locked blobs from their temp files. items is a list
+    of (blob, temp_path, content_type, prepared), one per distinct blob. Each
+    temp file is dropped if the content is already stored, or else split into
+    the chunk store (new content, 'chunks' engine) or moved to the blob store,
+    compressed if worthwhile, reusing the PreparedContent where it applies.
+    Returns the set of hashes whose content was not stored before.
+    """
+    stored, to_chunk = set(), []
+    for blob, temp_path, content_type, prepared in items:
+        if blob.chunked:
+            os.remove(temp_path) # Identical content is already stored
+            continue
+        found = get_blob_store().exists(BLOBS, blob.hash)
+        if found and (blob.ref_count > 0 or _adopt_stored_file(blob)):
+            os.remove(temp_path) # Identical content is already stored
+        elif blob.ref_count == 0 and should_chunk(blob.size):
+            if found:
+                _delete_stored_file(BLOBS, blob.hash) # Not this content, see _adopt_stored_file
+            if prepared.manifest_path is None:
+                prepared.manifest_path = write_manifest(temp_path) # Not prepared ahead
+            to_chunk.append((blob, temp_path, prepared.manifest_path))
+        else:
+            _store_file(blob, temp_path, content_type, prepared, replace=found)
+            stored.add(blob.hash)
+    if to_chunk:
+        _store_chunked(to_chunk)
+        stored.update(blob.hash for blob, _, _ in to_chunk)
+    return stored
+
+
+def _adopt_stored_file(blob):
+    """
+    Checks a file found at the path of a locked blob without references,
+    e.g. one stored by an upload whose transaction then rolled back, or left
+    behind by a failed delete. Nothing says how it is stored, so it is read
+    back under each codec its first bytes allow (and as is), and the blob
+    records the one that yields its content. Returns False if none does, or
+    the file cannot be read: it must then be replaced.
+    """
+    try:
+        with open_stored_blob(blob) as stored:
+            head = b''
+            while len(head) < 4: # Raw streams may return fewer bytes per read
+                block = stored.read(4 - len(head))
+                if not block:
+                    break
+                head += block
+    except OSError:
+        return False
+
+    for codec in [name for name, magic in CODEC_MAGIC.items() if head.startswith(magic)] + ['']:
+        try:
+            reader = (
+                DecompressingReader(lambda: open_stored_blob(blob), codec, blob.size) if codec
+                else open_stored_blob(blob)
+            )
+            hasher, size = hashlib.sha256(), 0
+            with reader:
+                for block in iter(lambda: reader.read(COPY_BLOCK_SIZE), b''):
+                    hasher.update(block)
+                    size += len(block)
+        except Exception as e: # Unreadable, or not a valid stream of this codec
+            logger.warning("Stored file is unreadable as codec", extra={
+                'hash': blob.hash, 'codec': codec, 'error': f"{type(e).__name__}: {e}",
+            })
+            continue
+        if size == blob.size and hasher.hexdigest() == blob.hash:
+            store = get_blob_store()
+            stored_size = store.backend.size(store.locate(BLOBS, blob.hash))
+            Blob.objects.filter(pk=blob.pk).update(codec=codec, stored_size=stored_size)
+            blob.codec, blob.stored_size = codec, stored_size
+            logger.info("Adopted stored file", extra={'hash': blob.hash, 'codec': codec})
+            return True
+    logger.warning("Replacing stored file that does not hold its content", extra={'hash': blob.hash})
+    return False
+
+
+def _store_file(blob, temp_path, content_type, prepared, replace=False):
+    """
+    Moves a locked blob's temp file to the blob store, or its compressed copy
+    if compressing is worthwhile (prepared ahead, or done here otherwise).
+    replace overwrites a file already stored at its path.
+    """
+    if blob.ref_count == 0:
+        if prepared.codec is None:
+            _compress_new_content(prepared, temp_path, content_type, blob.size)
+        codec = prepared.codec
+    else:
+        codec = blob.codec # Restoring a missing file: keep the recorded format
+        if codec and prepared.codec != codec:
+            prepared.discard()
+            prepared.codec, prepared.compressed_path = codec, compress_file(temp_path, codec)
+
+    stored_path, stored_size = temp_path, blob.size
+    if codec:
+        stored_path, stored_size = prepared.compressed_path, os.path.getsize(prepared.compressed_path)
+        prepared.compressed_path = None # Moved into storage, or dropped, below
+        os.remove(temp_path)
+
+    get_blob_store().save_file(BLOBS, blob.hash, stored_path, replace=replace)
+    if (blob.codec, blob.stored_size) != (codec, stored_size):
+        Blob.objects.filter(pk=blob.pk).update(codec=codec, stored_size=stored_size)
+        blob.codec, blob.stored_size = codec, stored_size
+
+
+def _remove_blobs(blobs):
+    """
+    Deletes locked blobs that lost their last reference: their rows (and
+    manifests), then the chunks only they used, then their files.
+    """
+    chunk_refs = Counter()
+    chunked = [blob.hash for blob in blobs if blob.chunked]
+    if chunked:
+        chunk_refs.update(dict(
+            BlobChunk.objects.filter(blob_id__in=chunked)
+            .values_list('chunk_id').annotate(refs=Count('id')).order_by()
+        ))
+    Blob.objects.filter(hash__in=[blob.hash for blob in blobs]).delete() # Manifests cascade
+    if chunk_refs:
+        _release_chunks(chunk_refs)
+    count_blobs_removed(blobs) # After the chunk locks, see the lock order above
+    for blob in blobs:
+        if not blob.chunked:
+            _delete_stored_file(BLOBS, blob.hash)
+
+
+def _delete_stored_file(namespace, content_hash):
+    try:
+        get_blob_store().delete(namespace, content_hash) # No-op if the file is already gone
+        logger.debug("Deleted stored file", extra={'namespace': namespace, 'hash': content_hash})
+    except OSError as e:
+        # The row is gone either way, the leftover file is only wasted space
+        logger.error("Could not delete stored file", extra={
+            'namespace': namespace, 'hash': content_hash, 'error': str(e),
+        })
+
+
+# --- Batch versions ---
+# Same rules as above, for many files at once with a fixed number of queries.
+# Missing rows are inserted first, then all rows are locked with a single
+# SELECT ... FOR UPDATE in primary key (hash) order. Every batch takes its
+# locks in that one order, so batches sharing some hashes queue up instead
+# of deadlocking. Chunks of chunked blobs are handled the same way.
+
+def _lock_rows(model, hashes):
+    """Locks the existing rows among hashes, in hash order. Returns {hash: row}."""
+    locked = model.objects.select_for_update().filter(pk__in=hashes).order_by('pk')
+    return {row.pk: row for row in locked}
+
+
+def _insert_and_lock(model, hashes, make_row):
+    """
+    Locks the rows for the sorted list hashes, inserting the missing ones
+    with make_row(hash) first. Returns {hash: row}.
+    """
+    while True:
+        # Savepoint: rolling it back gives the row locks back for a retry
+        with transaction.atomic():
+            existing = set(model.objects.filter(pk__in=hashes).values_list('pk', flat=True))
+            missing = [row_hash for row_hash in hashes if row_hash not in existing]
+            if missing:
+                # INSERT ... ON CONFLICT DO NOTHING, in hash order: rows created
+                # by a concurrent batch in the meantime are simply skipped (after
+                # waiting for that batch to commit, if it has not yet).
+                model.objects.bulk_create([make_row(row_hash) for row_hash in missing], ignore_conflicts=True)
+            rows = _lock_rows(model, hashes)
+            if len(rows) == len(hashes):
+                return rows
+            # A row lost its last reference, and was deleted, while we waited
+            # for the lock. Start over rather than lock it out of order.
+            transaction.set_rollback(True)
+
+
+def _add_refs(model, deltas):
+    """Adds deltas[hash] to each row's ref_count, one UPDATE per distinct delta."""
+    by_delta = defaultdict(list)
+    for row_hash, delta in deltas.items():
+        by_delta[delta].append(row_hash)
+    for delta, hashes in by_delta.items():
+        model.objects.filter(pk__in=hashes).update(ref_count=F('ref_count') + delta)
+
+
+def acquire_blobs(uploads, prepared=None):
+    """
+    acquire_blob for a batch. uploads is a list of (file_hash, size, temp_path,
+    content_type); the same hash may appear several times and gets one
+    reference per entry. prepared is the dict from prepare_contents(), if used.
+    Returns ({hash: blob}, set of hashes that had no references before,
+    i.e. content that is new to the vault).
+    """
+    sizes, sources, refs = {}, {}, Counter()
+    for file_hash, size, temp_path, content_type in uploads:
+        sizes[file_hash] = size
+        sources.setdefault(file_hash, (temp_path, content_type))
+        refs[file_hash] += 1
+    hashes = sorted(refs)
+
+    blobs = _insert_and_lock(
+        Blob, hashes, lambda file_hash: Blob(hash=file_hash, size=sizes[file_hash], ref_count=0)
+    )
+    # Under the row locks, see acquire_blob. Only one temp file per distinct
+    # hash is needed, the others are removed when the upload is closed.
+    with ExitStack() as stack:
+        prepared = dict(prepared or {})
+        for file_hash in hashes:
+            if file_hash not in prepared:
+                prepared[file_hash] = stack.enter_context(PreparedContent())
+        _store_contents([
+            (blobs[file_hash], *sources[file_hash], prepared[file_hash]) for file_hash in hashes
+        ])
+
+    new_blobs = [blob for blob in blobs.values() if blob.ref_count == 0]
+    if new_blobs:
+        enqueue_blob_jobs(new_blobs)
+        count_blobs_added(new_blobs)
+    _add_refs(Blob, refs)
+    return blobs, {blob.hash for blob in new_blobs}
+
+
+def release_blobs(refs):
+    """
+    release_blob for a batch. refs maps each hash to the number of references
+    dropped (the FileMetadata rows must already be deleted). Blobs left without
+    references are removed with a single DELETE, then their content.
+    Returns the list of removed hashes.
+    """
+    blobs = _lock_rows(Blob, sorted(refs))
+    orphaned = [blob for file_hash, blob in blobs.items() if blob.ref_count <= refs[file_hash]]
+    _add_refs(Blob, {
+        file_hash: -count for file_hash, count in refs.items()
+        if file_hash in blobs and blobs[file_hash].ref_count > count
+    })
+    if not orphaned:
+        return []
+
+    _remove_blobs(orphaned)
+    return [blob.hash for blob in orphaned]
+
+
+# --- Chunk store ---
+
+def _store_chunked(items):
+    """
+    Stores new, locked blobs in the chunk store: the chunks the vault does
+    not have yet, and the blobs' manifests. items is a list of (blob,
+    temp_path, manifest_path), the manifest files written by write_manifest().
+    They are streamed, only the distinct chunk hashes are held in memory.
+    All chunks of the batch are locked in one go, in hash order.
+    """
+    refs, sizes = Counter(), {}
+    for _, _, manifest_path in items:
+        for _, size, chunk_hash in read_manifest(manifest_path):
+            refs[chunk_hash] += 1
+            sizes[chunk_hash] = size
+
+    chunks = _insert_and_lock(
+        Chunk, sorted(refs), lambda chunk_hash: Chunk(hash=chunk_hash, size=sizes[chunk_hash], ref_count=0)
+    )
+    new_chunks = [chunk for chunk in chunks.values() if chunk.ref_count == 0]
+
+    # Write each new chunk once, from the first temp file that contains it
+    unwritten = {chunk.hash for chunk in new_chunks}
+    for blob, temp_path, manifest_path in items:
+        with open(temp_path, 'rb') as source:
+            for offset, size, chunk_hash in read_manifest(manifest_path):
+                if chunk_hash in unwritten:
+                    unwritten.discard(chunk_hash)
+                    source.seek(offset)
+                    _write_chunk(chunk_hash, source.read(size))
+
+        entries = (
+            BlobChunk(blob_id=blob.hash, offset=offset, chunk_id=chunk_hash)
+            for offset, _, chunk_hash in read_manifest(manifest_path)
+        )
+        while batch := list(itertools.islice(entries, 1000)):
+            BlobChunk.objects.bulk_create(batch)
+    _add_refs(Chunk, refs)
+    if new_chunks:
+        count_chunks_added(new_chunks)
+
+    Blob.objects.filter(hash__in=[blob.hash for blob, _, _ in items]).update(chunked=True)
+    for blob, temp_path, _ in items:
+        blob.chunked = True
+        os.remove(temp_path)
+
+
+def _write_chunk(chunk_hash, data):
+    """Writes a chunk file to the blob store, through a temp file like a blob."""
+    with create_temp_file(suffix='.chunk') as temp_file:
+        temp_file.write(data)
+    get_blob_store().save_file(CHUNKS, chunk_hash, temp_file.name)
+
+
+def _release_chunks(refs):
+    """
+    Drops refs[hash] references from each chunk (their BlobChunk entries must
+    already be deleted) and removes the chunks left without references.
+    """
+    chunks = _lock_rows(Chunk, sorted(refs))
+    orphaned = [chunk for chunk_hash, chunk in chunks.items() if chunk.ref_count <= refs[chunk_hash]]
+    _add_refs(Chunk, {
+        chunk_hash: -count for chunk_hash, count in refs.items()
+        if chunk_hash in chunks and chunks[chunk_hash].ref_count > count
+    })
+    if not orphaned:
+        return
+
+    Chunk.objects.filter(hash__in=[chunk.hash for chunk in orphaned]).delete()
+    count_chunks_removed(orphaned)
+    for chunk in orphaned:
+        _delete_stored_file(CHUNKS, chunk.hash)
+
+
+# --- Deleted users ---
+# Connected when the app is ready (vault/apps.py), so users deleted from the
+# admin, the shell or a management command are covered too.
+
+@receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
+def _release_user_files(sender, instance, **kwargs):
+    """
+    Deletes a user's files before the user row goes. Left to the CASCADE,
+    their rows would vanish without dropping their blob references or the
+    vault-wide usage, so their content would never be removed. Runs in the
+    deleting transaction, a batch at a time, like a bulk delete.
+    """
+    files = FileMetadata.objects.filter(owner_id=instance.pk).order_by('pk')
+    while True:
+        # Same lock order as every delete: file rows, then their blobs
+        rows = list(
+            files.select_for_update()
+            .only('id', 'owner_id', 'blob_id', 'file_size')[:settings.VAULT_BULK_BATCH_SIZE]
+        )
+        if not rows:
+            return
+        FileMetadata.objects.filter(pk__in=[row.pk for row in rows]).delete()
+        release_blobs(Counter(row.blob_id for row in rows))
+        count_files_removed(rows)
@@ -0,0 +1,80 @@
+# vault/sniffing.py
+"""
+Content type detection from the first bytes of a file (its "magic number"),
+for the background job that fills in Blob.detected_type (vault/jobs.py).
+Clients declare a content_type when they upload, which may be wrong or
+missing; this looks at what the bytes actually are.
+
+A small signature table covers the common formats. Content that matches
+none of them is text/plain if it decodes as UTF-8 without NUL bytes, and
+application/octet-stream otherwise.
+"""
+
+# Bytes needed to recognize any of the formats below
+SNIFF_SIZE = 4096
+
+# (offset, signature, MIME type), checked in order
+SIGNATURES = [
+    (0, b'%PDF-', 'application/pdf'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'BM', 'image/bmp'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (0, b'\x00\x00\x01\x00', 'image/x-icon'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'PK\x05\x06', 'application/zip'), # Empty archive
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'BZh', 'application/x-bzip2'),
+    (0, b'\xfd7zXZ\x00', 'application/x-xz'),
+    (0, b'(\xb5/\xfd', 'application/zstd'),
+    (0, b"7z\xbc\xaf'\x1c", 'application/x-7z-compressed'),
+    (0, b'Rar!\x1a\x07', 'application/vnd.rar'),
+    (257, b'ustar', 'application/x-tar'),
+    (0, b'\x7fELF', 'application/x-executable'),
+    (0, b'MZ', 'application/vnd.microsoft.portable-executable'),
+    (0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'application/x-ole-storage'), # Legacy Office documents
+    (0, b'SQLite format 3\x00', 'application/vnd.sqlite3'),
+    (0, b'OggS', 'audio/ogg'),
+    (0, b'fLaC', 'audio/flac'),
+    (0, b'ID3', 'audio/mpeg'),
+    (0, b'\x1aE\xdf\xa3', 'video/webm'),
+    (0, b'wOFF', 'font/woff'),
+    (0, b'wOF2', 'font/woff2'),
+]
+
+# RIFF containers: the format is named at offset 8
+RIFF_TYPES = {b'WEBP': 'image/webp', b'WAVE': 'audio/wav', b'AVI ': 'video/x-msvideo'}
+
+# ISO base media files ('ftyp' box at offset 4): by major brand
+FTYP_BRANDS = {
+    b'heic': 'image/heic', b'heix': 'image/heic', b'mif1': 'image/heif', b'avif': 'image/avif',
+    b'qt  ': 'video/quicktime', b'M4A ': 'audio/mp4',
+}
+
+
+def sniff_content_type(head):
+    """MIME type of content starting with the bytes head (at least SNIFF_SIZE of them, if it has that many)."""
+    for offset, signature, mime_type in SIGNATURES:
+        if head.startswith(signature, offset):
+            return mime_type
+    if head.startswith(b'RIFF') and head[8:12] in RIFF_TYPES:
+        return RIFF_TYPES[head[8:12]]
+    if head[4:8] == b'ftyp':
+        return FTYP_BRANDS.get(head[8:12], 'video/mp4')
+    if _looks_like_text(head):
+        return 'text/plain'
+    return 'application/octet-stream'
+
+
+def _looks_like_text(head):
+    if not head or b'\x00' in head:
+        return False
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off at the end of the sample still counts
+        return e.start >= len(head) - 3 and e.reason == 'unexpected end of data'
+    return True
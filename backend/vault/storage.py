@@ -0,0 +1,39 @@
+# vault/storage.py
+import os
+import tempfile
+
+from django.conf import settings
+
+
+def get_upload_temp_dir():
+    """
+    Returns the directory used for in-flight uploads, creating it if needed.
+    It lives inside MEDIA_ROOT (the storage volume) so that moving a finished
+    upload into the local blob store is a same-filesystem rename, not a copy.
+    """
+    temp_dir = str(settings.VAULT_UPLOAD_TEMP_DIR)
+    os.makedirs(temp_dir, exist_ok=True)
+    return temp_dir
+
+
+def create_temp_file(suffix='.upload'):
+    """
+    Opens a new named temporary file in the upload temp directory.
+    The caller owns the file: it is NOT deleted automatically on close.
+    """
+    return tempfile.NamedTemporaryFile(
+        mode='w+b',
+        dir=get_upload_temp_dir(),
+        suffix=suffix,
+        delete=False,
+    )
+
+
+def get_session_part_path(session_id):
+    """
+    Returns the path of the part file a resumable upload session
+    writes its chunks into.
+    """
+    session_dir = os.path.join(get_upload_temp_dir(), 'sessions')
+    os.makedirs(session_dir, exist_ok=True)
+    return os.path.join(session_dir, f"{session_id}.part")
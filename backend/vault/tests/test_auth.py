@@ -0,0 +1,188 @@
+# vault/tests/test_auth.py
+"""Authentication: the token cache and its invalidation, token expiry, archive links, and the metrics endpoint."""
+import io
+import pickle
+import zipfile
+from contextlib import contextmanager
+from datetime import timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from vault.authentication import _shared_key, get_token_cache
+from vault.dbslots import stream_slot, streaming_query
+
+from .base import VaultTestCase
+
+
+@override_settings(VAULT_AUTH_CACHE_TTL=60)
+class TokenAuthenticationTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user(token=True)
+
+    def test_repeated_requests_skip_the_token_lookup(self):
+        self.assertEqual(self.client.get('/api/vault/stats/').status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get('/api/vault/stats/').status_code, 200)
+        self.assertFalse(any('authtoken_token' in query['sql'] for query in queries))
+
+    def test_deleted_token_stops_working(self):
+        self.client.get('/api/vault/stats/')
+        Token.objects.filter(user=self.user).delete()
+        self.assertEqual(self.client.get('/api/vault/stats/').status_code, 401)
+
+    def test_deactivated_user_is_rejected(self):
+        self.client.get('/api/vault/stats/')
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/vault/stats/').status_code, 401)
+
+    @override_settings(VAULT_AUTH_CACHE_SHARED=True)
+    def test_shared_cache_holds_no_credentials(self):
+        key = Token.objects.get(user=self.user).key
+        self.assertEqual(self.client.get('/api/vault/stats/').status_code, 200)
+        entry = pickle.dumps(cache.get(_shared_key(key)))
+        self.assertNotIn(key.encode(), entry)
+        self.assertNotIn(self.user.password.encode(), entry)
+
+        # As another worker: resolved from the shared entry alone
+        get_token_cache().clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/vault/stats/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(any('authtoken_token' in query['sql'] or 'auth_user' in query['sql'] for query in queries))
+        user = response.wsgi_request.user
+        self.assertEqual((user.pk, user.username), (self.user.pk, 'alice'))
+        self.assertEqual(user.get_deferred_fields(), {'password'})
+        self.assertTrue(user.check_password('password123')) # Loaded on demand
+
+    def test_invalid_token(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + '0' * 40)
+        self.assertEqual(client.get('/api/vault/stats/').status_code, 401)
+
+
+class TokenExpiryTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user(token=True)
+        self.token = Token.objects.get(user=self.user)
+
+    def login(self):
+        response = APIClient().post('/api/token-auth/', {'username': 'alice', 'password': 'password123'})
+        self.assertEqual(response.status_code, 200)
+        return response.data['token']
+
+    def test_tokens_do_not_expire_by_default(self):
+        Token.objects.filter(pk=self.token.pk).update(created=timezone.now() - timedelta(days=365))
+        self.assertEqual(self.client.get('/api/vault/stats/').status_code, 200)
+        self.assertEqual(self.login(), self.token.key)
+
+    @override_settings(VAULT_TOKEN_TTL=3600)
+    def test_expired_token_is_rejected_and_replaced_on_login(self):
+        self.assertEqual(self.login(), self.token.key) # Still valid
+        Token.objects.filter(pk=self.token.pk).update(created=timezone.now() - timedelta(hours=2))
+        self.assertEqual(self.client.get('/api/vault/stats/').status_code, 401)
+        new_key = self.login()
+        self.assertNotEqual(new_key, self.token.key)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {new_key}')
+        self.assertEqual(self.client.get('/api/vault/stats/').status_code, 200)
+
+
+class ArchiveLinkTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user(token=True)
+        self.files = [
+            self.upload(self.client, f'content {i}'.encode(), name='same.txt', content_type='text/plain')
+            for i in range(2)
+        ]
+
+    def get_link(self, query=''):
+        response = self.client.post(f'/api/vault/files/archive-link/{query}')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.data['expires_in'], 60)
+        return response.data['url']
+
+    def test_link_downloads_the_archive_without_a_token(self):
+        response = APIClient().get(self.get_link())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        archive = zipfile.ZipFile(io.BytesIO(self.content(response)))
+        self.assertEqual(sorted(archive.namelist()), ['same (1).txt', 'same.txt'])
+        self.assertEqual(sorted(archive.read(name) for name in archive.namelist()), [b'content 0', b'content 1'])
+
+    def test_link_is_bound_to_its_selection(self):
+        link = self.get_link(f"?ids={self.files[0]['id']}")
+        archive = zipfile.ZipFile(io.BytesIO(self.content(APIClient().get(link))))
+        self.assertEqual(archive.namelist(), ['same.txt'])
+        widened = link.replace(f"ids={self.files[0]['id']}", f"ids={self.files[0]['id']},{self.files[1]['id']}")
+        self.assertEqual(APIClient().get(widened).status_code, 401)
+
+    def test_tampered_or_expired_links_are_rejected(self):
+        link = self.get_link()
+        self.assertEqual(APIClient().get(link[:-3] + 'xyz').status_code, 401)
+        later = timezone.now() + timedelta(seconds=61)
+        with mock.patch('django.core.signing.time.time', return_value=later.timestamp()):
+            self.assertEqual(APIClient().get(link).status_code, 401)
+
+    def test_links_are_only_accepted_by_the_archive(self):
+        token = self.get_link().split('link=')[1]
+        self.assertEqual(APIClient().get('/api/vault/files/', {'link': token}).status_code, 401)
+
+    def test_no_link_for_an_empty_selection(self):
+        self.assertEqual(self.client.post('/api/vault/files/archive-link/?search=nothing').status_code, 404)
+        self.assertEqual(APIClient().post('/api/vault/files/archive-link/').status_code, 401)
+
+
+class MetricsEndpointTests(VaultTestCase):
+
+    def test_disabled_by_default(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+    @override_settings(VAULT_METRICS_ENABLED=True, VAULT_METRICS_TOKEN='')
+    def test_exposes_counters(self):
+        _, client = self.make_user()
+        self.upload(client, b'counted')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('vault_uploads_total', response.content.decode())
+
+    @override_settings(VAULT_METRICS_ENABLED=True, VAULT_METRICS_TOKEN='scrape-secret')
+    def test_token_protected(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertEqual(response.status_code, 200)
+
+
+class StreamSlotTests(SimpleTestCase):
+
+    def test_queries_hold_the_slot_only_inside_stream_slot(self):
+        held = []
+
+        @contextmanager
+        def slot():
+            held.append('acquired')
+            yield
+            held.append('released')
+
+        with streaming_query():
+            pass
+        self.assertEqual(held, [])
+        with stream_slot(slot):
+            with streaming_query():
+                self.assertEqual(held, ['acquired'])
+        self.assertEqual(held, ['acquired', 'released'])
+        with streaming_query():
+            pass
+        self.assertEqual(len(held), 2)
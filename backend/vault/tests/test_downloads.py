@@ -0,0 +1,164 @@
+# vault/tests/test_downloads.py
+"""Downloads: byte ranges, conditional requests, nginx hand-off and compressed delivery."""
+import gzip
+import os
+
+from django.test import SimpleTestCase, override_settings
+
+from vault.downloads import accepts_encoding, etag_matches, parse_range_header
+from vault.models import Blob
+
+from .base import VaultTestCase
+
+
+class ParseRangeHeaderTests(SimpleTestCase):
+
+    def test_absent_or_other_unit_is_ignored(self):
+        self.assertIsNone(parse_range_header(None, 100))
+        self.assertIsNone(parse_range_header('', 100))
+        self.assertIsNone(parse_range_header('items=0-5', 100))
+
+    def test_single_ranges(self):
+        self.assertEqual(parse_range_header('bytes=0-9', 100), [(0, 9)])
+        self.assertEqual(parse_range_header('bytes=90-', 100), [(90, 99)])
+        # Suffix range: the last N bytes
+        self.assertEqual(parse_range_header('bytes=-10', 100), [(90, 99)])
+        # Ends past the content are clamped
+        self.assertEqual(parse_range_header('bytes=95-200', 100), [(95, 99)])
+        self.assertEqual(parse_range_header('bytes=-500', 100), [(0, 99)])
+
+    def test_multiple_ranges_are_sorted_and_merged(self):
+        self.assertEqual(parse_range_header('bytes=50-59, 0-9', 100), [(0, 9), (50, 59)])
+        # Overlapping and adjacent ranges become one
+        self.assertEqual(parse_range_header('bytes=0-9,5-19,20-29', 100), [(0, 29)])
+
+    def test_malformed_header_is_ignored(self):
+        self.assertIsNone(parse_range_header('bytes=abc', 100))
+        self.assertIsNone(parse_range_header('bytes=9-0', 100))
+        self.assertIsNone(parse_range_header('bytes=-', 100))
+        # Too many ranges: served in full rather than as a tiny-part multipart
+        self.assertIsNone(parse_range_header('bytes=' + ','.join(f'{i}-{i}' for i in range(17)), 100))
+
+    def test_unsatisfiable(self):
+        self.assertEqual(parse_range_header('bytes=100-', 100), [])
+        self.assertEqual(parse_range_header('bytes=-0', 100), [])
+        # One satisfiable range is enough
+        self.assertEqual(parse_range_header('bytes=200-300,0-0', 100), [(0, 0)])
+
+    def test_etag_matching(self):
+        self.assertTrue(etag_matches('"abc"', '"abc"'))
+        self.assertTrue(etag_matches('W/"abc", "def"', '"abc"'))
+        self.assertTrue(etag_matches('*', '"abc"'))
+        self.assertFalse(etag_matches('"abd"', '"abc"'))
+        self.assertFalse(etag_matches(None, '"abc"'))
+
+    def test_accept_encoding(self):
+        self.assertTrue(accepts_encoding('gzip, deflate, br', 'gzip'))
+        self.assertFalse(accepts_encoding('gzip;q=0, *', 'gzip'))
+        self.assertTrue(accepts_encoding('*;q=0.5', 'zstd'))
+        self.assertFalse(accepts_encoding('br', 'gzip'))
+        self.assertFalse(accepts_encoding(None, 'gzip'))
+
+
+class DownloadTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user()
+        self.data = os.urandom(10_000)
+        self.file = self.upload(self.client, self.data, name='report.bin')
+        self.url = f"/api/vault/files/{self.file['id']}/download/"
+
+    def test_full_download(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.content(response), self.data)
+        self.assertEqual(response['Content-Length'], str(len(self.data)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['ETag'], f'"{self.file["file_hash"]}"')
+        self.assertIn('report.bin', response['Content-Disposition'])
+
+    def test_single_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.content(response), self.data[100:200])
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.data)}')
+        self.assertEqual(response['Content-Length'], '100')
+
+    def test_multipart_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9,5000-5009')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges; boundary='))
+        boundary = response['Content-Type'].split('boundary=')[1]
+        body = self.content(response)
+        self.assertEqual(len(body), int(response['Content-Length']))
+        parts = body.split(f'--{boundary}'.encode())
+        self.assertEqual(parts[-1], b'--\r\n') # Closing delimiter
+        self.assertIn(f'Content-Range: bytes 0-9/{len(self.data)}'.encode(), parts[1])
+        self.assertTrue(parts[1].endswith(b'\r\n\r\n' + self.data[0:10] + b'\r\n'))
+        self.assertTrue(parts[2].endswith(b'\r\n\r\n' + self.data[5000:5010] + b'\r\n'))
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.data)}')
+
+    def test_if_range_with_another_version_sends_everything(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.content(response), self.data)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=f'"{self.file["file_hash"]}"')
+        self.assertEqual(response.status_code, 206)
+
+    def test_if_none_match(self):
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=f'"{self.file["file_hash"]}"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], f'"{self.file["file_hash"]}"')
+
+    def test_other_users_cannot_download(self):
+        _, other = self.make_user('bob')
+        self.assertEqual(other.get(self.url).status_code, 404)
+
+    @override_settings(VAULT_DOWNLOAD_MODE='accel', VAULT_ACCEL_REDIRECT_PREFIX='/protected-media/')
+    def test_accel_redirect(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+        self.assertTrue(response['X-Accel-Redirect'].startswith('/protected-media/'))
+        self.assertTrue(response['X-Accel-Redirect'].endswith(self.file['file_hash']))
+        self.assertEqual(response['ETag'], f'"{self.file["file_hash"]}"')
+
+
+@override_settings(VAULT_COMPRESSION='gzip')
+class CompressedDownloadTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user()
+        self.data = b'a line of very compressible text\n' * 2000
+        self.file = self.upload(self.client, self.data, name='notes.txt', content_type='text/plain')
+        self.url = f"/api/vault/files/{self.file['id']}/download/"
+
+    def test_blob_is_stored_compressed(self):
+        blob = Blob.objects.get(pk=self.file['file_hash'])
+        self.assertEqual(blob.codec, 'gzip')
+        self.assertLess(blob.stored_size, blob.size)
+
+    def test_sent_as_stored_to_clients_accepting_the_codec(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(self.content(response)), self.data)
+        self.assertEqual(response['ETag'], f'"{self.file["file_hash"]}+gzip"')
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_decompressed_for_other_clients(self):
+        response = self.client.get(self.url)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(self.content(response), self.data)
+
+    def test_ranges_refer_to_the_original_bytes(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=40000-40099', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 206)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(self.content(response), self.data[40000:40100])
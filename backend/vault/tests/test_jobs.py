@@ -0,0 +1,130 @@
+# vault/tests/test_jobs.py
+"""Background jobs: queueing with new content, claiming with leases, retries, and the content type sniffer."""
+from datetime import timedelta
+from unittest import mock
+
+from django.test import override_settings
+from django.utils import timezone
+
+from vault.jobs import HANDLERS, claim_jobs, release_jobs, run_job
+from vault.models import BlobJob, FileChange
+
+from .base import VaultTestCase
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 100
+
+
+@override_settings(VAULT_BLOB_JOBS=['test_job'], VAULT_JOB_LEASE=600, VAULT_JOB_MAX_ATTEMPTS=3)
+class JobQueueTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user()
+        self.outcomes = []
+        # The test handler fails while outcomes says so
+        handlers = mock.patch.dict(HANDLERS, {'test_job': self.handle})
+        handlers.start()
+        self.addCleanup(handlers.stop)
+
+    def handle(self, job):
+        if self.outcomes and self.outcomes.pop(0) == 'fail':
+            raise RuntimeError("storage unavailable")
+
+    def test_queued_once_per_new_content(self):
+        self.upload(self.client, b'content', name='a.txt')
+        self.upload(self.client, b'content', name='b.txt')
+        _, other = self.make_user('bob')
+        self.upload(other, b'content', name='c.txt')
+        self.assertEqual(BlobJob.objects.count(), 1)
+        self.upload(self.client, b'other content')
+        self.assertEqual(BlobJob.objects.count(), 2)
+
+    def test_claims_take_a_lease(self):
+        self.upload(self.client, b'content')
+        jobs = claim_jobs('worker-1', 10)
+        self.assertEqual(len(jobs), 1)
+        job = jobs[0]
+        self.assertEqual((job.state, job.claimed_by, job.attempts), (BlobJob.RUNNING, 'worker-1', 1))
+        self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=590))
+        # Held: nobody else gets it
+        self.assertEqual(claim_jobs('worker-2', 10), [])
+
+    def test_expired_lease_is_taken_over(self):
+        self.upload(self.client, b'content')
+        stale = claim_jobs('worker-1', 10)[0]
+        BlobJob.objects.update(run_after=timezone.now() - timedelta(seconds=1)) # worker-1 died
+        taken = claim_jobs('worker-2', 10)
+        self.assertEqual([(job.claimed_by, job.attempts) for job in taken], [('worker-2', 2)])
+        # The first worker's late outcome is not recorded
+        with self.assertLogs('vault.jobs', 'WARNING'):
+            self.assertIsNone(run_job(stale))
+        self.assertEqual(run_job(taken[0]), BlobJob.DONE)
+
+    def test_done(self):
+        self.upload(self.client, b'content')
+        job = claim_jobs('worker-1', 10)[0]
+        self.assertEqual(run_job(job), BlobJob.DONE)
+        job.refresh_from_db()
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(claim_jobs('worker-1', 10), [])
+
+    def test_retries_with_backoff_then_fails(self):
+        self.upload(self.client, b'content')
+        self.outcomes = ['fail'] * 3
+        for attempt in range(1, 4):
+            job = claim_jobs('worker-1', 10)[0]
+            self.assertEqual(job.attempts, attempt)
+            with self.assertLogs('vault.jobs', 'WARNING' if attempt < 3 else 'ERROR'):
+                state = run_job(job)
+            job.refresh_from_db()
+            if attempt < 3:
+                self.assertEqual(state, BlobJob.PENDING)
+                self.assertGreater(job.run_after, timezone.now())
+                self.assertIn("storage unavailable", job.last_error)
+                BlobJob.objects.update(run_after=timezone.now()) # Skip the wait
+        self.assertEqual(state, BlobJob.FAILED)
+        self.assertEqual(claim_jobs('worker-1', 10), [])
+
+    def test_unknown_kind_fails_at_once(self):
+        self.upload(self.client, b'content')
+        BlobJob.objects.update(kind='no_such_job')
+        with self.assertLogs('vault.jobs', 'ERROR'):
+            self.assertEqual(run_job(claim_jobs('worker-1', 10)[0]), BlobJob.FAILED)
+
+    def test_released_jobs_are_due_again(self):
+        self.upload(self.client, b'content')
+        release_jobs(claim_jobs('worker-1', 10))
+        job = BlobJob.objects.get()
+        self.assertEqual((job.state, job.attempts), (BlobJob.PENDING, 0))
+        self.assertEqual(len(claim_jobs('worker-2', 10)), 1)
+
+    def test_jobs_go_with_their_blob(self):
+        file = self.upload(self.client, b'content')
+        job = claim_jobs('worker-1', 10)[0]
+        self.client.delete(f"/api/vault/files/{file['id']}/")
+        self.assertFalse(BlobJob.objects.exists())
+        with self.assertLogs('vault.jobs', 'WARNING'):
+            self.assertIsNone(run_job(job))
+
+
+@override_settings(VAULT_BLOB_JOBS=['sniff_content_type'])
+class SniffJobTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user()
+
+    def test_detected_type_reaches_lists_and_change_logs(self):
+        file = self.upload(self.client, PNG, name='picture', content_type='application/octet-stream')
+        self.assertEqual(file['detected_type'], '')
+        cursor = self.client.get('/api/vault/files/changes/').data['cursor']
+        etag = self.client.get('/api/vault/files/')['ETag']
+
+        self.assertEqual(run_job(claim_jobs('worker-1', 10)[0]), BlobJob.DONE)
+
+        response = self.client.get('/api/vault/files/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['detected_type'], 'image/png')
+        changes = self.client.get('/api/vault/files/changes/', {'since': cursor}).data['changes']
+        self.assertEqual([(c['action'], c['file_id']) for c in changes], [(FileChange.UPDATED, file['id'])])
+        self.assertEqual(changes[0]['file']['detected_type'], 'image/png')
@@ -0,0 +1,217 @@
+# vault/tests/test_listing.py
+"""File list: keyset pagination, search, the response cache, and the change log used for sync."""
+from io import StringIO
+from urllib.parse import parse_qs, urlsplit
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+
+from vault.changes import decode_cursor, encode_cursor
+from vault.models import FileChange, FileMetadata, StorageUsage
+
+from .base import VaultTestCase
+
+
+class FileListTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user()
+
+    def test_pages_follow_the_next_link(self):
+        ids = [self.upload(self.client, f'file {i}'.encode(), name=f'{i}.txt', content_type='text/plain')['id']
+               for i in range(7)]
+        seen, url = [], '/api/vault/files/?page_size=3'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(file['id'] for file in response.data['results'])
+            url = response.data['next']
+            if url:
+                # Relative: resolved by the client against the URL it requested
+                self.assertTrue(url.startswith('/api/vault/files/?'))
+                self.assertEqual(parse_qs(urlsplit(url).query)['page_size'], ['3'])
+        # Newest first, each file exactly once
+        self.assertEqual(seen, ids[::-1])
+
+    def test_pages_stay_consistent_when_files_are_added(self):
+        for i in range(4):
+            self.upload(self.client, f'file {i}'.encode(), name=f'{i}.txt', content_type='text/plain')
+        first = self.client.get('/api/vault/files/?page_size=2').data
+        self.upload(self.client, b'newer', name='new.txt', content_type='text/plain')
+        second = self.client.get(first['next']).data
+        names = [file['original_filename'] for file in first['results'] + second['results']]
+        self.assertEqual(names, ['3.txt', '2.txt', '1.txt', '0.txt'])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/api/vault/files/?cursor=garbage').status_code, 404)
+
+    def test_search_matches_every_word(self):
+        for name in ('q3_report-final.pdf', 'report-draft.pdf', 'final.txt'):
+            self.upload(self.client, name.encode(), name=name)
+        response = self.client.get('/api/vault/files/', {'search': 'rep fin'})
+        self.assertEqual([file['original_filename'] for file in response.data['results']], ['q3_report-final.pdf'])
+
+    def test_filters(self):
+        self.upload(self.client, b'x' * 10, name='small.txt', content_type='text/plain')
+        self.upload(self.client, b'x' * 1000, name='large.png', content_type='image/png')
+        names = lambda params: [file['original_filename'] for file in self.client.get('/api/vault/files/', params).data['results']]
+        self.assertEqual(names({'content_type': 'image'}), ['large.png'])
+        self.assertEqual(names({'file_size_max': 100}), ['small.txt'])
+
+    def test_only_own_files_are_listed(self):
+        self.upload(self.client, b'mine', name='mine.txt')
+        _, other = self.make_user('bob')
+        self.assertEqual(other.get('/api/vault/files/').data['results'], [])
+
+
+class ListCacheTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user()
+        self.upload(self.client, b'first', name='first.txt')
+
+    def test_etag_revalidation(self):
+        response = self.client.get('/api/vault/files/')
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        self.assertEqual(self.client.get('/api/vault/files/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_writes_invalidate_the_cached_list(self):
+        etag = self.client.get('/api/vault/files/')['ETag']
+        file = self.upload(self.client, b'second', name='second.txt')
+        response = self.client.get('/api/vault/files/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 2)
+
+        self.client.delete(f"/api/vault/files/{file['id']}/")
+        self.assertEqual(len(self.client.get('/api/vault/files/').data['results']), 1)
+
+    def test_cached_data_is_per_user(self):
+        self.client.get('/api/vault/files/')
+        _, other = self.make_user('bob')
+        self.assertEqual(other.get('/api/vault/files/').data['results'], [])
+
+
+class ChangeCursorTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        self.assertEqual(decode_cursor(encode_cursor(12)), (12, None))
+        self.assertEqual(decode_cursor(encode_cursor(12, 345)), (12, 345))
+
+    def test_invalid(self):
+        for cursor in ('!!!', encode_cursor('x'), 'MTJ8eA=='): # '12|x'
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+
+class ChangeLogTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user()
+
+    def changes(self, cursor, **params):
+        response = self.client.get('/api/vault/files/changes/', {'since': cursor, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def start(self):
+        return self.client.get('/api/vault/files/changes/').data['cursor']
+
+    def test_without_since_only_the_cursor_is_returned(self):
+        self.upload(self.client, b'before', name='before.txt')
+        data = self.client.get('/api/vault/files/changes/').data
+        self.assertEqual(data['changes'], [])
+        self.assertFalse(data['has_more'])
+
+    def test_created_and_deleted(self):
+        cursor = self.start()
+        file = self.upload(self.client, b'content', name='a.txt')
+        data = self.changes(cursor)
+        self.assertEqual([(c['action'], c['file_id']) for c in data['changes']], [('created', file['id'])])
+        self.assertEqual(data['changes'][0]['file']['original_filename'], 'a.txt')
+
+        self.client.delete(f"/api/vault/files/{file['id']}/")
+        data = self.changes(data['cursor'])
+        self.assertEqual([(c['action'], c['file']) for c in data['changes']], [('deleted', None)])
+        # Nothing new since
+        self.assertEqual(self.changes(data['cursor'])['changes'], [])
+
+    def test_paging_with_limit(self):
+        cursor = self.start()
+        ids = [self.upload(self.client, f'{i}'.encode(), name=f'{i}.txt')['id'] for i in range(5)]
+        seen = []
+        while True:
+            data = self.changes(cursor, limit=2)
+            seen.extend(change['file_id'] for change in data['changes'])
+            cursor = data['cursor']
+            if not data['has_more']:
+                break
+        self.assertEqual(seen, ids)
+
+    def test_bulk_delete_in_one_version(self):
+        ids = [self.upload(self.client, f'{i}'.encode(), name=f'{i}.txt')['id'] for i in range(3)]
+        cursor = self.start()
+        self.client.post('/api/vault/files/bulk-delete/', {'ids': ids}, format='json')
+        data = self.changes(cursor, limit=2)
+        self.assertTrue(data['has_more'])
+        # Resumes in the middle of the version
+        rest = self.changes(data['cursor'], limit=2)
+        self.assertEqual(sorted(c['file_id'] for c in data['changes'] + rest['changes']), ids)
+
+    def test_other_users_changes_are_not_visible(self):
+        cursor = self.start()
+        _, other = self.make_user('bob')
+        self.upload(other, b'theirs')
+        self.assertEqual(self.changes(cursor)['changes'], [])
+
+    def test_invalid_parameters(self):
+        for params in ({'since': 'garbage'}, {'since': self.start(), 'wait': 'soon'},
+                       {'since': self.start(), 'limit': 'many'}):
+            self.assertEqual(self.client.get('/api/vault/files/changes/', params).status_code, 400, params)
+
+    @override_settings(VAULT_CHANGES_MAX_WAIT=0.2, VAULT_CHANGES_POLL_INTERVAL=0.05)
+    def test_long_poll_returns_when_nothing_changes(self):
+        data = self.changes(self.start(), wait=5)
+        self.assertEqual(data['changes'], [])
+
+
+class ReconcileTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user()
+        self.kept = self.upload(self.client, b'kept', name='kept.txt')
+        self.removed = self.upload(self.client, b'removed', name='removed.txt')
+
+    def reconcile(self, *args):
+        out = StringIO()
+        call_command('vault_reconcile_usage', *args, stdout=out)
+        return out.getvalue()
+
+    def test_nothing_to_fix(self):
+        output = self.reconcile()
+        self.assertIn("Fixed 0 user usage row(s).", output)
+        self.assertIn("Wrote 0 change log entries", output)
+
+    def test_repairs_counters_and_change_log_after_changes_outside_the_api(self):
+        cursor = self.client.get('/api/vault/files/changes/').data['cursor']
+        # Deleted behind the API's back: no counters, no log entry
+        FileMetadata.objects.filter(pk=self.removed['id']).delete()
+
+        self.assertIn("Would fix 1 user usage row(s).", self.reconcile('--dry-run'))
+        self.assertEqual(StorageUsage.objects.get(pk=self.user.pk).file_count, 2)
+
+        output = self.reconcile()
+        self.assertIn("Fixed 1 blob reference count(s).", output)
+        self.assertIn("Fixed 1 user usage row(s).", output)
+        self.assertIn("Wrote 1 change log entries", output)
+        usage = StorageUsage.objects.get(pk=self.user.pk)
+        self.assertEqual((usage.file_count, usage.logical_bytes), (1, 4))
+
+        changes = self.client.get('/api/vault/files/changes/', {'since': cursor}).data['changes']
+        self.assertEqual([(c['action'], c['file_id']) for c in changes], [(FileChange.DELETED, self.removed['id'])])
+        self.assertIn("Fixed 0 user usage row(s).", self.reconcile())
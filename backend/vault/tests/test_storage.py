@@ -0,0 +1,288 @@
+# vault/tests/test_storage.py
+"""Storage: content-defined chunking, the chunk store, compression, path layouts, the blob cache and scrubbing."""
+import hashlib
+import importlib.util
+import io
+import os
+import tempfile
+import unittest
+from io import StringIO
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+
+from vault.blobstore import BLOBS, CHUNKS, BlobStore, LocalBackend, get_blob_cache, get_blob_store
+from vault.chunking import FastCDC
+from vault.chunkstore import read_manifest, write_manifest
+from vault.compression import DecompressingReader, choose_codec, compress_file
+from vault.models import Blob, BlobChunk, Chunk
+
+from .base import VaultTestCase, VaultTestMixin
+
+# Small chunks, so a few hundred KB make dozens of them
+SMALL_CHUNKS = {
+    'VAULT_STORAGE_ENGINE': 'chunks',
+    'VAULT_CHUNKING_MIN_FILE_SIZE': 4096,
+    'VAULT_CHUNK_MIN_SIZE': 1024,
+    'VAULT_CHUNK_AVG_SIZE': 4096,
+    'VAULT_CHUNK_MAX_SIZE': 16384,
+}
+
+
+def random_bytes(size, seed):
+    """Deterministic pseudo-random content."""
+    out, counter = bytearray(), 0
+    while len(out) < size:
+        out += hashlib.sha256(f'{seed}-{counter}'.encode()).digest()
+        counter += 1
+    return bytes(out[:size])
+
+
+class FastCDCTests(SimpleTestCase):
+
+    def setUp(self):
+        self.chunker = FastCDC(1024, 4096, 16384)
+        self.data = random_bytes(300_000, 'cdc')
+
+    def chunks(self, data, read_size=65536):
+        return list(self.chunker.iter_chunks(io.BytesIO(data), read_size=read_size))
+
+    def test_chunks_cover_the_data_within_bounds(self):
+        chunks = self.chunks(self.data)
+        self.assertEqual(b''.join(data for _, data in chunks), self.data)
+        offset = 0
+        for chunk_offset, data in chunks:
+            self.assertEqual(chunk_offset, offset)
+            offset += len(data)
+        self.assertTrue(all(1024 <= len(data) <= 16384 for _, data in chunks[:-1]))
+
+    def test_boundaries_do_not_depend_on_read_size(self):
+        self.assertEqual(self.chunks(self.data, read_size=65536), self.chunks(self.data, read_size=7000))
+
+    def test_an_edit_only_changes_nearby_chunks(self):
+        edited = self.data[:150_000] + b'inserted bytes' + self.data[150_000:]
+        before = {hashlib.sha256(data).digest() for _, data in self.chunks(self.data)}
+        after = [hashlib.sha256(data).digest() for _, data in self.chunks(edited)]
+        changed = [digest for digest in after if digest not in before]
+        self.assertLessEqual(len(changed), 3)
+
+    def test_invalid_sizes(self):
+        with self.assertRaises(ValueError):
+            FastCDC(1024, 3000, 16384) # Average not a power of two
+        with self.assertRaises(ValueError):
+            FastCDC(8192, 4096, 16384)
+
+
+@override_settings(**SMALL_CHUNKS)
+class ChunkStoreTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user()
+        self.data = random_bytes(200_000, 'store')
+
+    def test_manifest_round_trip(self):
+        with tempfile.NamedTemporaryFile(dir=settings.MEDIA_ROOT, delete=False) as source:
+            source.write(self.data)
+        manifest_path = write_manifest(source.name)
+        self.addCleanup(os.remove, manifest_path)
+        expected = [
+            (offset, len(data), hashlib.sha256(data).hexdigest())
+            for offset, data in FastCDC(1024, 4096, 16384).iter_chunks(io.BytesIO(self.data))
+        ]
+        self.assertEqual(list(read_manifest(manifest_path)), expected)
+
+    def test_large_content_is_stored_as_chunks(self):
+        file = self.upload(self.client, self.data)
+        blob = Blob.objects.get(pk=file['file_hash'])
+        self.assertTrue(blob.chunked)
+        self.assertFalse(get_blob_store().exists(BLOBS, blob.hash))
+        entries = list(BlobChunk.objects.filter(blob=blob).order_by('offset'))
+        self.assertGreater(len(entries), 10)
+        self.assertEqual(sum(entry.chunk.size for entry in entries), len(self.data))
+        self.assertTrue(all(get_blob_store().exists(CHUNKS, entry.chunk_id) for entry in entries))
+
+        url = f"/api/vault/files/{file['id']}/download/"
+        self.assertEqual(self.content(self.client.get(url)), self.data)
+        response = self.client.get(url, HTTP_RANGE='bytes=123456-133455')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.content(response), self.data[123456:133456])
+
+    def test_similar_content_shares_chunks(self):
+        first = self.upload(self.client, self.data, name='v1.bin')
+        edited = self.data[:100_000] + b'edit' + self.data[100_000:]
+        second = self.upload(self.client, edited, name='v2.bin')
+        shared = Chunk.objects.filter(ref_count=2).count()
+        self.assertGreater(shared, Chunk.objects.filter(ref_count=1).count())
+        self.assertEqual(self.content(self.client.get(f"/api/vault/files/{second['id']}/download/")), edited)
+
+        self.client.delete(f"/api/vault/files/{first['id']}/")
+        self.assertFalse(Chunk.objects.filter(ref_count=2).exists())
+        self.client.delete(f"/api/vault/files/{second['id']}/")
+        self.assertFalse(Chunk.objects.exists())
+        self.assertFalse(BlobChunk.objects.exists())
+
+    def test_small_content_is_stored_whole(self):
+        file = self.upload(self.client, b'small')
+        self.assertFalse(Blob.objects.get(pk=file['file_hash']).chunked)
+
+
+class CompressionTests(VaultTestMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = b''.join(b'line %d of a compressible log\n' % i for i in range(20000))
+        with tempfile.NamedTemporaryFile(dir=settings.MEDIA_ROOT, delete=False) as source:
+            source.write(self.data)
+        self.path = source.name
+
+    def round_trip(self, codec):
+        compressed = compress_file(self.path, codec)
+        self.addCleanup(os.remove, compressed)
+        self.assertLess(os.path.getsize(compressed), len(self.data) // 4)
+        reader = DecompressingReader(lambda: open(compressed, 'rb'), codec, len(self.data))
+        with reader:
+            self.assertEqual(reader.read(), self.data)
+            # Backward and forward seeks, as Range requests do
+            reader.seek(1000)
+            self.assertEqual(reader.read(100), self.data[1000:1100])
+            reader.seek(400_000)
+            self.assertEqual(reader.read(100), self.data[400_000:400_100])
+            reader.seek(-10, io.SEEK_END)
+            self.assertEqual(reader.read(), self.data[-10:])
+
+    def test_gzip_round_trip(self):
+        self.round_trip('gzip')
+
+    @unittest.skipUnless(importlib.util.find_spec('zstandard'), "zstandard is not installed")
+    def test_zstd_round_trip(self):
+        self.round_trip('zstd')
+
+    @override_settings(VAULT_COMPRESSION='gzip', VAULT_COMPRESSION_MIN_SIZE=1024)
+    def test_choose_codec(self):
+        self.assertEqual(choose_codec('text/plain', self.path, len(self.data)), 'gzip')
+        # Too small, already compressed, or incompressible
+        self.assertEqual(choose_codec('text/plain', self.path, 100), '')
+        self.assertEqual(choose_codec('image/jpeg', self.path, len(self.data)), '')
+        with tempfile.NamedTemporaryFile(dir=settings.MEDIA_ROOT, delete=False) as noise:
+            noise.write(os.urandom(100_000))
+        self.assertEqual(choose_codec('application/octet-stream', noise.name, 100_000), '')
+        with override_settings(VAULT_COMPRESSION='off'):
+            self.assertEqual(choose_codec('text/plain', self.path, len(self.data)), '')
+
+
+class LayoutTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user()
+
+    def test_fanout_paths(self):
+        store = BlobStore(LocalBackend(settings.MEDIA_ROOT), 'fanout')
+        content_hash = 'ab' + 'c' * 62
+        self.assertEqual(store.path(BLOBS, content_hash), f'uploads/ab/cc/{content_hash}')
+        self.assertEqual(store.legacy_paths(BLOBS, content_hash), [f'uploads/{content_hash}'])
+
+    def test_migrate_layout(self):
+        with override_settings(VAULT_BLOB_LAYOUT='flat'):
+            file = self.upload(self.client, b'stored flat')
+            self.assertEqual(get_blob_store().locate(BLOBS, file['file_hash']), f"uploads/{file['file_hash']}")
+
+        with override_settings(VAULT_BLOB_LAYOUT='fanout'):
+            # Still readable before it is moved
+            download = self.client.get(f"/api/vault/files/{file['id']}/download/")
+            self.assertEqual(self.content(download), b'stored flat')
+
+            out = StringIO()
+            call_command('vault_migrate_layout', stdout=out)
+            self.assertIn("Blobs: 1 moved, 0 already in place, 0 missing.", out.getvalue())
+            store = get_blob_store()
+            self.assertEqual(store.locate(BLOBS, file['file_hash']), store.path(BLOBS, file['file_hash']))
+
+
+class ScrubTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user()
+        self.file = self.upload(self.client, b'tracked content')
+
+    def scrub(self, *args):
+        out = StringIO()
+        call_command('vault_scrub', *args, stdout=out)
+        return out.getvalue()
+
+    def test_orphans_are_deleted(self):
+        orphan = hashlib.sha256(b'untracked').hexdigest()
+        with tempfile.NamedTemporaryFile(dir=settings.MEDIA_ROOT, delete=False) as temp_file:
+            temp_file.write(b'untracked')
+        get_blob_store().save_file(BLOBS, orphan, temp_file.name)
+
+        self.assertIn("would delete 1", self.scrub('--orphans', '--dry-run'))
+        self.assertTrue(get_blob_store().exists(BLOBS, orphan))
+        self.assertIn("deleted 1", self.scrub('--orphans'))
+        self.assertFalse(get_blob_store().exists(BLOBS, orphan))
+        self.assertTrue(get_blob_store().exists(BLOBS, self.file['file_hash']))
+
+    def test_dangling_rows_are_reported(self):
+        self.assertIn("Dangling: 0 blob(s)", self.scrub('--dangling'))
+        get_blob_store().delete(BLOBS, self.file['file_hash'])
+        self.assertIn("Dangling: 1 blob(s) and 0 chunk(s) missing from storage", self.scrub('--dangling'))
+
+
+@unittest.skipIf(settings.VAULT_BLOB_BACKEND != 'local', "the blob cache fronts network storage, tested over the local backend")
+class BlobCacheTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache_dir = tempfile.mkdtemp(dir=settings.MEDIA_ROOT)
+        cached = override_settings(VAULT_BLOB_CACHE_DIR=cache_dir)
+        cached.enable()
+        self.addCleanup(cached.disable)
+        self.user, self.client = self.make_user()
+
+    def test_reads_are_served_from_the_cache(self):
+        data = random_bytes(50_000, 'cache')
+        file = self.upload(self.client, data)
+        url = f"/api/vault/files/{file['id']}/download/"
+        for _ in range(3):
+            self.assertEqual(self.content(self.client.get(url)), data)
+        stats = get_blob_cache().stats()
+        self.assertEqual((stats['misses'], stats['hits']), (1, 2))
+
+        # Removed from the cache together with the content
+        self.client.delete(f"/api/vault/files/{file['id']}/")
+        path = get_blob_store().path(BLOBS, file['file_hash'])
+        self.assertFalse(os.path.exists(os.path.join(settings.VAULT_BLOB_CACHE_DIR, path)))
+
+
+@unittest.skipUnless(
+    settings.VAULT_BLOB_BACKEND == 's3' and importlib.util.find_spec('boto3'),
+    "needs VAULT_BLOB_BACKEND=s3 (e.g. MinIO, see the 'test' compose profile)",
+)
+class S3BackendTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.store = get_blob_store(cached=False)
+        self.data = random_bytes(100_000, 's3')
+        self.content_hash = hashlib.sha256(self.data).hexdigest()
+        with tempfile.NamedTemporaryFile(dir=settings.MEDIA_ROOT, delete=False) as temp_file:
+            temp_file.write(self.data)
+        self.assertTrue(self.store.save_file(BLOBS, self.content_hash, temp_file.name))
+
+    def test_ranged_reads(self):
+        with self.store.open(BLOBS, self.content_hash) as stored:
+            stored.seek(50_000)
+            self.assertEqual(stored.read(1000), self.data[50_000:51_000])
+            stored.seek(10)
+            self.assertEqual(stored.read(10), self.data[10:20])
+            self.assertEqual(stored.read(), self.data[20:])
+
+    def test_listing_and_delete(self):
+        self.assertEqual(list(self.store.iter_stored(BLOBS)), [(self.content_hash, self.store.path(BLOBS, self.content_hash))])
+        self.store.delete(BLOBS, self.content_hash)
+        self.assertFalse(self.store.exists(BLOBS, self.content_hash))
+        with self.assertRaises(FileNotFoundError):
+            self.store.open(BLOBS, self.content_hash)
@@ -0,0 +1,327 @@
+# vault/tests/test_uploads.py
+"""Uploads: deduplication and reference counting, bulk operations, resumable sessions and claims."""
+import hashlib
+import os
+import tempfile
+from datetime import timedelta
+from io import StringIO
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import override_settings
+from django.utils import timezone
+
+from vault.blobstore import BLOBS, get_blob_store
+from vault.models import Blob, FileMetadata, UploadSession
+from vault.storage import get_session_part_path
+from vault.views import FileMetadataViewSet
+
+from .base import VaultTestCase
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class DeduplicationTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user()
+        self.data = os.urandom(5000)
+
+    def test_upload_hashes_and_stores_content(self):
+        file = self.upload(self.client, self.data, name='a.bin')
+        self.assertEqual(file['file_hash'], sha256(self.data))
+        self.assertEqual(file['file_size'], len(self.data))
+        blob = Blob.objects.get(pk=file['file_hash'])
+        self.assertEqual(blob.ref_count, 1)
+        self.assertTrue(get_blob_store().exists(BLOBS, blob.hash))
+
+    def test_duplicates_share_one_blob(self):
+        first = self.upload(self.client, self.data, name='a.bin')
+        _, other = self.make_user('bob')
+        second = self.upload(other, self.data, name='b.bin')
+        self.assertNotEqual(first['id'], second['id'])
+        self.assertEqual(Blob.objects.count(), 1)
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+
+    def test_content_is_removed_with_the_last_reference(self):
+        first = self.upload(self.client, self.data, name='a.bin')
+        second = self.upload(self.client, self.data, name='b.bin')
+        file_hash = first['file_hash']
+
+        self.assertEqual(self.client.delete(f"/api/vault/files/{first['id']}/").status_code, 204)
+        self.assertEqual(Blob.objects.get(pk=file_hash).ref_count, 1)
+        self.assertTrue(get_blob_store().exists(BLOBS, file_hash))
+
+        self.assertEqual(self.client.delete(f"/api/vault/files/{second['id']}/").status_code, 204)
+        self.assertFalse(Blob.objects.filter(pk=file_hash).exists())
+        self.assertFalse(get_blob_store().exists(BLOBS, file_hash))
+
+    def test_concurrent_deletes_release_the_blob_once(self):
+        first = self.upload(self.client, self.data, name='a.bin')
+        self.upload(self.client, self.data, name='b.bin')
+        # Both requests loaded the file before either deleted it
+        stale = FileMetadata.objects.get(pk=first['id'])
+        self.assertEqual(self.client.delete(f"/api/vault/files/{first['id']}/").status_code, 204)
+        FileMetadataViewSet().perform_destroy(stale)
+
+        self.assertEqual(Blob.objects.get(pk=first['file_hash']).ref_count, 1)
+        self.assertTrue(get_blob_store().exists(BLOBS, first['file_hash']))
+        self.assertEqual(self.client.get('/api/vault/stats/').data['file_count'], 1)
+
+    def test_stats_count_duplicates_once(self):
+        self.upload(self.client, self.data, name='a.bin')
+        self.upload(self.client, self.data, name='b.bin')
+        self.upload(self.client, b'other content', name='c.txt', content_type='text/plain')
+        stats = self.client.get('/api/vault/stats/').data
+        self.assertEqual(stats['file_count'], 3)
+        self.assertEqual(stats['logical_bytes'], 2 * len(self.data) + 13)
+        self.assertEqual(stats['physical_bytes'], len(self.data) + 13)
+        self.assertEqual(stats['dedup_savings_bytes'], len(self.data))
+
+    def test_orphan_file_with_the_content_is_adopted(self):
+        # Left behind e.g. by an upload whose transaction rolled back
+        self.store_orphan(sha256(self.data), self.data)
+        file = self.upload(self.client, self.data)
+        self.assertEqual(self.content(self.client.get(f"/api/vault/files/{file['id']}/download/")), self.data)
+
+    def test_orphan_file_with_other_content_is_replaced(self):
+        self.store_orphan(sha256(self.data), b'not the content')
+        with self.assertLogs('vault.services', 'WARNING'):
+            file = self.upload(self.client, self.data)
+        self.assertEqual(self.content(self.client.get(f"/api/vault/files/{file['id']}/download/")), self.data)
+
+    def test_deleting_a_user_releases_their_files(self):
+        self.upload(self.client, self.data, name='a.bin')
+        bob, other = self.make_user('bob')
+        self.upload(other, self.data, name='b.bin')
+        self.upload(other, b'only bob has this', name='c.txt', content_type='text/plain')
+
+        bob.delete()
+        self.assertEqual(Blob.objects.get(pk=sha256(self.data)).ref_count, 1)
+        self.assertFalse(Blob.objects.filter(pk=sha256(b'only bob has this')).exists())
+        self.assertFalse(get_blob_store().exists(BLOBS, sha256(b'only bob has this')))
+
+    def store_orphan(self, file_hash, data):
+        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+            temp_file.write(data)
+        get_blob_store().save_file(BLOBS, file_hash, temp_file.name)
+
+
+class BulkTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user()
+
+    def bulk_upload(self, *files):
+        return self.client.post(
+            '/api/vault/files/bulk-upload/',
+            {'files': [SimpleUploadedFile(name, data, content_type=content_type) for name, data, content_type in files]},
+            format='multipart',
+        )
+
+    def test_bulk_upload(self):
+        response = self.bulk_upload(
+            ('a.txt', b'same', 'text/plain'),
+            ('b.txt', b'same', 'text/plain'),
+            ('c.txt', b'different', 'text/plain'),
+        )
+        self.assertEqual(response.status_code, 201)
+        results = response.data['results']
+        self.assertEqual([result['duplicate'] for result in results], [False, True, False])
+        self.assertEqual(Blob.objects.get(pk=sha256(b'same')).ref_count, 2)
+        self.assertEqual(FileMetadata.objects.filter(owner=self.user).count(), 3)
+
+    def test_bulk_upload_reports_invalid_files(self):
+        response = self.bulk_upload(('a.txt', b'fine', 'text/plain'), ('b.txt', b'bad', 'not a type'))
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual([result['status'] for result in response.data['results']], [201, 400])
+
+    def test_bulk_delete_by_ids(self):
+        results = self.bulk_upload(('a.txt', b'same', 'text/plain'), ('b.txt', b'same', 'text/plain')).data['results']
+        ids = [result['file']['id'] for result in results]
+        response = self.client.post('/api/vault/files/bulk-delete/', {'ids': [*ids, 99999]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['deleted'], 2)
+        self.assertEqual(response.data['blobs_removed'], 1)
+        self.assertEqual([result['status'] for result in response.data['results']], [204, 204, 404])
+        self.assertFalse(Blob.objects.exists())
+
+    def test_bulk_delete_by_filter(self):
+        self.bulk_upload(('a.txt', b'text', 'text/plain'), ('b.png', b'image', 'image/png'))
+        response = self.client.post('/api/vault/files/bulk-delete/', {'filter': {'content_type': 'image'}}, format='json')
+        self.assertEqual(response.data['deleted'], 1)
+        self.assertEqual(list(FileMetadata.objects.values_list('original_filename', flat=True)), ['a.txt'])
+
+    def test_bulk_delete_rejects_unknown_or_empty_filters(self):
+        self.bulk_upload(('a.txt', b'text', 'text/plain'))
+        for selection in ({'filter': {'content_typ': 'image'}}, {'filter': {'search': '  '}}, {}):
+            response = self.client.post('/api/vault/files/bulk-delete/', selection, format='json')
+            self.assertEqual(response.status_code, 400, selection)
+        self.assertEqual(FileMetadata.objects.count(), 1)
+
+
+@override_settings(VAULT_UPLOAD_MIN_CHUNK_SIZE=1000)
+class UploadSessionTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user()
+        self.data = os.urandom(2500)
+
+    def create_session(self, **extra):
+        response = self.client.post('/api/vault/uploads/', {
+            'original_filename': 'big.bin',
+            'content_type': 'application/octet-stream',
+            'file_size': len(self.data),
+            'chunk_size': 1000,
+            **extra,
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.data
+
+    def send_chunk(self, session, index, data=None, chunk_hash=None):
+        data = self.data[index * 1000:(index + 1) * 1000] if data is None else data
+        return self.client.generic(
+            'PUT', f"/api/vault/uploads/{session['id']}/chunks/{index}/", data,
+            content_type='application/octet-stream', HTTP_X_CHUNK_SHA256=chunk_hash or sha256(data),
+        )
+
+    def finalize(self, session):
+        return self.client.post(f"/api/vault/uploads/{session['id']}/finalize/")
+
+    def test_chunks_in_any_order(self):
+        session = self.create_session(expected_hash=sha256(self.data))
+        self.assertEqual(session['total_chunks'], 3)
+        for index in (2, 0):
+            self.assertEqual(self.send_chunk(session, index).status_code, 200)
+
+        status = self.client.get(f"/api/vault/uploads/{session['id']}/").data
+        self.assertEqual(status['received_chunks'], [0, 2])
+        self.assertEqual(status['received_ranges'], [[0, 1000], [2000, 2500]])
+        response = self.finalize(session)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['missing_chunks'], [1])
+
+        self.send_chunk(session, 1)
+        response = self.finalize(session)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['file_hash'], sha256(self.data))
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.path.exists(get_session_part_path(session['id'])))
+        download = self.client.get(f"/api/vault/files/{response.data['id']}/download/")
+        self.assertEqual(self.content(download), self.data)
+
+    def test_bad_chunks_are_rejected(self):
+        session = self.create_session()
+        self.assertEqual(self.send_chunk(session, 0, chunk_hash='0' * 64).status_code, 400)
+        self.assertEqual(self.send_chunk(session, 0, data=b'short').status_code, 400)
+        self.assertEqual(self.send_chunk(session, 3, data=b'').status_code, 400)
+        self.assertEqual(self.client.get(f"/api/vault/uploads/{session['id']}/").data['received_chunks'], [])
+
+    def test_expected_hash_mismatch(self):
+        session = self.create_session(expected_hash='0' * 64)
+        for index in range(3):
+            self.send_chunk(session, index)
+        self.assertEqual(self.finalize(session).status_code, 400)
+        # The failed finalize reopens the session for chunks
+        self.assertFalse(UploadSession.objects.get().finalizing)
+        self.assertEqual(self.send_chunk(session, 0).status_code, 200)
+
+    def test_no_chunk_is_written_while_finalizing(self):
+        session = self.create_session()
+        for index in range(3):
+            self.send_chunk(session, index)
+        # As a finalize hashing the part file leaves it
+        UploadSession.objects.update(finalizing=True)
+        response = self.send_chunk(session, 1, data=b'x' * 1000)
+        self.assertEqual(response.status_code, 409)
+        with open(get_session_part_path(session['id']), 'rb') as part_file:
+            self.assertEqual(part_file.read(), self.data)
+        self.assertEqual(self.finalize(session).status_code, 409)
+
+    def test_expired_sessions(self):
+        session = self.create_session()
+        UploadSession.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.send_chunk(session, 0).status_code, 404)
+        self.assertEqual(self.finalize(session).status_code, 404)
+
+        out = StringIO()
+        call_command('vault_expire_uploads', stdout=out)
+        self.assertIn("Deleted 1 expired upload session(s).", out.getvalue())
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.path.exists(get_session_part_path(session['id'])))
+
+    @override_settings(VAULT_UPLOAD_MIN_CHUNK_SIZE=64 * 1024, VAULT_UPLOAD_MAX_CHUNKS=4)
+    def test_chunk_count_is_bounded(self):
+        for file_size, chunk_size in ((2500, 1), (2500, 1000), (5 * 64 * 1024, 64 * 1024)):
+            response = self.client.post('/api/vault/uploads/', {
+                'original_filename': 'big.bin', 'content_type': 'application/octet-stream',
+                'file_size': file_size, 'chunk_size': chunk_size,
+            }, format='json')
+            self.assertEqual(response.status_code, 400, (file_size, chunk_size))
+            self.assertIn('chunk_size', response.data)
+        # Smaller than the minimum is fine for the last (here: only) chunk
+        self.assertEqual(self.create_session(chunk_size=64 * 1024)['total_chunks'], 1)
+
+    def test_other_users_cannot_use_a_session(self):
+        session = self.create_session()
+        _, other = self.make_user('bob')
+        self.assertEqual(other.get(f"/api/vault/uploads/{session['id']}/").status_code, 404)
+
+
+class ClaimTests(VaultTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.client = self.make_user()
+        self.data = os.urandom(200_000)
+        self.claim_data = {'sha256': sha256(self.data), 'size': len(self.data), 'filename': 'copy.bin'}
+
+    def claim(self, client, **extra):
+        return client.post('/api/vault/files/claim/', {**self.claim_data, **extra}, format='json')
+
+    def test_owner_claims_without_proof(self):
+        self.upload(self.client, self.data)
+        response = self.claim(self.client)
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(response.data['upload_required'])
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+
+    def test_others_must_prove_possession(self):
+        self.upload(self.client, self.data)
+        bob, other = self.make_user('bob')
+
+        response = self.claim(other)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['upload_required'])
+        challenge, ranges = response.data['challenge'], response.data['ranges']
+        self.assertEqual(len(ranges), 3)
+
+        wrong = self.claim(other, challenge=challenge, proofs=['0' * 64] * len(ranges))
+        self.assertTrue(wrong.data['upload_required'])
+        self.assertFalse(FileMetadata.objects.filter(owner=bob).exists())
+
+        proofs = [sha256(self.data[start:end]) for start, end in ranges]
+        response = self.claim(other, challenge=challenge, proofs=proofs)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['file']['original_filename'], 'copy.bin')
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+
+    def test_challenge_is_bound_to_the_user(self):
+        self.upload(self.client, self.data)
+        _, bob = self.make_user('bob')
+        _, carol = self.make_user('carol')
+        response = self.claim(bob)
+        proofs = [sha256(self.data[start:end]) for start, end in response.data['ranges']]
+        stolen = self.claim(carol, challenge=response.data['challenge'], proofs=proofs)
+        self.assertTrue(stolen.data['upload_required'])
+
+    def test_unknown_content_gets_the_same_answer(self):
+        response = self.claim(self.client)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['upload_required'])
+        self.assertIn('challenge', response.data)
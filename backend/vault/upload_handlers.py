@@ -0,0 +1,79 @@
+# vault/upload_handlers.py
+import hashlib
+import os
+import time
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+from .storage import create_temp_file
+
+
+class HashedUploadedFile(UploadedFile):
+    """
+    An uploaded file streamed to a temp file in the storage volume.
+    Carries the SHA-256 of its content (computed while the request body
+    was parsed) so views never have to read the bytes a second time.
+    """
+
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        file = create_temp_file()
+        super().__init__(file, name, content_type, size, charset, content_type_extra)
+        self.file_hash = None
+        # Seconds spent hashing and writing the temp file, for the upload's phase timings
+        self.hash_seconds = 0.0
+        self.spool_seconds = 0.0
+
+    def temporary_file_path(self):
+        """
+        Returns the full path of this file on disk. The view renames it into
+        storage (see vault.services.acquire_blob) instead of copying it.
+        """
+        return self.file.name
+
+    def close(self):
+        """Closes the file and removes the temp copy if it was not moved into storage."""
+        try:
+            return self.file.close()
+        finally:
+            try:
+                os.remove(self.temporary_file_path())
+            except FileNotFoundError:
+                pass # Already renamed into storage (or dropped as a duplicate)
+
+
+class HashingFileUploadHandler(FileUploadHandler):
+    """
+    Upload handler that hashes each chunk as it arrives and writes it straight
+    to a temp file next to the blob store. Memory use per upload is bounded by
+    chunk_size, regardless of the file size.
+    """
+    chunk_size = 256 * 2 ** 10  # 256 KB
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hasher = hashlib.sha256()
+        self.file = HashedUploadedFile(
+            self.file_name, self.content_type, 0, self.charset, self.content_type_extra
+        )
+
+    def receive_data_chunk(self, raw_data, start):
+        started = time.perf_counter()
+        self.hasher.update(raw_data)
+        hashed = time.perf_counter()
+        self.file.write(raw_data)
+        self.file.hash_seconds += hashed - started
+        self.file.spool_seconds += time.perf_counter() - hashed
+        # Returning None tells Django not to pass the chunk to later handlers
+
+    def file_complete(self, file_size):
+        self.file.flush()
+        self.file.seek(0)
+        self.file.size = file_size
+        self.file.file_hash = self.hasher.hexdigest()
+        return self.file
+
+    def upload_interrupted(self):
+        # Client disconnected mid-upload: discard the partial temp file
+        if hasattr(self, 'file'):
+            self.file.close()
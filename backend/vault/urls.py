@@ -1,22 +1,39 @@
 # vault/urls.py
+from django.conf import settings
 from django.urls import path, include
+from django.urls.resolvers import URLPattern
 from rest_framework.routers import DefaultRouter # Restore router import
 # Import all necessary views
-from .views import FileMetadataViewSet, UserCreate # Restore FileMetadataViewSet import
+from .views import FileMetadataViewSet, StorageStatsView, UploadSessionViewSet, UserCreate # Restore FileMetadataViewSet import
+from .async_views import ASYNC_ROUTES
 
 # Create a router and register our FileMetadata viewset with it.
 # This automatically creates URLs for list, create, retrieve, update, destroy actions
 # and the custom 'download' action.
 router = DefaultRouter() # Restore router definition
 router.register(r'files', FileMetadataViewSet, basename='filemetadata') # Restore router registration
+# Resumable chunked uploads: /uploads/, /uploads/{id}/chunks/{index}/, /uploads/{id}/finalize/
+router.register(r'uploads', UploadSessionViewSet, basename='uploadsession')
+
+router_urls = router.urls
+if settings.VAULT_ASYNC_TRANSFERS:
+    # Under ASGI, uploads, downloads and change log long-polls are served by
+    # async wrappers of the same views
+    router_urls = [
+        URLPattern(url.pattern, ASYNC_ROUTES[url.name](url.callback), url.default_args, url.name)
+        if url.name in ASYNC_ROUTES else url
+        for url in router_urls
+    ]
 
 # Define urlpatterns
 urlpatterns = [
     # Add the specific path for user registration FIRST
     path('register/', UserCreate.as_view(), name='user_register'),
 
+    # Storage usage and deduplication savings of the current user
+    path('stats/', StorageStatsView.as_view(), name='storage_stats'),
+
     # Include the router URLs for the 'files' endpoint AFTER specific paths
     # This handles /api/vault/files/, /api/vault/files/{pk}/, /api/vault/files/{pk}/download/ etc.
-    path('', include(router.urls)), # Restore including router URLs
+    path('', include(router_urls)), # Restore including router URLs
 ]
-
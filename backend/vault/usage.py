@@ -0,0 +1,191 @@
+# vault/usage.py
+"""
+Storage usage counters: one StorageUsage row per user and the VaultUsage row
+for the whole vault. They are updated in the same transaction as the
+FileMetadata / Blob change they describe, so the stats endpoint reads a
+couple of rows instead of aggregating over every file.
+
+Lock order is always Blob rows -> Chunk rows -> VaultUsage row -> StorageUsage
+row, the same order the upload and delete paths already take, so counters add
+no deadlocks.
+`manage.py vault_reconcile_usage` recomputes everything from scratch.
+"""
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+
+from .changes import log_changes
+from .models import FileChange, FileMetadata, StorageUsage, VaultUsage
+
+# Primary key of the single VaultUsage row
+VAULT_USAGE_PK = 1
+
+
+def _add_to_row(model, pk, **deltas):
+    """Adds deltas to the counter row model(pk), creating the row if needed."""
+    updated = model.objects.filter(pk=pk).update(
+        **{field: F(field) + delta for field, delta in deltas.items()}
+    )
+    if updated:
+        return
+    try:
+        # Savepoint, so a lost creation race does not abort the outer transaction
+        with transaction.atomic():
+            model.objects.create(pk=pk, **deltas)
+    except IntegrityError:
+        # Created concurrently by another transaction: add to that row instead
+        model.objects.filter(pk=pk).update(
+            **{field: F(field) + delta for field, delta in deltas.items()}
+        )
+
+
+def count_blobs_added(blobs):
+    """
+    Call in the transaction that gives the blobs their first reference,
+    once their content is stored (Blob.chunked / codec are set).
+    """
+    _add_to_row(
+        VaultUsage, VAULT_USAGE_PK,
+        blob_count=len(blobs),
+        physical_bytes=sum(blob.size for blob in blobs),
+        chunked_bytes=sum(blob.size for blob in blobs if blob.chunked),
+        compression_saved_bytes=_compression_saved_bytes(blobs),
+    )
+
+
+def count_blobs_removed(blobs):
+    """Call in the transaction that drops the blobs' last reference."""
+    _add_to_row(
+        VaultUsage, VAULT_USAGE_PK,
+        blob_count=-len(blobs),
+        physical_bytes=-sum(blob.size for blob in blobs),
+        chunked_bytes=-sum(blob.size for blob in blobs if blob.chunked),
+        compression_saved_bytes=-_compression_saved_bytes(blobs),
+    )
+
+
+def _compression_saved_bytes(blobs):
+    return sum(blob.size - blob.stored_size for blob in blobs if blob.codec)
+
+
+def count_chunks_added(chunks):
+    """Call in the transaction that gives the chunks their first reference."""
+    _add_to_row(
+        VaultUsage, VAULT_USAGE_PK,
+        chunk_count=len(chunks), chunk_bytes=sum(chunk.size for chunk in chunks),
+    )
+
+
+def count_chunks_removed(chunks):
+    """Call in the transaction that drops the chunks' last reference."""
+    _add_to_row(
+        VaultUsage, VAULT_USAGE_PK,
+        chunk_count=-len(chunks), chunk_bytes=-sum(chunk.size for chunk in chunks),
+    )
+
+
+def _usage_deltas(instances):
+    """
+    Yields (owner_id, rows, file_count, logical_bytes, physical_bytes) for the
+    given FileMetadata rows, where physical bytes only include the blobs their owner
+    has no other record of. One query per owner.
+    """
+    by_owner = defaultdict(list)
+    for instance in instances:
+        by_owner[instance.owner_id].append(instance)
+    for owner_id, owned in by_owner.items():
+        sizes = {instance.blob_id: instance.file_size for instance in owned}
+        referenced_elsewhere = set(
+            FileMetadata.objects
+            .filter(owner_id=owner_id, blob_id__in=sizes)
+            .exclude(pk__in=[instance.pk for instance in owned])
+            .values_list('blob_id', flat=True)
+            .distinct()
+        )
+        physical = sum(size for blob_id, size in sizes.items() if blob_id not in referenced_elsewhere)
+        yield owner_id, owned, len(owned), sum(instance.file_size for instance in owned), physical
+
+
+def count_files_added(instances):
+    """
+    Adds newly inserted FileMetadata rows to their owners' usage.
+    Must run in the inserting transaction, after the blobs were locked by
+    acquire_blob(s) or claim_blob: the locks serialize every change to the
+    blobs' references, which makes the "first copy for this user" check exact.
+    Also bumps the owners' version, which invalidates their cached file lists,
+    and records the new files in their change log.
+    """
+    for owner_id, owned, files, logical, physical in _usage_deltas(instances):
+        _add_to_row(
+            StorageUsage, owner_id,
+            file_count=files, logical_bytes=logical, physical_bytes=physical, version=1,
+        )
+        log_changes(owner_id, owned, FileChange.CREATED)
+
+
+def count_files_removed(instances):
+    """
+    Removes deleted FileMetadata rows from their owners' usage.
+    Same rules as count_files_added: call after release_blob(s) took the locks.
+    The instances must still have their IDs (delete through a queryset).
+    """
+    for owner_id, owned, files, logical, physical in _usage_deltas(instances):
+        _add_to_row(
+            StorageUsage, owner_id,
+            file_count=-files, logical_bytes=-logical, physical_bytes=-physical, version=1,
+        )
+        log_changes(owner_id, owned, FileChange.DELETED)
+
+
+def get_user_usage(user):
+    """Counters of one user, as a dict."""
+    usage = StorageUsage.objects.filter(pk=user.pk).first() or StorageUsage(user=user)
+    return {
+        'file_count': usage.file_count,
+        'logical_bytes': usage.logical_bytes,
+        'physical_bytes': usage.physical_bytes,
+        # Bytes this user did not add to storage thanks to their own duplicates
+        'dedup_savings_bytes': usage.logical_bytes - usage.physical_bytes,
+    }
+
+
+def get_vault_usage():
+    """
+    Counters of the whole vault, as a dict. Logical totals are summed over
+    the per-user rows (one per user, not one per file).
+    """
+    vault = VaultUsage.objects.filter(pk=VAULT_USAGE_PK).first() or VaultUsage()
+    totals = StorageUsage.objects.aggregate(
+        file_count=Sum('file_count'), logical_bytes=Sum('logical_bytes'),
+    )
+    logical_bytes = totals['logical_bytes'] or 0
+    # Chunked blobs take up their unique chunks instead of their own size
+    deduplicated_bytes = vault.physical_bytes - vault.chunked_bytes + vault.chunk_bytes
+    # ... and compressed blobs their stored size
+    stored_bytes = deduplicated_bytes - vault.compression_saved_bytes
+    return {
+        'file_count': totals['file_count'] or 0,
+        'blob_count': vault.blob_count,
+        'logical_bytes': logical_bytes,
+        'physical_bytes': vault.physical_bytes,
+        'stored_bytes': stored_bytes,
+        'dedup_savings_bytes': logical_bytes - deduplicated_bytes,
+        # Logical / deduplicated: 2.0 means every unique byte is referenced twice
+        'dedup_ratio': _ratio(logical_bytes, deduplicated_bytes),
+        'chunk_store': {
+            'chunk_count': vault.chunk_count,
+            # Unique content held by chunked blobs, and the chunks it takes up
+            'logical_bytes': vault.chunked_bytes,
+            'stored_bytes': vault.chunk_bytes,
+            'dedup_ratio': _ratio(vault.chunked_bytes, vault.chunk_bytes),
+        },
+        'compression': {
+            'saved_bytes': vault.compression_saved_bytes,
+            'ratio': _ratio(deduplicated_bytes, stored_bytes),
+        },
+    }
+
+
+def _ratio(numerator, denominator):
+    return round(numerator / denominator, 4) if denominator else None
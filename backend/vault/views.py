@@ -1,22 +1,63 @@
 # vault/views.py
-from rest_framework import viewsets, permissions, generics # Added generics
+from rest_framework import viewsets, mixins, permissions, generics, serializers # Added generics
 from rest_framework.decorators import action
-from django.http import FileResponse, Http404
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework.authtoken.models import Token
+from rest_framework.authtoken.views import ObtainAuthToken
+from rest_framework.settings import api_settings
+from rest_framework import status
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.http import content_disposition_header
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from django.contrib.auth import get_user_model
 import hashlib
+import logging
+import os
+import re
+import shutil
+import time
+from collections import Counter
 
 # Imports for filtering
 from django_filters.rest_framework import DjangoFilterBackend
 from .filters import FileMetadataFilter
+from .pagination import FileKeysetPagination
 
 # Imports for models and serializers
-from .models import FileMetadata
-from .serializers import FileMetadataSerializer, UserSerializer # Import both serializers
+from .models import Blob, FileChange, FileMetadata, UploadSession, UploadChunk, session_expiry
+from .serializers import (
+    BulkDeleteSerializer, FileChangeSerializer, FileMetadataSerializer, FileClaimSerializer,
+    UploadSessionSerializer, UserSerializer
+)
+from .storage import create_temp_file, get_session_part_path
+from .services import (
+    acquire_blob, acquire_blobs, claim_blob, open_blob, open_stored_blob, prepare_content, prepare_contents,
+    release_blob, release_blobs
+)
+from .blobstore import BLOBS, get_blob_store
+from .usage import count_files_added, count_files_removed, get_user_usage, get_vault_usage
+from .downloads import (
+    accel_redirect_response, accepts_encoding, blob_response, encoded_blob_response,
+    is_valid_media_type, not_modified_response
+)
+from .claims import challenge_ranges, make_challenge, verify_proofs
+from .archivelinks import ArchiveLinkAuthentication, make_archive_link
+from .archives import iter_archive_files, iter_zip_archive
+from .listcache import cached_response
+from .authentication import is_token_expired
+from .metrics import BLOBS_REMOVED, DELETES, DOWNLOAD_BYTES, DOWNLOADS, PhaseTimer, record_upload
+from .changes import MAX_PAGE_SIZE, PAGE_SIZE, decode_cursor, get_changes, parse_wait, wait_for_changes
 
 User = get_user_model() # Get active user model
 
+logger = logging.getLogger(__name__)
+
 # --- File Metadata ViewSet ---
 class FileMetadataViewSet(viewsets.ModelViewSet):
     """
@@ -30,6 +71,10 @@ class FileMetadataViewSet(viewsets.ModelViewSet):
     filter_backends = [DjangoFilterBackend] # Specify the backend to use
     filterset_class = FileMetadataFilter    # Specify our custom filter class
 
+    # --- Pagination Setup ---
+    # Keyset pagination on (upload_date, id): follow the 'next' link for more
+    pagination_class = FileKeysetPagination
+
     def get_queryset(self):
         """
         This view returns a list of all file metadata records owned by the
@@ -37,12 +82,26 @@ class FileMetadataViewSet(viewsets.ModelViewSet):
         Filtering is applied automatically by DjangoFilterBackend based on filterset_class.
         """
         # Filter files based on the logged-in user
-        return FileMetadata.objects.filter(owner=self.request.user).order_by('-upload_date')
+        queryset = FileMetadata.objects.filter(owner=self.request.user).order_by('-upload_date', '-id')
+        if self.action in ('download', 'list', 'retrieve'):
+            # How the blob is stored decides how it is sent, and the metadata
+            # shows the blob's detected_type
+            queryset = queryset.select_related('blob')
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        """Lists the user's files, served from the per-user response cache when current."""
+        return cached_response(request, lambda: super(FileMetadataViewSet, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        """Returns one file's metadata, cached like the list."""
+        return cached_response(request, lambda: super(FileMetadataViewSet, self).retrieve(request, *args, **kwargs))
 
     def perform_create(self, serializer):
         """
-        Handle file upload, calculate hash, perform deduplication,
-        save file if new, and save metadata associated with the logged-in user.
+        Handle file upload, perform deduplication, move the blob into
+        storage if new, and save metadata associated with the logged-in user.
+        The upload was already hashed and spooled to disk by the upload handler.
         """
         # --- Get the uploaded file ---
         # 'file' should be the name of the file field in the upload request
@@ -51,103 +110,776 @@ class FileMetadataViewSet(viewsets.ModelViewSet):
         if not uploaded_file:
             # Raise validation error if no file is provided
             raise serializers.ValidationError("No file uploaded.")
+        if uploaded_file.content_type and not is_valid_media_type(uploaded_file.content_type):
+            # Sent back as the Content-Type of downloads
+            raise serializers.ValidationError("Invalid content type.")
 
-        # --- Calculate Hash ---
-        hasher = hashlib.sha256()
-        for chunk in uploaded_file.chunks():
-            hasher.update(chunk)
-        file_hash = hasher.hexdigest()
-        uploaded_file.seek(0) # Reset file pointer
+        # --- Hash ---
+        # Computed by HashingFileUploadHandler while the request body was parsed,
+        # the file content itself is already sitting in a temp file on disk.
+        file_hash = uploaded_file.file_hash
+        phases = PhaseTimer('upload')
+        phases.record('hash', uploaded_file.hash_seconds)
+        phases.record('spool', uploaded_file.spool_seconds)
 
-        # --- Deduplication Check ---
-        existing_file = FileMetadata.objects.filter(file_hash=file_hash).first()
-        storage_key = f"uploads/{file_hash}" # Path within MEDIA_ROOT
+        # --- Chunking / Compression ---
+        # Slow for large new content, so done before any lock is taken
+        prepared = prepare_content(
+            file_hash, uploaded_file.size, uploaded_file.temporary_file_path(),
+            content_type=uploaded_file.content_type, timer=phases,
+        )
 
-        if existing_file:
-            # Duplicate detected based on hash
-            print(f"Duplicate detected. Hash: {file_hash}")
-            # Physical file already exists, no need to save blob again.
-        else:
-            # File hash is new, save the actual file content to storage
-            print(f"New file detected. Saving with hash: {file_hash}")
+        # --- Deduplication + Save Blob + Save Metadata ---
+        # One transaction: lock (or create) the Blob row, move the temp file
+        # (or its prepared chunks / compressed copy) into storage if the blob
+        # is new, bump its reference count, insert the metadata row and
+        # update the owner's usage counters.
+        with prepared, transaction.atomic():
             try:
-                saved_file_name = default_storage.save(storage_key, ContentFile(uploaded_file.read()))
-                print(f"File saved to: {saved_file_name}")
-            except Exception as e:
-                print(f"ERROR saving file {storage_key}: {e}")
+                # Times its dedup lookup and blob write phases
+                blob, is_new_blob = acquire_blob(
+                    file_hash, uploaded_file.size, uploaded_file.temporary_file_path(),
+                    content_type=uploaded_file.content_type, timer=phases, prepared=prepared,
+                )
+            except OSError as e:
+                logger.error("Failed to save file to storage", extra={'file_hash': file_hash, 'error': str(e)})
                 # Raise an error to prevent metadata creation if file save fails
                 raise serializers.ValidationError("Failed to save file to storage.")
-            uploaded_file.seek(0) # Reset pointer again after read()
-
-        # --- Save Metadata ---
-        # Pass necessary metadata derived from the file and the request.
-        # Serializer uses read_only_fields to prevent client overwriting these.
-        serializer.save(
-            owner=self.request.user,
-            original_filename=uploaded_file.name,
-            file_hash=file_hash,
-            file_size=uploaded_file.size,
-            content_type=uploaded_file.content_type
+
+            # Pass necessary metadata derived from the file and the request.
+            # Serializer uses read_only_fields to prevent client overwriting these.
+            with phases('metadata_insert'):
+                serializer.save(
+                    owner=self.request.user,
+                    original_filename=uploaded_file.name,
+                    file_hash=file_hash,
+                    file_size=uploaded_file.size,
+                    content_type=uploaded_file.content_type,
+                    blob=blob,
+                )
+                count_files_added([serializer.instance])
+            committing = time.perf_counter()
+        phases.record('commit', time.perf_counter() - committing)
+
+        record_upload(uploaded_file.size, is_new_blob)
+        # A duplicate's uploaded copy was discarded, the stored content is reused
+        logger.info("Upload stored", extra={
+            'file_id': serializer.instance.pk,
+            'file_hash': file_hash,
+            'file_size': uploaded_file.size,
+            'duplicate': not is_new_blob,
+            'phases_ms': phases.as_ms(),
+        })
+
+    @action(detail=False, methods=['post'])
+    def claim(self, request):
+        """
+        Hash-first upload probe: POST {sha256, size, filename, content_type}.
+        If the caller already has a file with this content, the metadata record
+        is created right away (201) and the client skips sending the bytes.
+        Otherwise responds 200 with upload_required=True and a proof-of-
+        possession challenge: byte ranges of the file ([start, end), end
+        exclusive). Posting the claim again with the 'challenge' and 'proofs'
+        (hex SHA-256 of each range, in order) adds the file without sending it
+        if the vault stores that content; any other outcome is 200 with
+        upload_required=True, and the client falls back to a normal upload.
+        See vault/claims.py.
+        """
+        claim_serializer = FileClaimSerializer(data=request.data)
+        claim_serializer.is_valid(raise_exception=True)
+        claim = claim_serializer.validated_data
+
+        file_hash = claim['sha256']
+        size = claim['size']
+        upload_required = Response({'upload_required': True}, status=status.HTTP_200_OK)
+
+        # Size must match too, so a bare hash is not enough to claim a blob
+        owned = FileMetadata.objects.filter(owner=request.user, file_hash=file_hash, file_size=size).exists()
+        if not owned:
+            if 'challenge' not in claim:
+                # Same answer whether or not the content is stored
+                return Response(
+                    {'upload_required': True, **make_challenge(request.user.pk, file_hash, size)},
+                    status=status.HTTP_200_OK,
+                )
+            ranges = challenge_ranges(claim['challenge'], request.user.pk, file_hash, size)
+            blob = Blob.objects.filter(hash=file_hash, size=size).first() if ranges is not None else None
+            if blob is None:
+                return upload_required
+            try:
+                proven = verify_proofs(blob, ranges, claim['proofs'])
+            except OSError:
+                proven = False # Deleted meanwhile, or missing from storage
+            if not proven:
+                logger.info("Claim proof rejected", extra={'file_hash': file_hash, 'user_id': request.user.pk})
+                return upload_required
+
+        with transaction.atomic():
+            blob = claim_blob(file_hash, size)
+            if blob is None:
+                return upload_required # The last copy was deleted meanwhile
+
+            instance = FileMetadata.objects.create(
+                owner=request.user,
+                original_filename=claim['filename'],
+                file_hash=file_hash,
+                file_size=size,
+                content_type=claim['content_type'],
+                blob=blob,
+            )
+            count_files_added([instance])
+        record_upload(instance.file_size, is_new_blob=False, claimed=True)
+        logger.info("Claim matched existing blob", extra={
+            'file_id': instance.pk, 'file_hash': file_hash, 'proven': not owned,
+        })
+        return Response(
+            {'upload_required': False, 'file': FileMetadataSerializer(instance).data},
+            status=status.HTTP_201_CREATED,
+        )
+
+    @action(detail=False, methods=['post'], url_path='bulk-upload')
+    def bulk_upload(self, request):
+        """
+        Uploads many files in one multipart request (repeat the 'files' field).
+        All valid files are stored in a single transaction: blobs are locked
+        and reference-counted as a set and the metadata rows are written with
+        one bulk INSERT. Responds with one result per file, in request order
+        (201 if every file was stored, 207 otherwise).
+        """
+        uploaded_files = request.FILES.getlist('files')
+        if not uploaded_files:
+            raise serializers.ValidationError("No files uploaded.")
+
+        results = [None] * len(uploaded_files)
+        accepted = [] # (index, uploaded_file)
+        for index, uploaded_file in enumerate(uploaded_files):
+            error = None
+            # Filenames are already cut to 255 characters by Django's upload parser
+            if len(uploaded_file.content_type or '') > FileMetadata._meta.get_field('content_type').max_length:
+                error = "Content type is too long."
+            elif uploaded_file.content_type and not is_valid_media_type(uploaded_file.content_type):
+                error = "Invalid content type."
+            if error:
+                results[index] = {'index': index, 'filename': uploaded_file.name, 'status': 400, 'error': error}
+            else:
+                accepted.append((index, uploaded_file))
+
+        if accepted:
+            uploads = [(f.file_hash, f.size, f.temporary_file_path(), f.content_type) for _, f in accepted]
+            # Chunking and compression happen before the blobs are locked
+            with prepare_contents(uploads) as prepared, transaction.atomic():
+                try:
+                    blobs, new_hashes = acquire_blobs(uploads, prepared=prepared)
+                except OSError as e:
+                    logger.error("Failed to save files of bulk upload", extra={'error': str(e)})
+                    raise serializers.ValidationError("Failed to save files to storage.")
+
+                instances = FileMetadata.objects.bulk_create([
+                    FileMetadata(
+                        owner=request.user,
+                        original_filename=f.name,
+                        file_hash=f.file_hash,
+                        file_size=f.size,
+                        content_type=f.content_type,
+                        blob=blobs[f.file_hash],
+                    )
+                    for _, f in accepted
+                ])
+                count_files_added(instances)
+            logger.info("Bulk upload stored", extra={'files': len(instances), 'new_blobs': len(new_hashes)})
+
+            seen_hashes = set()
+            for (index, uploaded_file), instance in zip(accepted, instances):
+                # Only the first copy of new content within the batch is not a duplicate
+                duplicate = instance.file_hash in seen_hashes or instance.file_hash not in new_hashes
+                seen_hashes.add(instance.file_hash)
+                record_upload(instance.file_size, is_new_blob=not duplicate)
+                results[index] = {
+                    'index': index,
+                    'filename': uploaded_file.name,
+                    'status': 201,
+                    'duplicate': duplicate,
+                    'file': FileMetadataSerializer(instance).data,
+                }
+
+        all_stored = len(accepted) == len(uploaded_files)
+        return Response(
+            {'results': results},
+            status=status.HTTP_201_CREATED if all_stored else status.HTTP_207_MULTI_STATUS,
         )
 
+    @action(detail=False, methods=['post'], url_path='bulk-delete')
+    def bulk_delete(self, request):
+        """
+        Deletes many files: POST {"ids": [...]} or {"filter": {...}}, the filter
+        taking the same parameters as the file list. Files are deleted in
+        batches of VAULT_BULK_BATCH_SIZE, each in one transaction.
+        With ids, every ID gets a result (204, or 404 if it is not one of the
+        user's files); with a filter, every deleted file does.
+        """
+        delete_serializer = BulkDeleteSerializer(data=request.data)
+        delete_serializer.is_valid(raise_exception=True)
+        selection = delete_serializer.validated_data
+        batch_size = settings.VAULT_BULK_BATCH_SIZE
+
+        results = []
+        blobs_removed = 0
+        if 'ids' in selection:
+            ids = list(dict.fromkeys(selection['ids'])) # Unique, in request order
+            for start in range(0, len(ids), batch_size):
+                batch = ids[start:start + batch_size]
+                deleted, removed = self.delete_batch(batch)
+                blobs_removed += removed
+                results.extend(
+                    {'id': pk, 'status': 204} if pk in deleted
+                    else {'id': pk, 'status': 404, 'error': "Not found."}
+                    for pk in batch
+                )
+        else:
+            unknown = set(selection['filter']) - self.filterset_class.get_param_names()
+            if unknown:
+                # django-filter ignores unknown parameters, which here would
+                # widen the selection: a typo must not mean "delete everything"
+                raise serializers.ValidationError(
+                    {'filter': f"Unknown filter parameters: {', '.join(sorted(unknown))}."}
+                )
+            filterset = self.filterset_class(
+                data=selection['filter'], queryset=self.get_queryset(), request=request
+            )
+            if not filterset.is_valid():
+                raise serializers.ValidationError({'filter': filterset.errors})
+            if not filterset.is_restrictive():
+                raise serializers.ValidationError({'filter': "The filter must narrow down the files to delete."})
+            matching = filterset.qs.order_by('pk').values_list('pk', flat=True)
+            last_pk = 0
+            while True:
+                # Keyset over the primary key, so each batch is a fresh index range scan
+                batch = list(matching.filter(pk__gt=last_pk)[:batch_size])
+                if not batch:
+                    break
+                last_pk = batch[-1]
+                deleted, removed = self.delete_batch(batch)
+                blobs_removed += removed
+                results.extend({'id': pk, 'status': 204} for pk in batch if pk in deleted)
+
+        deleted_count = sum(1 for result in results if result['status'] == 204)
+        logger.info("Bulk delete", extra={'files': deleted_count, 'blobs_removed': blobs_removed})
+        return Response({'deleted': deleted_count, 'blobs_removed': blobs_removed, 'results': results})
+
+    def delete_batch(self, ids):
+        """
+        Deletes the user's files among ids in one transaction, with a fixed
+        number of queries whatever the batch size: lock the rows, one DELETE,
+        then the blobs' remaining reference counts are read (and locked) in a
+        single query and orphaned blobs are removed together.
+        Returns (set of deleted IDs, number of blobs removed).
+        """
+        with transaction.atomic():
+            rows = list(
+                self.get_queryset().filter(pk__in=ids)
+                .select_for_update().order_by('pk')
+                .only('id', 'owner_id', 'blob_id', 'file_size')
+            )
+            if not rows:
+                return set(), 0
+            FileMetadata.objects.filter(pk__in=[row.pk for row in rows]).delete()
+            removed = release_blobs(Counter(row.blob_id for row in rows))
+            count_files_removed(rows)
+        DELETES.inc(len(rows))
+        BLOBS_REMOVED.inc(len(removed))
+        return {row.pk for row in rows}, len(removed)
+
     @action(detail=True, methods=['get'])
     def download(self, request, pk=None):
         """
         Custom action to download the actual file blob associated
         with a specific FileMetadata record ID (pk).
+        Supports conditional requests (ETag / If-None-Match) and byte ranges
+        (Range / If-Range), so downloads can be cached, resumed and seeked.
+        Compressed blobs are sent as stored, with Content-Encoding, to clients
+        that accept their codec, and decompressed on the fly for the others.
         """
-        instance = self.get_object() # Retrieves instance, checks permissions
-        storage_key = f"uploads/{instance.file_hash}"
+        phases = PhaseTimer('download')
+        with phases('lookup'):
+            instance = self.get_object() # Retrieves instance, checks permissions
+        blob = instance.blob
 
-        if not default_storage.exists(storage_key):
-            print(f"Error: File not found in storage at {storage_key}")
-            raise Http404(f"File not found in storage for hash {instance.file_hash}")
+        # Ranges always refer to the original bytes, so they are served from
+        # the decompressed stream
+        content_encoding = None
+        if (
+            blob.codec
+            and 'Range' not in request.headers
+            and accepts_encoding(request.headers.get('Accept-Encoding'), blob.codec)
+        ):
+            content_encoding = blob.codec
+
+        # Blobs are immutable: a matching ETag means the client already has it
+        not_modified = not_modified_response(request, instance.file_hash, content_encoding)
+        if not_modified is not None:
+            DOWNLOADS.inc(mode='not_modified')
+            return self._vary_on_encoding(not_modified, blob)
+
+        store = get_blob_store()
+        opening = time.perf_counter()
+
+        # Chunked blobs are reassembled here, chunk by chunk, and compressed
+        # ones need their headers set here, so only plain files are handed to
+        # nginx (and only if the blob store is on a filesystem nginx can read).
+        # Everything else is looked up by opening it below, which the blob
+        # cache can answer without asking primary storage.
+        if (
+            not blob.chunked and not blob.codec
+            and settings.VAULT_DOWNLOAD_MODE == 'accel' and store.supports_accel
+        ):
+            storage_path = store.locate(BLOBS, instance.file_hash)
+            if storage_path is None:
+                logger.error("File not found in storage", extra={'file_hash': instance.file_hash})
+                raise Http404(f"File not found in storage for hash {instance.file_hash}")
+
+            # Access is checked, let nginx send the bytes with sendfile
+            phases.record('open', time.perf_counter() - opening)
+            self._count_download('accel', instance.file_size, instance, phases)
+            return accel_redirect_response(
+                storage_path,
+                file_hash=instance.file_hash,
+                filename=instance.original_filename,
+                content_type=instance.content_type,
+            )
 
         try:
-            file_handle = default_storage.open(storage_key, 'rb')
+            file_handle = open_stored_blob(blob) if content_encoding else open_blob(blob)
+        except FileNotFoundError:
+            logger.error("File not found in storage", extra={'file_hash': instance.file_hash})
+            raise Http404(f"File not found in storage for hash {instance.file_hash}")
         except IOError as e:
-            print(f"Error opening file {storage_key}: {e}")
+            logger.error("Could not open file in storage", extra={'file_hash': instance.file_hash, 'error': str(e)})
             raise Http404(f"Could not open file in storage for hash {instance.file_hash}")
+        phases.record('open', time.perf_counter() - opening)
+
+        if content_encoding:
+            response = encoded_blob_response(
+                file_handle,
+                stored_size=blob.stored_size,
+                file_hash=instance.file_hash,
+                content_encoding=content_encoding,
+                filename=instance.original_filename,
+                content_type=instance.content_type,
+            )
+            mode = 'encoded'
+        else:
+            # Streams the full file (FileResponse) or only the requested ranges
+            response = blob_response(
+                request,
+                file_handle,
+                size=instance.file_size,
+                file_hash=instance.file_hash,
+                filename=instance.original_filename,
+                content_type=instance.content_type,
+            )
+            mode = {
+                status.HTTP_206_PARTIAL_CONTENT: 'range',
+                status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE: 'unsatisfiable',
+            }.get(response.status_code, 'full')
+        # Every streamed response declares its length up front
+        self._count_download(mode, int(response.get('Content-Length', 0)), instance, phases)
+        return self._vary_on_encoding(response, blob)
+
+    @staticmethod
+    def _count_download(mode, body_bytes, instance, phases):
+        DOWNLOADS.inc(mode=mode)
+        DOWNLOAD_BYTES.inc(body_bytes, mode=mode)
+        logger.info("Download", extra={
+            'file_id': instance.pk,
+            'file_hash': instance.file_hash,
+            'mode': mode,
+            'bytes': body_bytes,
+            'phases_ms': phases.as_ms(),
+        })
+
+    @staticmethod
+    def _vary_on_encoding(response, blob):
+        """Compressed blobs are sent differently depending on Accept-Encoding."""
+        if blob.codec:
+            patch_vary_headers(response, ['Accept-Encoding'])
+        return response
+
+    def _archive_selection(self, request):
+        """The files an archive request selects; 400 or 404 if none can be."""
+        queryset = self.filter_queryset(self.get_queryset())
 
-        # Use FileResponse for efficient streaming
-        response = FileResponse(file_handle, as_attachment=True, filename=instance.original_filename)
+        ids = request.query_params.get('ids')
+        if ids:
+            try:
+                id_list = [int(value) for value in ids.split(',') if value.strip()]
+            except ValueError:
+                raise serializers.ValidationError({'ids': "Must be a comma-separated list of file IDs."})
+            if len(id_list) > settings.VAULT_BULK_MAX_ITEMS:
+                raise serializers.ValidationError(
+                    {'ids': f"At most {settings.VAULT_BULK_MAX_ITEMS} IDs per archive."}
+                )
+            queryset = queryset.filter(pk__in=id_list)
+
+        if not queryset.exists():
+            raise Http404("No files match the selection.")
+        return queryset
+
+    @action(
+        detail=False, methods=['get'],
+        # Also accepts the links handed out by archive_link below
+        authentication_classes=[*api_settings.DEFAULT_AUTHENTICATION_CLASSES, ArchiveLinkAuthentication],
+    )
+    def archive(self, request):
+        """
+        Downloads several files as a single ZIP archive, streamed as it is
+        built. Select files with ?ids=1,2,3 and/or the same filter parameters
+        as the file list (no selection means all of the user's files).
+        Identical filenames are numbered ('name (1).ext'), and already
+        compressed content types are stored rather than deflated again.
+        """
+        queryset = self._archive_selection(request)
+
+        # Rows are fetched in batches while the archive streams, not all up front
+        files = iter_archive_files(
+            queryset.select_related('blob')
+            .only(
+                'id', 'original_filename', 'file_hash', 'file_size', 'content_type', 'upload_date',
+                'blob__hash', 'blob__size', 'blob__chunked', 'blob__codec', 'blob__stored_size',
+            )
+        )
+        response = StreamingHttpResponse(iter_zip_archive(files), content_type='application/zip')
+        archive_name = f"vault-{timezone.localtime():%Y%m%d-%H%M%S}.zip"
+        response['Content-Disposition'] = content_disposition_header(True, archive_name)
+        # Let nginx pass the stream through instead of spooling it to disk first
+        response['X-Accel-Buffering'] = 'no'
+        logger.info("Streaming archive", extra={'archive': archive_name, 'user_id': request.user.pk})
         return response
 
+    @action(detail=False, methods=['post'], url_path='archive-link')
+    def archive_link(self, request):
+        """
+        Returns a short-lived link to the archive of the selection in the
+        query string (same parameters as archive/), which needs no token:
+        browsers download it by navigating to it, streaming it to disk,
+        instead of holding it in memory. See vault/archivelinks.py.
+        Responds {'url': relative URL, 'expires_in': seconds}.
+        """
+        self._archive_selection(request) # Same 400 / 404 as the archive itself
+        url = make_archive_link(request.user.pk, request.query_params, reverse('filemetadata-archive'))
+        return Response({'url': url, 'expires_in': settings.VAULT_ARCHIVE_LINK_TTL})
+
+    @action(detail=False, methods=['get'])
+    def changes(self, request):
+        """
+        Incremental sync: the files created, updated and deleted since ?since=<cursor>,
+        oldest first, with the cursor to pass next time. Without 'since' no
+        changes are returned, only the cursor to start from (take it before
+        listing the files). With ?wait=<seconds> the request waits up to
+        VAULT_CHANGES_MAX_WAIT seconds for a change if there is none yet.
+        'has_more' means the next page is already waiting; ?limit= sets the
+        page size.
+        """
+        try:
+            cursor = decode_cursor(request.query_params['since']) if 'since' in request.query_params else None
+        except ValueError:
+            raise serializers.ValidationError({'since': "Invalid cursor."})
+        try:
+            wait = parse_wait(request.query_params.get('wait'))
+        except ValueError:
+            raise serializers.ValidationError({'wait': "Must be a number of seconds."})
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE))
+        except ValueError:
+            raise serializers.ValidationError({'limit': "Must be an integer."})
+
+        changes, next_cursor, has_more = get_changes(request.user, cursor, limit)
+        if not changes and wait and cursor is not None:
+            # Long-poll; only waiting requests pay for a second look at the log
+            if wait_for_changes(request.user, decode_cursor(next_cursor)[0], wait):
+                changes, next_cursor, has_more = get_changes(request.user, cursor, limit)
+
+        file_ids = [change.file_id for change in changes if change.action != FileChange.DELETED]
+        files = FileMetadata.objects.filter(owner=request.user).select_related('blob').in_bulk(file_ids) if file_ids else {}
+        return Response({
+            'cursor': next_cursor,
+            'has_more': has_more,
+            'changes': FileChangeSerializer(changes, many=True, context={'files': files}).data,
+        })
+
     def perform_destroy(self, instance):
         """
-        Overrides deletion behavior. Checks reference count based on hash
-        before deleting the physical file, then deletes metadata.
-        """
-        file_hash_to_check = instance.file_hash
-        instance_pk = instance.pk
-
-        print(f"Attempting deletion for metadata instance {instance_pk} with hash {file_hash_to_check}")
-
-        if file_hash_to_check:
-            # Count OTHER records with the same hash
-            reference_count = FileMetadata.objects.filter(
-                file_hash=file_hash_to_check
-            ).exclude(pk=instance_pk).count()
-
-            print(f"Found {reference_count} other metadata records referencing hash {file_hash_to_check}.")
-
-            if reference_count == 0:
-                # Last reference, delete physical file
-                storage_key = f"uploads/{file_hash_to_check}"
-                if default_storage.exists(storage_key):
-                    try:
-                        default_storage.delete(storage_key)
-                        print(f"Deleted physical file from storage: {storage_key}")
-                    except Exception as e: # Catch broader exceptions during delete
-                        print(f"ERROR: Could not delete file {storage_key} from storage: {e}")
-                else:
-                    print(f"Physical file {storage_key} already gone from storage.")
-            else:
-                print(f"Other metadata records reference hash {file_hash_to_check}. Physical file not deleted.")
+        Overrides deletion behavior. Deletes the metadata, drops its
+        reference to the blob and updates the owner's usage counters in one
+        transaction; the physical file is deleted together with the Blob row
+        when the last reference goes.
+        """
+        phases = PhaseTimer('delete')
+        with transaction.atomic():
+            with phases('metadata_delete'):
+                # Through the queryset, so the instance keeps its ID for the change log
+                deleted, _ = FileMetadata.objects.filter(pk=instance.pk).delete()
+            if not deleted:
+                # A concurrent delete of the same file got there first (this
+                # DELETE waited for its row lock): it already dropped the
+                # blob reference and the usage, they must not go twice
+                return
+            with phases('blob_release'): # Includes deleting the stored file if this was the last reference
+                blob_removed = release_blob(instance.blob_id)
+            with phases('usage_update'):
+                count_files_removed([instance])
+            committing = time.perf_counter()
+        phases.record('commit', time.perf_counter() - committing)
+
+        DELETES.inc()
+        BLOBS_REMOVED.inc(int(blob_removed))
+        # Other records may still reference the blob, then only the metadata went
+        logger.info("File deleted", extra={
+            'file_id': instance.pk,
+            'file_hash': instance.file_hash,
+            'blob_removed': blob_removed,
+            'phases_ms': phases.as_ms(),
+        })
+
+
+# --- Resumable Upload Session ViewSet ---
+class UploadSessionViewSet(mixins.CreateModelMixin,
+                           mixins.RetrieveModelMixin,
+                           mixins.DestroyModelMixin,
+                           viewsets.GenericViewSet):
+    """
+    API endpoint for resumable, chunked uploads of large files.
+
+    POST   /uploads/                      Create a session (original_filename, content_type, file_size)
+    GET    /uploads/{id}/                 Session status, including which chunks were received
+    PUT    /uploads/{id}/chunks/{index}/  Send one chunk as the raw request body,
+                                          with its SHA-256 in the X-Chunk-SHA256 header
+    POST   /uploads/{id}/finalize/        Assemble into a FileMetadata record, like a normal upload
+    DELETE /uploads/{id}/                 Abort and discard the received data
+
+    A session expires VAULT_UPLOAD_SESSION_TTL seconds after its last chunk
+    and is then treated as deleted. Once finalize has started, chunks are
+    refused with 409 until it fails (e.g. on an expected_hash mismatch).
+    """
+    serializer_class = UploadSessionSerializer
+    permission_classes = [permissions.IsAuthenticated] # Only logged-in users
+
+    # Chunk bodies are copied from the request stream in blocks of this size,
+    # so memory use does not depend on the chunk size.
+    stream_block_size = 1024 * 1024 # 1 MB
+
+    def get_queryset(self):
+        """Only the current user's unexpired sessions, with their received chunks."""
+        return UploadSession.objects.filter(
+            owner=self.request.user, expires_at__gt=timezone.now()
+        ).prefetch_related('chunks')
+
+    def perform_create(self, serializer):
+        """
+        Creates the session and preallocates its (sparse) part file, so chunks
+        can be written at their final offset in any order.
+        """
+        chunk_size = serializer.validated_data.get('chunk_size') or settings.VAULT_UPLOAD_CHUNK_SIZE
+        session = serializer.save(owner=self.request.user, chunk_size=chunk_size)
+
+        with open(get_session_part_path(session.id), 'wb') as part_file:
+            part_file.truncate(session.file_size)
+        logger.info("Created upload session", extra={'session_id': str(session.id), 'chunks': session.total_chunks})
 
-        # Always delete the metadata record itself
+    def perform_destroy(self, instance):
+        """Aborts the session and removes its part file."""
+        part_path = get_session_part_path(instance.id)
         instance.delete()
-        print(f"Deleted metadata instance {instance_pk}.")
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+
+    @action(detail=True, methods=['put'], url_path=r'chunks/(?P<index>\d+)')
+    def chunk(self, request, pk=None, index=None):
+        """
+        Receives one chunk. The body is streamed into a temporary file while
+        being hashed and checked against the X-Chunk-SHA256 header; only a
+        verified chunk is copied into the part file at its offset, under the
+        session row lock. Sending the same index again replaces it.
+        """
+        session = self.get_object()
+        index = int(index)
+        if index >= session.total_chunks:
+            raise serializers.ValidationError(f"Chunk index must be below {session.total_chunks}.")
+
+        expected_chunk_hash = request.headers.get('X-Chunk-SHA256', '').lower()
+        if not re.fullmatch(r'[0-9a-f]{64}', expected_chunk_hash):
+            raise serializers.ValidationError("X-Chunk-SHA256 header with the chunk's SHA-256 is required.")
+
+        if session.finalizing:
+            return self._finalizing_response()
+
+        offset, length = session.chunk_bounds(index)
+        hasher = hashlib.sha256()
+        received = 0
+        stream = request.stream # None for an empty body
+
+        # The slow part, reading from the client, goes to a temporary file
+        # without any lock held; the part file is only written below
+        with create_temp_file(suffix='.chunk') as chunk_file:
+            temp_path = chunk_file.name
+            try:
+                while stream is not None and received < length:
+                    block = stream.read(min(self.stream_block_size, length - received))
+                    if not block:
+                        break
+                    hasher.update(block)
+                    chunk_file.write(block)
+                    received += len(block)
+            except BaseException:
+                chunk_file.close()
+                os.remove(temp_path)
+                raise
+
+        try:
+            too_long = stream is not None and bool(stream.read(1))
+            if received != length or too_long:
+                raise serializers.ValidationError(f"Chunk {index} must be exactly {length} bytes.")
+            if hasher.hexdigest() != expected_chunk_hash:
+                raise serializers.ValidationError(f"Checksum mismatch for chunk {index}.")
+
+            with transaction.atomic():
+                # The row lock finalize takes to set 'finalizing': either this
+                # chunk is in the part file before finalize hashes it, or it
+                # sees the flag and the part file is left alone
+                session = UploadSession.objects.select_for_update().filter(
+                    pk=session.pk, expires_at__gt=timezone.now()
+                ).first()
+                if session is None:
+                    raise Http404 # Finalized, aborted or expired since get_object()
+                if session.finalizing:
+                    return self._finalizing_response()
+
+                try:
+                    part_file = open(get_session_part_path(session.id), 'r+b')
+                except FileNotFoundError:
+                    raise Http404
+                with part_file, open(temp_path, 'rb') as chunk_data:
+                    part_file.seek(offset)
+                    shutil.copyfileobj(chunk_data, part_file, self.stream_block_size)
+
+                session.expires_at = session_expiry()
+                session.save(update_fields=['expires_at'])
+                UploadChunk.objects.update_or_create(
+                    session=session,
+                    index=index,
+                    defaults={'size': length, 'chunk_hash': expected_chunk_hash},
+                )
+        finally:
+            os.remove(temp_path)
+        return Response({'index': index, 'size': length, 'chunk_hash': expected_chunk_hash})
+
+    def _finalizing_response(self):
+        """409 for a chunk sent while the session is being finalized."""
+        return Response({'detail': "Upload is being finalized."}, status=status.HTTP_409_CONFLICT)
+
+    @action(detail=True, methods=['post'])
+    def finalize(self, request, pk=None):
+        """
+        Completes the upload once every chunk has been received. Produces the
+        same uploads/<hash> blob and FileMetadata record as a single-request upload.
+        """
+        session = self.get_object()
+        received_indexes = {chunk.index for chunk in session.chunks.all()}
+        missing = [i for i in range(session.total_chunks) if i not in received_indexes]
+        if missing:
+            return Response(
+                {'detail': "Upload is incomplete.", 'missing_chunks': missing},
+                status=status.HTTP_409_CONFLICT,
+            )
+
+        # Marked under the session row lock, which waits for any chunk being
+        # copied into the part file; chunk() refuses to write after this.
+        # Only the flag is set here, the lock is not held while hashing.
+        with transaction.atomic():
+            unexpired = UploadSession.objects.filter(pk=session.pk, expires_at__gt=timezone.now())
+            if not unexpired.filter(finalizing=False).update(finalizing=True):
+                if unexpired.exists():
+                    return Response({'detail': "Upload is already being finalized."}, status=status.HTTP_409_CONFLICT)
+                raise Http404
+
+        try:
+            return self._finalize(request, pk, session)
+        except BaseException:
+            # Chunks may be re-sent and finalize retried (no-op if the session is gone)
+            UploadSession.objects.filter(pk=session.pk).update(finalizing=False)
+            raise
+
+    def _finalize(self, request, pk, session):
+        """Hashes and commits the part file of a session marked as finalizing."""
+        # Each chunk was verified on arrival, but the dedup key is the digest
+        # of the whole file. hashlib state cannot be persisted between the
+        # requests that delivered the chunks, so this is one sequential,
+        # constant-memory pass over the local part file. No chunk can change
+        # it anymore, and the session is only locked for the short commit below.
+        part_path = get_session_part_path(session.id)
+        hasher = hashlib.sha256()
+        try:
+            with open(part_path, 'rb') as part_file:
+                for block in iter(lambda: part_file.read(self.stream_block_size), b''):
+                    hasher.update(block)
+        except FileNotFoundError:
+            raise Http404 # Finalized or expired meanwhile
+        file_hash = hasher.hexdigest()
+
+        if session.expected_hash and session.expected_hash != file_hash:
+            raise serializers.ValidationError("Assembled file does not match expected_hash.")
+
+        # Chunking and compression, also before any lock (see prepare_content)
+        prepared = prepare_content(file_hash, session.file_size, part_path, content_type=session.content_type)
+
+        with prepared, transaction.atomic():
+            # Row lock against an abort or expiry deleting the session meanwhile
+            session = get_object_or_404(self.get_queryset().select_for_update(), pk=pk)
+
+            try:
+                blob, is_new_blob = acquire_blob(
+                    file_hash, session.file_size, part_path, content_type=session.content_type,
+                    prepared=prepared,
+                )
+            except OSError as e:
+                logger.error("Failed to save file to storage", extra={'file_hash': file_hash, 'error': str(e)})
+                raise serializers.ValidationError("Failed to save file to storage.")
+
+            instance = FileMetadata.objects.create(
+                owner=request.user,
+                original_filename=session.original_filename,
+                file_hash=file_hash,
+                file_size=session.file_size,
+                content_type=session.content_type,
+                blob=blob,
+            )
+            count_files_added([instance])
+            session.delete()
+
+        record_upload(instance.file_size, is_new_blob)
+        logger.info("Finalized upload session", extra={
+            'session_id': str(pk), 'file_id': instance.pk, 'file_hash': file_hash, 'duplicate': not is_new_blob,
+        })
+        return Response(FileMetadataSerializer(instance).data, status=status.HTTP_201_CREATED)
+
+
+# --- Storage Stats View ---
+class StorageStatsView(APIView):
+    """
+    API endpoint returning the current user's storage usage: file count,
+    logical bytes (every record counted) and physical bytes (each distinct
+    blob counted once). Staff users also get vault-wide totals and the
+    overall deduplication ratio under 'global'.
+    Served from counter rows maintained on upload and delete (vault/usage.py).
+    """
+    permission_classes = [permissions.IsAuthenticated] # Only logged-in users
+
+    def get(self, request):
+        data = get_user_usage(request.user)
+        if request.user.is_staff:
+            data['global'] = get_vault_usage()
+        return Response(data)
 
 
 # --- User Registration View ---
@@ -160,3 +892,22 @@ class UserCreate(generics.CreateAPIView):
     serializer_class = UserSerializer
     permission_classes = [permissions.AllowAny] # Allow anyone to register
 
+
+# --- Login (Token) View ---
+class ObtainTokenView(ObtainAuthToken):
+    """
+    Exchanges a username and password for the user's API token, like DRF's
+    obtain_auth_token, but replaces the token with a new one once it has
+    expired (VAULT_TOKEN_TTL).
+    """
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user = serializer.validated_data['user']
+        with transaction.atomic():
+            # Locked, so concurrent logins agree on the replacement
+            token, created = Token.objects.select_for_update().get_or_create(user=user)
+            if not created and is_token_expired(token):
+                token.delete() # Also drops it from the token caches
+                token = Token.objects.create(user=user)
+        return Response({'token': token.key})
@@ -1,50 +1,98 @@
 // src/components/FileList.js
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef, useCallback } from 'react';
 import axios from 'axios';
 
+// Number of files requested per page from the (cursor-paginated) list endpoint
+const PAGE_SIZE = 100;
+
+// Saves downloaded binary data under the given filename
+function saveToDisk(data, filename) {
+  const url = window.URL.createObjectURL(new Blob([data]));
+  const link = document.createElement('a');
+  link.href = url;
+  link.setAttribute('download', filename);
+  document.body.appendChild(link);
+  link.click();
+  link.parentNode.removeChild(link);
+  window.URL.revokeObjectURL(url);
+}
+
 function FileList() {
   const [files, setFiles] = useState([]); // Store the list of files
-  const [loading, setLoading] = useState(true); // Track loading state
+  const [loading, setLoading] = useState(true); // Track loading state (first page)
+  const [loadingMore, setLoadingMore] = useState(false); // Track loading of later pages
+  const [nextUrl, setNextUrl] = useState(null); // Cursor link to the next page, null when done
   const [error, setError] = useState(null); // Store potential errors
+  const [selectedIds, setSelectedIds] = useState([]); // Files ticked for a ZIP download
+  const [archiving, setArchiving] = useState(false); // Track a running ZIP download
+
+  // Sentinel element at the bottom of the list, observed for infinite scroll
+  const sentinelRef = useRef(null);
 
-  // Function to fetch files (can be called again later if needed)
-  const fetchFiles = async () => {
-    setLoading(true); // Start loading
+  // Function to fetch one page of files. Without a URL it loads the first page,
+  // otherwise it follows the 'next' cursor link and appends the results.
+  const fetchFiles = useCallback(async (pageUrl = null) => {
+    const isFirstPage = pageUrl === null;
+    if (isFirstPage) {
+      setLoading(true); // Start loading
+    } else {
+      setLoadingMore(true);
+    }
     setError(null); // Clear previous errors
     const token = localStorage.getItem('token');
 
     if (!token) {
       setError("Authentication token not found. Please log in again.");
       setLoading(false);
+      setLoadingMore(false);
       return; // Stop if no token
     }
 
+    // Make GET request to the backend file list endpoint using env variable.
+    // 'next' links are relative to the API host (path and query string).
+    const apiUrl = pageUrl
+      ? `${process.env.REACT_APP_API_BASE_URL}${pageUrl}`
+      : `${process.env.REACT_APP_API_BASE_URL}/api/vault/files/?page_size=${PAGE_SIZE}`;
     try {
-      // --- CORRECTED URL ---
-      // Make GET request to the backend file list endpoint using env variable
-      const apiUrl = `${process.env.REACT_APP_API_BASE_URL}/api/vault/files/`;
-      console.log("Fetching files from:", apiUrl); // Optional debug log
       const response = await axios.get(apiUrl, {
         headers: {
           'Authorization': `Token ${token}`
         }
       });
-      // --- END CORRECTION ---
-      setFiles(response.data); // Update state with the array of files received
+      const pageFiles = response.data.results;
+      setFiles(currentFiles => isFirstPage ? pageFiles : [...currentFiles, ...pageFiles]);
+      setNextUrl(response.data.next);
     } catch (err) {
       console.error("Failed to fetch files:", err);
        // Log the URL that was actually used in case of error
-      console.error('Failed URL:', `${process.env.REACT_APP_API_BASE_URL}/api/vault/files/`);
+      console.error('Failed URL:', apiUrl);
       setError("Failed to fetch files. " + (err.response?.data?.detail || err.message));
     } finally {
       setLoading(false); // Stop loading
+      setLoadingMore(false);
     }
-  };
+  }, []);
 
-  // Fetch files when the component mounts
+  // Fetch the first page when the component mounts
   useEffect(() => {
     fetchFiles();
-  }, []); // Empty dependency array means run only once on mount
+  }, [fetchFiles]);
+
+  // Load the next page when the sentinel below the list scrolls into view,
+  // so only the pages the user actually scrolls to are fetched and rendered.
+  useEffect(() => {
+    const sentinel = sentinelRef.current;
+    if (!sentinel || !nextUrl || loadingMore) {
+      return undefined;
+    }
+    const observer = new IntersectionObserver(entries => {
+      if (entries[0].isIntersecting) {
+        fetchFiles(nextUrl);
+      }
+    }, { rootMargin: '200px' });
+    observer.observe(sentinel);
+    return () => observer.disconnect();
+  }, [nextUrl, loadingMore, fetchFiles]);
 
   // --- Download Handler ---
   const handleDownload = async (fileId, filename) => {
@@ -67,14 +115,7 @@ function FileList() {
       // --- END CORRECTION ---
 
       // Trigger browser download
-      const url = window.URL.createObjectURL(new Blob([response.data]));
-      const link = document.createElement('a');
-      link.href = url;
-      link.setAttribute('download', filename);
-      document.body.appendChild(link);
-      link.click();
-      link.parentNode.removeChild(link);
-      window.URL.revokeObjectURL(url);
+      saveToDisk(response.data, filename);
 
     } catch (err) {
       console.error("Download failed:", err);
@@ -97,6 +138,43 @@ function FileList() {
     }
   };
 
+  // --- Selection for ZIP downloads ---
+  const toggleSelected = (fileId) => {
+    setSelectedIds(current =>
+      current.includes(fileId) ? current.filter(id => id !== fileId) : [...current, fileId]
+    );
+  };
+
+  // --- ZIP Download Handler ---
+  // The server streams one archive for all selected files, instead of one request per file.
+  // It is fetched through a short-lived link the browser navigates to, so the archive
+  // streams straight to disk instead of being held in memory as a blob first.
+  const handleDownloadArchive = async () => {
+    const token = localStorage.getItem('token');
+    if (!token) {
+      setError("Authentication token not found. Please log in again.");
+      return;
+    }
+    setError(null);
+    setArchiving(true);
+
+    const linkUrl = `${process.env.REACT_APP_API_BASE_URL}/api/vault/files/archive-link/?ids=${selectedIds.join(',')}`;
+    try {
+      const response = await axios.post(linkUrl, null, {
+        headers: { 'Authorization': `Token ${token}` },
+      });
+      // Relative URL carrying its own signed token, valid for about a minute
+      window.location.assign(`${process.env.REACT_APP_API_BASE_URL}${response.data.url}`);
+      setSelectedIds([]);
+    } catch (err) {
+      console.error("Archive download failed:", err);
+      console.error('Failed URL:', linkUrl);
+      setError("Failed to download the selected files. " + (err.response?.status === 404 ? "Files not found." : err.message));
+    } finally {
+      setArchiving(false);
+    }
+  };
+
   // --- Delete Handler ---
   const handleDelete = async (fileId, filename) => {
     if (!window.confirm(`Are you sure you want to delete "${filename}"? This action cannot be undone.`)) {
@@ -123,6 +201,7 @@ function FileList() {
         console.log(`Successfully deleted file metadata ${fileId}`);
         // Update UI by removing the deleted file from the state
         setFiles(currentFiles => currentFiles.filter(file => file.id !== fileId));
+        setSelectedIds(current => current.filter(id => id !== fileId));
       } else {
          setError(`Deletion failed with status: ${response.status}`);
       }
@@ -156,11 +235,29 @@ function FileList() {
       <h3>Your Uploaded Files:</h3>
       {/* Display errors related to download/delete above the list */}
       {error && <p className="error-message">Error: {error}</p>}
+      <button
+        onClick={handleDownloadArchive}
+        className="button-3d" // Apply style
+        disabled={selectedIds.length === 0 || archiving}
+        style={{ marginBottom: '10px' }}
+      >
+        {archiving ? 'Preparing ZIP...' : `Download selected as ZIP (${selectedIds.length})`}
+      </button>
       <ul style={{ padding: 0 }}> {/* Removed list-style none as it's on item */}
         {files.map(file => (
           // Apply item style to each li
           <li key={file.id} className="file-item-3d">
-            <div><strong>Name:</strong> {file.original_filename}</div>
+            <div>
+              <label>
+                <input
+                  type="checkbox"
+                  checked={selectedIds.includes(file.id)}
+                  onChange={() => toggleSelected(file.id)}
+                  style={{ marginRight: '8px' }}
+                />
+                <strong>Name:</strong> {file.original_filename}
+              </label>
+            </div>
             <div><strong>Size:</strong> {file.file_size} bytes</div>
             <div><strong>Type:</strong> {file.content_type}</div>
             <div><strong>Uploaded:</strong> {new Date(file.upload_date).toLocaleString()}</div>
@@ -184,6 +281,9 @@ function FileList() {
           </li>
         ))}
       </ul>
+      {/* Infinite scroll: reaching this element loads the next page */}
+      {nextUrl && <div ref={sentinelRef} style={{ height: '1px' }} />}
+      {loadingMore && <p>Loading more files...</p>}
     </div>
   );
 }
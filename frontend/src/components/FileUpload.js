@@ -2,6 +2,99 @@
 import React, { useState, useRef } from 'react'; // Import useRef
 import axios from 'axios';
 
+// Files larger than this are not hashed in the browser before uploading.
+// crypto.subtle.digest needs the whole file in memory, so for very large
+// files we skip the dedup probe and go straight to a normal upload.
+const CLAIM_MAX_HASH_BYTES = 512 * 1024 * 1024; // 512 MB
+
+// Files larger than this are sent through the resumable upload session API,
+// in chunks that are retried individually and resumed after a page reload.
+const CHUNKED_UPLOAD_THRESHOLD = 64 * 1024 * 1024; // 64 MB
+const CHUNK_ATTEMPTS = 3; // Tries per chunk before giving up
+
+// Lowercase hex SHA-256 of an ArrayBuffer
+async function sha256Hex(buffer) {
+  const digest = await window.crypto.subtle.digest('SHA-256', buffer);
+  return Array.from(new Uint8Array(digest))
+    .map(byte => byte.toString(16).padStart(2, '0'))
+    .join('');
+}
+
+// Computes the SHA-256 of a File, or null if hashing is unavailable
+// (non-secure context) or the file is too large to hash here.
+async function hashFile(file) {
+  if (!window.crypto?.subtle || file.size > CLAIM_MAX_HASH_BYTES) {
+    return null;
+  }
+  return sha256Hex(await file.arrayBuffer());
+}
+
+// Answers a claim challenge: the SHA-256 of each requested byte range
+// ([start, end), end exclusive), proving we hold the file and not just its hash.
+async function claimProofs(file, ranges) {
+  const proofs = [];
+  for (const [start, end] of ranges) {
+    proofs.push(await sha256Hex(await file.slice(start, end).arrayBuffer()));
+  }
+  return proofs;
+}
+
+// Uploads a file as numbered chunks through /api/vault/uploads/.
+// The session id is remembered in localStorage, so retrying the same file
+// later only sends the chunks the server has not received yet.
+async function uploadInChunks(file, headers, onProgress) {
+  const sessionsUrl = `${process.env.REACT_APP_API_BASE_URL}/api/vault/uploads/`;
+  const resumeKey = `vault-upload:${file.name}:${file.size}:${file.lastModified}`;
+
+  // Resume an earlier session for this file if the server still has it
+  let session = null;
+  const savedSessionId = localStorage.getItem(resumeKey);
+  if (savedSessionId) {
+    try {
+      session = (await axios.get(`${sessionsUrl}${savedSessionId}/`, { headers })).data;
+    } catch {
+      localStorage.removeItem(resumeKey); // Expired or aborted, start over
+    }
+  }
+  if (!session) {
+    session = (await axios.post(sessionsUrl, {
+      original_filename: file.name,
+      content_type: file.type || 'application/octet-stream',
+      file_size: file.size,
+    }, { headers })).data;
+    localStorage.setItem(resumeKey, session.id);
+  }
+
+  const received = new Set(session.received_chunks);
+  for (let index = 0; index < session.total_chunks; index++) {
+    if (!received.has(index)) {
+      const chunk = file.slice(index * session.chunk_size, (index + 1) * session.chunk_size);
+      const chunkHash = await sha256Hex(await chunk.arrayBuffer());
+      for (let attempt = 1; ; attempt++) {
+        try {
+          await axios.put(`${sessionsUrl}${session.id}/chunks/${index}/`, chunk, {
+            headers: {
+              ...headers,
+              'Content-Type': 'application/octet-stream',
+              'X-Chunk-SHA256': chunkHash,
+            },
+          });
+          break;
+        } catch (err) {
+          if (attempt >= CHUNK_ATTEMPTS) {
+            throw err;
+          }
+        }
+      }
+    }
+    onProgress(index + 1, session.total_chunks);
+  }
+
+  const response = await axios.post(`${sessionsUrl}${session.id}/finalize/`, null, { headers });
+  localStorage.removeItem(resumeKey);
+  return response;
+}
+
 // Accept onUploadSuccess prop from parent (Login component)
 function FileUpload({ onUploadSuccess }) { 
   const [selectedFile, setSelectedFile] = useState(null);
@@ -42,40 +135,79 @@ function FileUpload({ onUploadSuccess }) {
       return;
     }
 
-    // Create a FormData object to send the file
-    const formData = new FormData();
-    // Append the file with the key 'file' (matching what the backend view expects)
-    formData.append('file', selectedFile, selectedFile.name); 
+    // Called once the file is stored, whether via claim or full upload
+    const finishUpload = (successMessage) => {
+      setMessage(successMessage);
+      setSelectedFile(null); // Clear the selection state
+
+      // Reset the file input element visually
+      if (fileInputRef.current) {
+          fileInputRef.current.value = "";
+      }
+
+      // Call the callback function passed from parent to trigger refresh
+      if (onUploadSuccess) {
+          onUploadSuccess();
+      }
+    };
 
     try {
-      // --- CORRECTED URL CONSTRUCTION ---
-      // Use template literal (backticks) to correctly insert the environment variable
       const apiUrl = `${process.env.REACT_APP_API_BASE_URL}/api/vault/files/`;
-      console.log("Attempting upload to:", apiUrl); // Optional: log for debugging
+      const headers = { 'Authorization': `Token ${token}` };
 
-      // Make the POST request with axios
-      const response = await axios.post(apiUrl, formData, { 
-        headers: {
-          'Authorization': `Token ${token}`,
-          // 'Content-Type': 'multipart/form-data' // Axios sets this automatically
+      // --- Hash-first dedup probe ---
+      // If the vault already has this content, the server records the file
+      // without us sending any bytes. Unless we already own a copy, it first
+      // asks for hashes of a few byte ranges to prove we hold the file.
+      const sha256 = await hashFile(selectedFile);
+      if (sha256) {
+        const claim = {
+          sha256: sha256,
+          size: selectedFile.size,
+          filename: selectedFile.name,
+          content_type: selectedFile.type || 'application/octet-stream',
+        };
+        let claimResponse = await axios.post(`${apiUrl}claim/`, claim, { headers });
+        if (claimResponse.data.challenge) {
+          claimResponse = await axios.post(`${apiUrl}claim/`, {
+            ...claim,
+            challenge: claimResponse.data.challenge,
+            proofs: await claimProofs(selectedFile, claimResponse.data.ranges),
+          }, { headers });
         }
-      });
-      // --- END CORRECTION ---
 
-      // Handle success
-      if (response.status === 201) {
-        setMessage("File uploaded successfully!"); // Simplified message
-        setSelectedFile(null); // Clear the selection state
-        
-        // Reset the file input element visually
-        if (fileInputRef.current) {
-            fileInputRef.current.value = ""; 
+        if (claimResponse.status === 201 && !claimResponse.data.upload_required) {
+          finishUpload("File uploaded successfully! (content already in vault, no data sent)");
+          return;
         }
+      }
 
-        // Call the callback function passed from parent to trigger refresh
-        if (onUploadSuccess) { 
-            onUploadSuccess(); 
+      // --- Large files: resumable chunked upload ---
+      if (selectedFile.size > CHUNKED_UPLOAD_THRESHOLD && window.crypto?.subtle) {
+        const response = await uploadInChunks(selectedFile, headers, (done, total) => {
+          setMessage(`Uploading... (${done}/${total} chunks)`);
+        });
+        if (response.status === 201) {
+          finishUpload("File uploaded successfully!");
+        } else {
+          setMessage(`Upload failed with status: ${response.status}`);
         }
+        return;
+      }
+
+      // Create a FormData object to send the file
+      const formData = new FormData();
+      // Append the file with the key 'file' (matching what the backend view expects)
+      formData.append('file', selectedFile, selectedFile.name);
+
+      console.log("Attempting upload to:", apiUrl); // Optional: log for debugging
+
+      // Make the POST request with axios
+      const response = await axios.post(apiUrl, formData, { headers });
+
+      // Handle success
+      if (response.status === 201) {
+        finishUpload("File uploaded successfully!"); // Simplified message
       } else {
          setMessage(`Upload failed with status: ${response.status}`);
       }